@@ -0,0 +1,86 @@
+"""
+Zoom latency of interactive mode on a 10k x 10k matrix.
+
+Times resolving a zoom box into a pyramid layer and cells, and the full
+server-side work of a zoom: resolving, drawing the viewport into a palette PNG
+and building the hover grid.
+
+Usage:
+    python benchmarks/bench_viewport.py [--size 10000] [--layers 5] [--repeat 200]
+"""
+
+import argparse
+import time
+import numpy as np
+from moddotplot.viewport import (
+    ViewportResolver,
+    encodePng,
+    hoverGrid,
+    identityPalette,
+    quantizeIdentity,
+)
+
+IDENTITY = 86
+SEQUENCE_LENGTH = 100_000_000
+
+
+def makePyramid(size, layers):
+    # Coarsest layer first, finest `size` x `size`
+    rng = np.random.default_rng(0)
+    matrices = []
+    axes = []
+    for level in range(layers):
+        cells = max(size >> (layers - 1 - level), 1)
+        matrix = rng.uniform(IDENTITY, 100, (cells, cells)).astype(np.float32)
+        matrix[rng.random((cells, cells)) < 0.5] = 0
+        matrices.append(matrix)
+        axis = np.linspace(0, SEQUENCE_LENGTH, cells + 1)
+        axes += [axis, axis]
+    return matrices, axes
+
+
+def timeIt(fn, boxes):
+    times = []
+    for box in boxes:
+        start = time.perf_counter()
+        fn(box)
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    return np.median(times), np.percentile(times, 95)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=10000)
+    parser.add_argument("--layers", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    matrices, axes = makePyramid(args.size, args.layers)
+    resolver = ViewportResolver(matrices, axes, SEQUENCE_LENGTH)
+    palette = identityPalette("Viridis", IDENTITY, IDENTITY, 100, [IDENTITY, 100])
+
+    # Zoom boxes of every scale, anywhere on the matrix
+    rng = np.random.default_rng(1)
+    spans = SEQUENCE_LENGTH / 2.0 ** rng.uniform(0, args.layers + 1, args.repeat)
+    starts = rng.uniform(0, 1, (args.repeat, 2)) * (SEQUENCE_LENGTH - spans[:, None])
+    boxes = [(x, x + span, y, y + span) for (x, y), span in zip(starts.tolist(), spans)]
+
+    def zoom(box):
+        view, x_axis, y_axis = resolver.view(*resolver.resolve(*box))
+        encodePng(quantizeIdentity(view, IDENTITY), palette)
+        hoverGrid(view, x_axis, y_axis)
+
+    print(
+        f"{args.size} x {args.size} matrix, {args.layers} layers, {args.repeat} zooms"
+    )
+    for name, fn in [
+        ("resolve", lambda box: resolver.resolve(*box)),
+        ("resolve + render", zoom),
+    ]:
+        median, p95 = timeIt(fn, boxes)
+        print(f"{name:>18}: median {median:.3f} ms, p95 {p95:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
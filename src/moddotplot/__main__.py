@@ -8,4 +8,6 @@ import setproctitle
 # Set the process title to a custom name
 setproctitle.setproctitle("ModDotPlot")
 
-sys.exit(main())
+# Hashing workers import the main module again, so only run when executed
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+CHECKPOINT_FILE = "checkpoint.json"
+
+# Directory, inside the output directory, holding hashed sequences while a run is
+# in progress.
+KMER_CHECKPOINT_DIR = "kmer_checkpoint"
+
+
+def fingerprint(params):
+    """
+    Short, stable digest of the parameters a piece of work was computed with.
+    """
+    encoded = json.dumps(params, sort_keys=True, default=str).encode()
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+def fileStamp(path):
+    """
+    Absolute path, size and modification time of a file. Changes whenever the file
+    is replaced or edited, without having to read it.
+    """
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+class Checkpoint:
+    """
+    Records finished units of work (hashed sequences, row bands, pyramid layers,
+    matrices) in a JSON manifest, so a rerun can skip them.
+
+    The manifest is keyed by a fingerprint of the parameters the work was computed
+    with. A rerun with different parameters, or with `resume` off, ignores everything
+    recorded before and starts over. The manifest is rewritten atomically after each
+    unit, so an interrupted run never leaves it half written.
+    """
+
+    def __init__(self, directory, params, name=CHECKPOINT_FILE, resume=True):
+        self.directory = directory
+        self.path = os.path.join(directory, name)
+        self.fingerprint = fingerprint(params)
+        self.params = params
+        self.units = {}
+        if not resume or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            print(f"Unable to read checkpoint {self.path}, starting over.\n")
+            return
+        if state.get("fingerprint") == self.fingerprint:
+            self.units = state.get("units", {})
+        else:
+            print(
+                f"Parameters changed since the checkpoint in {self.directory} was written, starting over.\n"
+            )
+
+    def done(self, unit):
+        return unit in self.units
+
+    def get(self, unit, default=None):
+        return self.units.get(unit, default)
+
+    def mark(self, unit, info=True):
+        """
+        Record `unit` as finished, with any JSON-serializable details needed to pick
+        it back up.
+        """
+        self.units[unit] = info
+        os.makedirs(self.directory, exist_ok=True)
+        state = {
+            "fingerprint": self.fingerprint,
+            "params": self.params,
+            "units": self.units,
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, indent=2, default=str)
+        os.replace(tmp_path, self.path)
+
+    def saveArray(self, unit, array):
+        """
+        Save an array for `unit` next to the manifest, then mark the unit finished.
+        """
+        filename = hashlib.sha1(unit.encode()).hexdigest()[:16] + ".npy"
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = os.path.join(self.directory, filename + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, os.path.join(self.directory, filename))
+        self.mark(unit, {"file": filename})
+
+    def _arrayPath(self, unit):
+        info = self.units.get(unit)
+        if not isinstance(info, dict) or "file" not in info:
+            return None
+        path = os.path.join(self.directory, info["file"])
+        return path if os.path.exists(path) else None
+
+    def hasArray(self, unit):
+        return self._arrayPath(unit) is not None
+
+    def loadArray(self, unit):
+        """
+        Array saved for `unit` by saveArray, or None if it is missing.
+        """
+        path = self._arrayPath(unit)
+        return None if path is None else np.load(path)
+
+    def discard(self):
+        """
+        Delete the checkpoint directory once the work it guards is complete. Only
+        use on directories holding nothing but checkpoint files.
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.units = {}
@@ -7,25 +7,92 @@ from moddotplot.const import (
     QUALITATIVE_PALETTES,
 )
 from palettable import colorbrewer
-from typing import List, Set, Dict, Tuple
+from typing import List, Set, Tuple, NamedTuple, Union
 import mmh3
 import pandas as pd
+from itertools import repeat
 import cooler
 
-from moddotplot.parse_fasta import printProgressBar
+from moddotplot.progress import ProgressReporter
+from moddotplot.profiling import PROFILER
 
 
-def removeAmbiguousBases(mod_list, k):
-    # Ambiguous IUPAC codes
-    bases_to_remove = ["R", "Y", "M", "K", "S", "W", "H", "B", "V", "D", "N"]
-    kmers_to_remove = set()
-    for i in range(len(bases_to_remove)):
-        result_string = str(bases_to_remove[i]) * k
-        kmers_to_remove.add(mmh3.hash(result_string))
-    mod_set = set(mod_list)
-    # Remove homopolymers of ambiguous nucleotides
-    mod_set.difference_update(kmers_to_remove)
-    return mod_set
+class PackedSketches(NamedTuple):
+    """
+    Every window sketch of a sequence stored in one contiguous buffer.
+
+    Sketch i is values[offsets[i]:offsets[i + 1]], sorted in ascending order. Compared
+    to a list of Python sets this needs 4 bytes per modimizer, and intersections can be
+    computed for a whole row of windows at once.
+    """
+
+    values: np.ndarray
+    offsets: np.ndarray
+
+
+# Hashes of ambiguous homopolymers, keyed by k-mer length.
+AMBIGUOUS_HASHES = {}
+
+
+def ambiguousHashes(k):
+    if k not in AMBIGUOUS_HASHES:
+        # Ambiguous IUPAC codes
+        bases_to_remove = ["R", "Y", "M", "K", "S", "W", "H", "B", "V", "D", "N"]
+        kmers_to_remove = set()
+        for i in range(len(bases_to_remove)):
+            result_string = str(bases_to_remove[i]) * k
+            kmers_to_remove.add(mmh3.hash(result_string))
+        AMBIGUOUS_HASHES[k] = frozenset(kmers_to_remove)
+    return AMBIGUOUS_HASHES[k]
+
+
+BEDPE_HEADER = (
+    "#query_name",
+    "query_start",
+    "query_end",
+    "reference_name",
+    "reference_start",
+    "reference_end",
+    "perID_by_events",
+)
+
+
+def sketchSequence(
+    sequence_length, sequence, window_size, sparsity, delta, k, ambiguous, expectation
+) -> Tuple[PackedSketches, PackedSketches]:
+    """
+    Sketch every window of a sequence, and every window extended by `delta` into its
+    neighbors.
+
+    Returns:
+        Tuple[PackedSketches, PackedSketches]: Window sketches and neighbor sketches.
+    """
+    with PROFILER.stage("partition") as stage:
+        starts, ends = partitionOffsets(window_size, 0, sequence_length, k)
+        neighbor_starts, neighbor_ends = partitionOffsets(
+            window_size, delta, sequence_length, k
+        )
+        stage["items"] = len(starts)
+
+    with PROFILER.stage("sketch", items=len(starts)):
+        positions = modimizerPositions(sequence, sparsity, ambiguous, k)
+        no_neighbors_mods = sketchModimizers(
+            sequence, starts, ends, sparsity, ambiguous, k, expectation, positions
+        )
+        if delta > 0:
+            neighbors_mods = sketchModimizers(
+                sequence,
+                neighbor_starts,
+                neighbor_ends,
+                sparsity,
+                ambiguous,
+                k,
+                expectation,
+                positions,
+            )
+        else:
+            neighbors_mods = no_neighbors_mods
+    return no_neighbors_mods, neighbors_mods
 
 
 def createSelfMatrix(
@@ -38,20 +105,34 @@ def createSelfMatrix(
     identity,
     ambiguous,
     sketch_size,
+    max_distance=None,
 ):
-    no_neighbors = partitionOverlaps(sequence, window_size, 0, sequence_length, k)
-    if delta > 0:
-        neighbors = partitionOverlaps(sequence, window_size, delta, sequence_length, k)
-    else:
-        neighbors = no_neighbors
-
-    neighbors_mods = convertToModimizers(neighbors, sparsity, ambiguous, k, sketch_size)
-    no_neighbors_mods = convertToModimizers(
-        no_neighbors, sparsity, ambiguous, k, sketch_size
-    )
-    matrix = selfContainmentMatrix(
-        no_neighbors_mods, neighbors_mods, k, identity, ambiguous
+    """
+    Compute the self-identity matrix of a sequence. With `max_distance` (in bp),
+    only the band of windows at most that far apart is computed and the band
+    layout from selfContainmentBand is returned instead of a full matrix.
+    """
+    no_neighbors_mods, neighbors_mods = sketchSequence(
+        sequence_length,
+        sequence,
+        window_size,
+        sparsity,
+        delta,
+        k,
+        ambiguous,
+        sketch_size,
     )
+    n = len(no_neighbors_mods.offsets) - 1
+    if max_distance:
+        bandwidth = math.ceil(max_distance / window_size)
+        with PROFILER.stage("matrix", items=n * (bandwidth + 1)):
+            return selfContainmentBand(
+                no_neighbors_mods, neighbors_mods, k, identity, ambiguous, bandwidth
+            )
+    with PROFILER.stage("matrix", items=n**2):
+        matrix = selfContainmentMatrix(
+            no_neighbors_mods, neighbors_mods, k, identity, ambiguous
+        )
     return matrix
 
 
@@ -68,148 +149,272 @@ def createPairwiseMatrix(
     ambiguous,
     expectation,
 ):
-    no_neighbors_large = partitionOverlaps(larger_seq, window_size, 0, larger_length, k)
-    no_neighbors_small = partitionOverlaps(
-        smaller_seq, window_size, 0, smaller_length, k
-    )
-    if delta > 0:
-        neighbors_large = partitionOverlaps(
-            larger_seq, window_size, delta, larger_length, k
-        )
-        neighbors_small = partitionOverlaps(
-            smaller_seq, window_size, delta, smaller_length, k
-        )
-    else:
-        neighbors_large = no_neighbors_large
-        neighbors_small = no_neighbors_small
-
-    neighbors_mods_large = convertToModimizers(
-        neighbors_large, sparsity, ambiguous, k, expectation
-    )
-    no_neighbors_mods_large = convertToModimizers(
-        no_neighbors_large, sparsity, ambiguous, k, expectation
-    )
-    neighbors_mods_small = convertToModimizers(
-        neighbors_small, sparsity, ambiguous, k, expectation
-    )
-    no_neighbors_mods_small = convertToModimizers(
-        no_neighbors_small, sparsity, ambiguous, k, expectation
+    no_neighbors_mods_large, neighbors_mods_large = sketchSequence(
+        larger_length,
+        larger_seq,
+        window_size,
+        sparsity,
+        delta,
+        k,
+        ambiguous,
+        expectation,
     )
-    matrix = pairwiseContainmentMatrix(
-        no_neighbors_mods_large,
-        no_neighbors_mods_small,
-        neighbors_mods_large,
-        neighbors_mods_small,
-        identity,
+    no_neighbors_mods_small, neighbors_mods_small = sketchSequence(
+        smaller_length,
+        smaller_seq,
+        window_size,
+        sparsity,
+        delta,
         k,
-        False,
+        ambiguous,
+        expectation,
+    )
+    cells = (len(no_neighbors_mods_large.offsets) - 1) * (
+        len(no_neighbors_mods_small.offsets) - 1
     )
+    with PROFILER.stage("matrix", items=cells):
+        matrix = pairwiseContainmentMatrix(
+            no_neighbors_mods_large,
+            no_neighbors_mods_small,
+            neighbors_mods_large,
+            neighbors_mods_small,
+            identity,
+            k,
+            False,
+        )
     return matrix
 
 
-def partitionOverlaps(
-    lst: List[int], win: int, delta: float, seq_len: int, k: int
-) -> List[List[int]]:
-    kmer_list = []
+def partitionOffsets(
+    win: int, delta: float, seq_len: int, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the k-mer index range of every window, optionally extended by `delta`
+    window lengths into its neighbors.
+
+    Windows are described by offsets into a single hash buffer rather than copied
+    out of it, so overlapping windows cost nothing extra to store.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Start (inclusive) and end (exclusive) k-mer index of each window.
+    """
     kmer_to_genomic_coordinate_offset = win - k + 1
     delta_offset = win * delta
 
-    # Set the first window to contain win - k + 1 kmers.
-    starting_end_index = int(round(kmer_to_genomic_coordinate_offset + delta_offset))
-    kmer_list.append(lst[0:starting_end_index])
-    counter = win - k + 1
-
-    # Set normal windows
-    while counter <= (seq_len - win):
-        start_index = counter + 1
-        end_index = win + counter + 1
-        delta_start_index = int(round(start_index - delta_offset))
-        delta_end_index = int(round(end_index + delta_offset))
-        if delta_end_index > seq_len:
-            delta_end_index = seq_len
-        try:
-            kmer_list.append(lst[delta_start_index:delta_end_index])
-        except Exception as e:
-            print("Error in appending list of kmers...\n")
-            print(e)
-            kmer_list.append(lst[delta_start_index:seq_len])
-        counter += win
-
-    # Set the last window to get the remainder
+    # The first window contains win - k + 1 kmers, then every window starts one
+    # k-mer after a multiple of win.
+    counters = np.arange(kmer_to_genomic_coordinate_offset, seq_len - win + 1, win)
+    starts = np.round(counters + 1 - delta_offset).astype(np.int64)
+    ends = np.round(counters + win + 1 + delta_offset).astype(np.int64)
+    first_end = int(round(kmer_to_genomic_coordinate_offset + delta_offset))
+    starts = np.concatenate([[0], starts])
+    ends = np.concatenate([[first_end], ends])
+
+    # The last window gets the remainder
+    counter = kmer_to_genomic_coordinate_offset + len(counters) * win
     if counter <= seq_len - 2:
-        final_start_index = int(round(counter + 1 - delta_offset))
-        kmer_list.append(lst[final_start_index:seq_len])
+        starts = np.append(starts, int(round(counter + 1 - delta_offset)))
+        ends = np.append(ends, seq_len)
 
-    # Test that last value was added on correctly
-    try:
-        assert kmer_list[-1][-1] == lst[-1]
-    except (AssertionError, IndexError) as e:
-        print(f"Error: Last k-mer does not match original sequence: {e}\n")
-    return kmer_list
+    np.clip(starts, 0, seq_len, out=starts)
+    np.clip(ends, 0, seq_len, out=ends)
+    return starts, ends
 
 
-def populateModimizers(partition, sparsity, ambiguous, expectation, k):
-    mod_set = set()
-    for kmer in partition:
-        if kmer % sparsity == 0:
-            mod_set.add(kmer)
+def sketchModimizers(
+    kmers: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    sparsity: int,
+    ambiguous: bool,
+    k: int,
+    expectation: int,
+    positions: np.ndarray = None,
+) -> PackedSketches:
+    """
+    Modimizers of the windows kmers[starts[i]:ends[i]] (see partitionOffsets):
+    their distinct hashes divisible by `sparsity`, written straight into a
+    PackedSketches buffer.
+
+    Windows are read off the positional index from modimizerPositions, so a window
+    only touches its own modimizers rather than every k-mer. Pass the same
+    `positions` when sketching both the windows and their delta-extended neighbors:
+    the sequence is then scanned once, and a neighbor sketch is simply the
+    modimizers of its window plus those in the bordering fractions of the adjacent
+    windows.
+
+    Windows that yield fewer than half the expected modimizers (eg. low complexity
+    sequence) fall back to the largest power-of-two sparsity below `sparsity` that
+    yields enough of them. Instead of rescanning the window for every halving, each
+    hash is tagged once with the largest sparsity it is divisible by, and the
+    fallback sparsity is read off the counts per tag. `sparsity` must be a power of two.
+    """
+    ambiguous_hashes = np.array(sorted(ambiguousHashes(k)), dtype=np.int64)
+    minimum_size = round(expectation / 2)
+    kmers = np.asarray(kmers)
+    if positions is None:
+        positions = modimizerPositions(kmers, sparsity, ambiguous, k)
+    modimizers = kmers[positions]
+    lower = np.searchsorted(positions, starts).tolist()
+    upper = np.searchsorted(positions, ends).tolist()
+    sketches = []
+    for i in range(len(starts)):
+        sketch = np.unique(modimizers[lower[i] : upper[i]])
+        if len(sketch) < minimum_size and sparsity > 1:
+            partition = kmers[starts[i] : ends[i]]
+            candidates = np.unique(partition).astype(np.int64)
+            if not ambiguous:
+                candidates = candidates[
+                    ~np.isin(candidates, ambiguous_hashes, assume_unique=True)
+                ]
+            levels = sparsityLevels(candidates, sparsity)
+            # Number of candidates divisible by each power of two, largest first
+            at_least = np.cumsum(np.bincount(levels)[::-1])[::-1]
+            enough = np.flatnonzero(at_least >= minimum_size)
+            level = enough[-1] if len(enough) else 0
+            sketch = candidates[levels >= level]
+        sketches.append(sketch)
+    offsets = np.zeros(len(sketches) + 1, dtype=np.int64)
+    np.cumsum([len(sketch) for sketch in sketches], out=offsets[1:])
+    values = np.empty(offsets[-1], dtype=np.int32)
+    if sketches:
+        np.concatenate(sketches, out=values, casting="same_kind")
+    return PackedSketches(values, offsets)
+
+
+def modimizerPositions(
+    kmers: np.ndarray, sparsity: int, ambiguous: bool, k: int
+) -> np.ndarray:
+    """
+    Positional index of a sequence's modimizers: the sorted k-mer indices whose hash
+    is divisible by `sparsity`, excluding ambiguous homopolymers unless `ambiguous`.
+    """
+    kmers = np.asarray(kmers)
+    positions = np.flatnonzero(kmers % sparsity == 0)
     if not ambiguous:
-        mod_set = removeAmbiguousBases(mod_set, k)
-    if (len(mod_set) < round(expectation / 2)) and (sparsity > 1):
-        populateModimizers(partition, sparsity / 2, ambiguous, expectation, k)
-    return mod_set
+        ambiguous_hashes = np.array(sorted(ambiguousHashes(k)), dtype=np.int64)
+        positions = positions[~np.isin(kmers[positions], ambiguous_hashes)]
+    return positions
 
 
-def convertToModimizers(
-    kmer_list: List[List[int]], sparsity: int, ambiguous: bool, k: int, expectation: int
-) -> List[Set[int]]:
-    mod_total = []
-    for partition in kmer_list:
-        mod_set = populateModimizers(partition, sparsity, ambiguous, expectation, k)
-        mod_total.append(mod_set)
-    return mod_total
+def sparsityLevels(hashes: np.ndarray, sparsity: int) -> np.ndarray:
+    """
+    For each hash, the exponent of the largest power of two (capped at `sparsity`)
+    that divides it, ie. its number of trailing zero bits.
+    """
+    lowest_bit = np.bitwise_and(hashes, -hashes)
+    lowest_bit[lowest_bit == 0] = sparsity
+    lowest_bit = np.minimum(lowest_bit, sparsity)
+    return np.log2(lowest_bit).astype(np.int64)
 
 
 def convertMatrixToBed(
-    matrix, window_size, id_threshold, x_name, y_name, self_identity, x_offset, y_offset
+    matrix,
+    window_size,
+    id_threshold,
+    x_name,
+    y_name,
+    self_identity,
+    x_offset,
+    y_offset,
+    banded=False,
 ):
-    bed = [
-        (
-            "#query_name",
-            "query_start",
-            "query_end",
-            "reference_name",
-            "reference_start",
-            "reference_end",
-            "perID_by_events",
-        )
-    ]
-
-    rows, cols = matrix.shape
-    for x in range(rows):
-        for y in range(cols):
-            value = matrix[x, y]
-            if (not self_identity) or (self_identity and x <= y):
-                if value >= id_threshold / 100:
-                    start_x = x * window_size + x_offset
-                    end_x = start_x + window_size - 1
-                    start_y = y * window_size + y_offset
-                    end_y = start_y + window_size - 1
-
-                    bed.append(
-                        (
-                            x_name,
-                            int(start_x),
-                            int(end_x),
-                            y_name,
-                            int(start_y),
-                            int(end_y),
-                            float(value),
-                        )
-                    )
+    bed = [BEDPE_HEADER]
+    x, y, values = matrixCellsAboveThreshold(
+        matrix,
+        id_threshold,
+        self_identity,
+        banded,
+        diagonalCells(x_offset, y_offset, window_size),
+    )
+    bed.extend(bedpeRows(x, y, values, window_size, x_name, y_name, x_offset, y_offset))
     return bed
 
 
+def convertMatrixToBedpeFrame(
+    matrix,
+    window_size,
+    id_threshold,
+    x_name,
+    y_name,
+    self_identity,
+    x_offset,
+    y_offset,
+):
+    """
+    Same rows as convertMatrixToBed, as a DataFrame with BEDPE_HEADER columns, so
+    large matrices can be written in one call to `to_csv(path, sep="\t",
+    index=False)` rather than row by row.
+    """
+    x, y, values = matrixCellsAboveThreshold(
+        matrix,
+        id_threshold,
+        self_identity,
+        diagonal=diagonalCells(x_offset, y_offset, window_size),
+    )
+    start_x = x * window_size + x_offset
+    start_y = y * window_size + y_offset
+    columns = (
+        x_name,
+        start_x,
+        start_x + window_size - 1,
+        y_name,
+        start_y,
+        start_y + window_size - 1,
+        values,
+    )
+    return pd.DataFrame(dict(zip(BEDPE_HEADER, columns)), columns=BEDPE_HEADER)
+
+
+def diagonalCells(x_offset, y_offset, window_size):
+    """
+    Where the main diagonal of a self-identity matrix lies in a part of it starting
+    at (x_offset, y_offset): the number of cells it is shifted right of the part's
+    own diagonal.
+    """
+    return (x_offset - y_offset) // window_size
+
+
+def bedpeRows(x, y, values, window_size, x_name, y_name, x_offset, y_offset):
+    """
+    Bedpe rows for the matrix cells (x[i], y[i]) with the given identity values.
+    """
+    start_x = x * window_size + x_offset
+    end_x = start_x + window_size - 1
+    start_y = y * window_size + y_offset
+    end_y = start_y + window_size - 1
+    return zip(
+        repeat(x_name),
+        start_x.tolist(),
+        end_x.tolist(),
+        repeat(y_name),
+        start_y.tolist(),
+        end_y.tolist(),
+        values.tolist(),
+    )
+
+
+def matrixCellsAboveThreshold(
+    matrix, id_threshold, self_identity, banded=False, diagonal=0
+):
+    """
+    Row index, column index and value of the cells to export, in row-major order.
+    Works for any rows x cols matrix; self-identity matrices only export the upper
+    triangle, on and right of `diagonal` (see diagonalCells) when the matrix is
+    only part of one. With `banded`, the matrix is a band from selfContainmentBand.
+    """
+    keep = matrix >= id_threshold / 100
+    if banded:
+        x, d = bandCells(matrix)
+        keep = keep[x, d]
+        x, d = x[keep], d[keep]
+        return x, x + d, matrix[x, d]
+    if self_identity:
+        keep = np.triu(keep, diagonal)
+    x, y = np.nonzero(keep)
+    return x, y, matrix[x, y]
+
+
 def convertMatrixToCool(
     matrix,
     window_size,
@@ -221,12 +426,13 @@ def convertMatrixToCool(
     y_offset,
     chromsizes,
     output_cool,
+    banded=False,
 ):
     """
     Convert a matrix into a .cool file.
 
     Args:
-        matrix (ndarray): 2D numpy array.
+        matrix (ndarray): 2D numpy array, rows x cols.
         window_size (int): Bin/window size in bp.
         id_threshold (float): Percent identity threshold (0-100).
         x_name (str): Chromosome name for rows.
@@ -236,106 +442,224 @@ def convertMatrixToCool(
         y_offset (int): Genomic offset for y axis (start position).
         chromsizes (dict): Dict of chromosome lengths, e.g. {"chr1": 248956422}.
         output_cool (str): Path to save cooler file.
+        banded (bool): Whether matrix is a band from selfContainmentBand.
     """
     rows, cols = matrix.shape
+    if banded:
+        cols = rows
 
     # ---- build bin table ----
-    bins = []
-    for i in range(rows):
-        bins.append(
-            (x_name, i * window_size + x_offset, (i + 1) * window_size + x_offset)
-        )
-    for j in range(cols):
-        bins.append(
-            (y_name, j * window_size + y_offset, (j + 1) * window_size + y_offset)
-        )
-
-    bins = pd.DataFrame(bins, columns=["chrom", "start", "end"])
+    bins = coolerBins(rows, cols, window_size, x_name, y_name, x_offset, y_offset)
 
     # ---- build pixel table ----
-    pixels = []
-    for x in range(rows):
-        for y in range(cols):
-            value = matrix[x, y]
-            if (not self_identity) or (self_identity and x <= y):
-                if value >= id_threshold / 100:
-                    bin1_id = x
-                    bin2_id = rows + y  # offset y bins after x bins
-                    pixels.append((bin1_id, bin2_id, float(value)))
-
-    pixels = pd.DataFrame(pixels, columns=["bin1_id", "bin2_id", "count"])
+    x, y, values = matrixCellsAboveThreshold(
+        matrix,
+        id_threshold,
+        self_identity,
+        banded,
+        diagonalCells(x_offset, y_offset, window_size),
+    )
+    pixels = pd.DataFrame(
+        {
+            "bin1_id": x,
+            "bin2_id": rows + y,  # offset y bins after x bins
+            "count": values.astype(float),
+        }
+    )
 
     # ---- write cooler ----
     cooler.create_cooler(output_cool, bins=bins, pixels=pixels, ordered=True)
-    print(bins)
-    print(pixels)
 
     return output_cool
 
 
-def binomial_distance(containment_value: float, kmer_value: int) -> float:
+def coolerBins(rows, cols, window_size, x_name, y_name, x_offset, y_offset):
+    """
+    Bin table with the row (x) bins first, followed by the column (y) bins.
     """
-    Calculate the binomial distance based on containment and kmer values.
+    starts = np.concatenate(
+        [
+            np.arange(rows, dtype=np.int64) * window_size + x_offset,
+            np.arange(cols, dtype=np.int64) * window_size + y_offset,
+        ]
+    )
+    return pd.DataFrame(
+        {
+            "chrom": [x_name] * rows + [y_name] * cols,
+            "start": starts,
+            "end": starts + window_size,
+        }
+    )
 
-    Args:
-        containment_value (float): The containment value.
-        kmer_value (int): The k-mer value.
 
-    Returns:
-        float: The binomial distance.
-    """
-    return math.pow(containment_value, 1.0 / kmer_value)
+def packModimizers(mod_sets: List[Set[int]]) -> PackedSketches:
+    lengths = np.fromiter((len(mod_set) for mod_set in mod_sets), dtype=np.int64)
+    offsets = np.zeros(len(mod_sets) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.empty(offsets[-1], dtype=np.int32)
+    for i, mod_set in enumerate(mod_sets):
+        values[offsets[i] : offsets[i + 1]] = sorted(mod_set)
+    return PackedSketches(values, offsets)
 
 
-def containment_neighbors(
-    set1: Set[int],
-    set2: Set[int],
-    set3: Set[int],
-    set4: Set[int],
-    identity: int,
-    k: int,
-) -> float:
+def asPackedSketches(sketches: Union[PackedSketches, List[Set[int]]]) -> PackedSketches:
+    if isinstance(sketches, PackedSketches):
+        return sketches
+    return packModimizers(sketches)
+
+
+def sketchLengths(sketches: PackedSketches) -> np.ndarray:
+    return np.diff(sketches.offsets)
+
+
+def encodeSketches(*sketches: PackedSketches) -> Tuple[List[np.ndarray], int]:
     """
-    Calculate the containment neighbors based on four sets and an identity threshold.
+    Replace modimizer hashes with dense ids shared across all given sketches.
 
-    Args:
-        set1 (Set[int]): The first set.
-        set2 (Set[int]): The second set.
-        set3 (Set[int]): The third set.
-        set4 (Set[int]): The fourth set.
-        identity (int): The identity threshold.
-        k (int): Kmer value.
+    Dense ids let a single window be marked in a boolean table, after which the
+    intersection with every other window is a table lookup per modimizer.
 
     Returns:
-        float: The containment neighbors value.
+        Tuple[List[np.ndarray], int]: The id buffer for each input, and the number of distinct ids.
+    """
+    if not sketches:
+        return [], 0
+    vocabulary, inverse = np.unique(
+        np.concatenate([packed.values for packed in sketches]), return_inverse=True
+    )
+    inverse = inverse.reshape(-1)
+    encoded = []
+    start = 0
+    for packed in sketches:
+        end = start + len(packed.values)
+        encoded.append(inverse[start:end])
+        start = end
+    return encoded, len(vocabulary)
+
+
+def countIntersections(
+    marked: np.ndarray, ids: np.ndarray, offsets: np.ndarray, start: int, end: int
+) -> np.ndarray:
+    """
+    Count, for windows start..end-1, how many of their ids are set in `marked`.
     """
-    len_a = len(set1)
-    len_b = len(set2)
+    hits = marked[ids[offsets[start] : offsets[end]]]
+    cumulative = np.zeros(len(hits) + 1, dtype=np.int64)
+    np.cumsum(hits, out=cumulative[1:])
+    bounds = offsets[start : end + 1] - offsets[start]
+    return cumulative[bounds[1:]] - cumulative[bounds[:-1]]
 
-    intersection_a_b_prime = len(set1 & set4)
-    if len_a != 0:
-        containment_a_b_prime = intersection_a_b_prime / len_a
-    else:
-        # If len_a is zero, handle it by setting containment_a_b_prime to a default value
-        containment_a_b_prime = 0
 
-    if binomial_distance(containment_a_b_prime, k) < identity / 100:
-        return 0.0
+def binomialDistances(containment_values: np.ndarray, k: int) -> np.ndarray:
+    """
+    Binomial distance containment ** (1 / k) of every containment value.
+    Containment values are ratios of small integers and repeat heavily, so
+    math.pow is only evaluated once per distinct value. Unlike np.power, this
+    gives bit-identical results to the scalar math.pow formula.
+    """
+    unique, inverse = np.unique(containment_values, return_inverse=True)
+    powered = np.array([math.pow(value, 1.0 / k) for value in unique.tolist()])
+    return powered[inverse.reshape(-1)].reshape(containment_values.shape)
 
-    else:
-        intersection_a_prime_b = len(set2 & set3)
-        if len_b != 0:
-            containment_a_prime_b = intersection_a_prime_b / len_b
-        else:
-            # If len_a is zero, handle it by setting containment_a_b_prime to a default value
-            containment_a_prime_b = 0
 
-        return max(containment_a_b_prime, containment_a_prime_b)
+def containmentScores(
+    intersection_a_b_prime: np.ndarray,
+    len_a: np.ndarray,
+    intersection_a_prime_b: np.ndarray,
+    len_b: np.ndarray,
+    identity: int,
+    k: int,
+) -> np.ndarray:
+    """
+    Identity score of each pair of windows a and b: the binomial distance of the
+    larger of the containments of a in b's neighborhood (b') and of b in a's (a'),
+    times 100. Pairs whose a-in-b' distance is below `identity` score 0.
+    """
+    len_a, len_b = np.broadcast_arrays(len_a, len_b)
+    containment_a_b_prime = np.zeros(intersection_a_b_prime.shape)
+    np.divide(
+        intersection_a_b_prime, len_a, out=containment_a_b_prime, where=len_a != 0
+    )
+    containment_a_prime_b = np.zeros(intersection_a_prime_b.shape)
+    np.divide(
+        intersection_a_prime_b, len_b, out=containment_a_prime_b, where=len_b != 0
+    )
+    distances = binomialDistances(
+        np.concatenate([containment_a_b_prime, containment_a_prime_b]), k
+    )
+    distance_a_b_prime = distances[: len(containment_a_b_prime)]
+    distance_a_prime_b = distances[len(containment_a_b_prime) :]
+    # The binomial distance is monotonic, so the distance of the larger containment
+    # is the larger of the two distances.
+    scores = np.maximum(distance_a_b_prime, distance_a_prime_b) * 100.0
+    scores[distance_a_b_prime < identity / 100] = 0.0
+    return scores
+
+
+def selfContainmentRows(
+    mod_set: Union[PackedSketches, List[set]],
+    mod_set_neighbors: Union[PackedSketches, List[set]],
+    k: int,
+    identity: int,
+    ambiguous: bool,
+    bandwidth: int = None,
+):
+    """
+    Compute a self-containment matrix one row at a time.
+
+    Only the upper triangle is computed, since the matrix is symmetric. With a
+    `bandwidth`, row w stops at window w + bandwidth.
+
+    Yields:
+        Tuple[int, float, np.ndarray]: Row w, the value on the diagonal, and the values for windows w + 1, w + 2, ...
+    """
+    mod_set = asPackedSketches(mod_set)
+    mod_set_neighbors = asPackedSketches(mod_set_neighbors)
+    (ids, neighbor_ids), vocabulary_size = encodeSketches(mod_set, mod_set_neighbors)
+    lengths = sketchLengths(mod_set)
+    marked = np.zeros(vocabulary_size, dtype=bool)
+
+    n = len(lengths)
+    for w in range(n):
+        diagonal = 100.0
+        if lengths[w] == 0 and not ambiguous:
+            diagonal = 0
+        end = n if bandwidth is None else min(n, w + bandwidth + 1)
+        if w + 1 == end:
+            yield w, diagonal, np.empty(0)
+            continue
+
+        # A = window w, B = every later window r
+        window = ids[mod_set.offsets[w] : mod_set.offsets[w + 1]]
+        marked[window] = True
+        intersection_a_b_prime = countIntersections(
+            marked, neighbor_ids, mod_set_neighbors.offsets, w + 1, end
+        )
+        marked[window] = False
+
+        window = neighbor_ids[
+            mod_set_neighbors.offsets[w] : mod_set_neighbors.offsets[w + 1]
+        ]
+        marked[window] = True
+        intersection_a_prime_b = countIntersections(
+            marked, ids, mod_set.offsets, w + 1, end
+        )
+        marked[window] = False
+
+        c_hat = containmentScores(
+            intersection_a_b_prime,
+            lengths[w],
+            intersection_a_prime_b,
+            lengths[w + 1 : end],
+            identity,
+            k,
+        )
+        yield w, diagonal, c_hat
 
 
 def selfContainmentMatrix(
-    mod_set: List[set],
-    mod_set_neighbors: List[set],
+    mod_set: Union[PackedSketches, List[set]],
+    mod_set_neighbors: Union[PackedSketches, List[set]],
     k: int,
     identity: int,
     ambiguous: bool,
@@ -344,56 +668,82 @@ def selfContainmentMatrix(
     Create a self-containment matrix based on containment similarity calculations.
 
     Args:
-        mod_set (List[set]): A list of sets representing elements.
-        mod_set_neighbors (List[set]): A list of sets representing neighbors for each element.
+        mod_set (PackedSketches | List[set]): Sketch of each window.
+        mod_set_neighbors (PackedSketches | List[set]): Sketch of each window extended into its neighbors.
         k (int): A parameter for containment similarity calculation.
 
     Returns:
         np.ndarray: A NumPy array representing the self-containment matrix.
     """
-    n = len(mod_set)
-    progress_thresholds = round(n / 77)
-
-    if progress_thresholds == 0:
-        progress_thresholds = 1
-
-    printProgressBar(0, n, prefix="Progress:", suffix="Complete", length=40)
+    n = len(asPackedSketches(mod_set).offsets) - 1
+    progress = ProgressReporter(n).start()
     containment_matrix = np.empty((n, n))
 
-    for w in range(n):
-        if w % progress_thresholds == 0:
-            printProgressBar(w, n, prefix="Progress:", suffix="Complete", length=40)
-        containment_matrix[w, w] = 100.0
-        if len(mod_set[w]) == 0 and not ambiguous:
-            containment_matrix[w, w] = 0
-
-        for r in range(w + 1, n):
-            c_hat = binomial_distance(
-                containment_neighbors(
-                    mod_set[w],
-                    mod_set[r],
-                    mod_set_neighbors[w],
-                    mod_set_neighbors[r],
-                    identity,
-                    k,
-                ),
-                k,
-            )
-            containment_matrix[r, w] = c_hat * 100.0
-            containment_matrix[w, r] = c_hat * 100.0
+    for w, diagonal, c_hat in selfContainmentRows(
+        mod_set, mod_set_neighbors, k, identity, ambiguous
+    ):
+        progress.advance()
+        containment_matrix[w, w] = diagonal
+        containment_matrix[w + 1 :, w] = c_hat
+        containment_matrix[w, w + 1 :] = c_hat
 
-    printProgressBar(
-        n, n, prefix="Progress:", suffix="Completed", length=40
-    )  # show completed progress bar
+    progress.stop()  # show completed progress bar
     print("\n")
     return containment_matrix
 
 
+def selfContainmentBand(
+    mod_set: Union[PackedSketches, List[set]],
+    mod_set_neighbors: Union[PackedSketches, List[set]],
+    k: int,
+    identity: int,
+    ambiguous: bool,
+    bandwidth: int,
+) -> np.ndarray:
+    """
+    Create the near-diagonal band of a self-containment matrix, skipping every pair
+    of windows more than `bandwidth` windows apart. Cost and memory are linear in
+    the number of windows.
+
+    Args:
+        mod_set (PackedSketches | List[set]): Sketch of each window.
+        mod_set_neighbors (PackedSketches | List[set]): Sketch of each window extended into its neighbors.
+        k (int): A parameter for containment similarity calculation.
+        bandwidth (int): Largest distance, in windows, between two compared windows.
+
+    Returns:
+        np.ndarray: An n x (bandwidth + 1) band, where band[i, d] is the identity between windows i and i + d. Cells past the last window are 0.
+    """
+    n = len(asPackedSketches(mod_set).offsets) - 1
+    progress = ProgressReporter(n).start()
+    band = np.zeros((n, bandwidth + 1))
+
+    for w, diagonal, c_hat in selfContainmentRows(
+        mod_set, mod_set_neighbors, k, identity, ambiguous, bandwidth
+    ):
+        progress.advance()
+        band[w, 0] = diagonal
+        band[w, 1 : len(c_hat) + 1] = c_hat
+
+    progress.stop()  # show completed progress bar
+    print("\n")
+    return band
+
+
+def bandCells(band: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Row and band column of every cell that lies inside the matrix.
+    """
+    n = band.shape[0]
+    inside = np.arange(n)[:, None] + np.arange(band.shape[1])[None, :] < n
+    return np.nonzero(inside)
+
+
 def pairwiseContainmentMatrix(
-    mod_set_x: List[int],
-    mod_set_y: List[int],
-    mod_set_x_neighbors: List[List[int]],
-    mod_set_y_neighbors: List[List[int]],
+    mod_set_x: Union[PackedSketches, List[set]],
+    mod_set_y: Union[PackedSketches, List[set]],
+    mod_set_x_neighbors: Union[PackedSketches, List[set]],
+    mod_set_y_neighbors: Union[PackedSketches, List[set]],
     identity: int,
     k: int,
     supress_progress: bool,
@@ -402,54 +752,67 @@ def pairwiseContainmentMatrix(
     Calculate an updated identity matrix using specified parameters.
 
     Args:
-        mod_set_x (List[int]): List of values for the x-axis.
-        mod_set_y (List[int]): List of values for the y-axis.
-        mod_set_x_neighbors (List[List[int]]): List of lists representing neighbors of mod_set_x values.
-        mod_set_y_neighbors (List[List[int]]): List of lists representing neighbors of mod_set_y values.
+        mod_set_x (PackedSketches | List[set]): Window sketches for the x-axis.
+        mod_set_y (PackedSketches | List[set]): Window sketches for the y-axis.
+        mod_set_x_neighbors (PackedSketches | List[set]): Neighbor-extended sketches of mod_set_x windows.
+        mod_set_y_neighbors (PackedSketches | List[set]): Neighbor-extended sketches of mod_set_y windows.
         identity (int): Resolution parameter.
-        k (int): Value for the k parameter in the binomial_distance function.
+        k (int): Value for the k parameter in the binomial distance.
         supress_progress (bool): if true supresses the progress bar
 
     Returns:
-        np.ndarray: An identity matrix containing containment values.
+        np.ndarray: A len(mod_set_y) x len(mod_set_x) matrix of containment values.
     """
-    n = max(len(mod_set_y), len(mod_set_x))
-    progress_thresholds = round(n / 77)
-    if progress_thresholds == 0:
-        progress_thresholds = 1
+    mod_set_x = asPackedSketches(mod_set_x)
+    mod_set_y = asPackedSketches(mod_set_y)
+    mod_set_x_neighbors = asPackedSketches(mod_set_x_neighbors)
+    mod_set_y_neighbors = asPackedSketches(mod_set_y_neighbors)
+    (x_ids, x_neighbor_ids, y_ids, y_neighbor_ids), vocabulary_size = encodeSketches(
+        mod_set_x, mod_set_x_neighbors, mod_set_y, mod_set_y_neighbors
+    )
+    x_lengths = sketchLengths(mod_set_x)
+    y_lengths = sketchLengths(mod_set_y)
+    marked = np.zeros(vocabulary_size, dtype=bool)
 
+    cols = len(x_lengths)
+    rows = len(y_lengths)
+    progress = ProgressReporter(rows)
     if not supress_progress:
-        printProgressBar(0, n, prefix="Progress:", suffix="Complete", length=40)
-    containment_matrix = np.zeros((n, n), dtype=float)
-
-    for w in range(len(mod_set_y)):
-        if not supress_progress:
-            if w % progress_thresholds == 0:
-                printProgressBar(w, n, prefix="Progress:", suffix="Complete", length=40)
-        for q in range(n):
-            try:
-                containment_matrix[w, q] = (
-                    binomial_distance(
-                        containment_neighbors(
-                            mod_set_x[q],
-                            mod_set_y[w],
-                            mod_set_x_neighbors[q],
-                            mod_set_y_neighbors[w],
-                            identity,
-                            k,
-                        ),
-                        k,
-                    )
-                    * 100.0
-                )
-            # Bandaid solution for too sequences that are too small.
-            except IndexError as e:
-                pass
+        progress.start()
+    containment_matrix = np.zeros((rows, cols), dtype=float)
+
+    for w in range(rows):
+        progress.advance()
+        if cols == 0:
+            continue
+        # A = every x window q, B = y window w
+        window = y_neighbor_ids[
+            mod_set_y_neighbors.offsets[w] : mod_set_y_neighbors.offsets[w + 1]
+        ]
+        marked[window] = True
+        intersection_a_b_prime = countIntersections(
+            marked, x_ids, mod_set_x.offsets, 0, cols
+        )
+        marked[window] = False
+
+        window = y_ids[mod_set_y.offsets[w] : mod_set_y.offsets[w + 1]]
+        marked[window] = True
+        intersection_a_prime_b = countIntersections(
+            marked, x_neighbor_ids, mod_set_x_neighbors.offsets, 0, cols
+        )
+        marked[window] = False
+
+        containment_matrix[w] = containmentScores(
+            intersection_a_b_prime,
+            x_lengths,
+            intersection_a_prime_b,
+            y_lengths[w],
+            identity,
+            k,
+        )
 
     if not supress_progress:
-        printProgressBar(
-            n, n, prefix="Progress:", suffix="Completed", length=40
-        )  # show completed progress bar
+        progress.stop()  # show completed progress bar
         print("\n")
     return containment_matrix
 
@@ -544,39 +907,9 @@ def nextPowerOfTwo(n):
     return n + 1
 
 
-def generateDictionaryFromList(lst: List[int]) -> Dict[Tuple[int, int], int]:
-    result = {}
-    for i in range(len(lst) - 1):
-        result[(lst[i], lst[i + 1])] = i
-    return result
-
-
-def findValueInRange(integer: int, range_dict: dict) -> int:
-    if integer > max(key[0] for key in range_dict.keys()):
-        return 0
-    highest_value = max(range_dict.values()) + 1
-    for key, value in range_dict.items():
-        if key[0] >= integer >= key[1]:
-            return value
-    return highest_value
-
-
 def setZoomLevels(axis_length, sparsity_layers):
     zoom_levels = []
     zoom_levels.append(axis_length)
     for i in range(1, len(sparsity_layers)):
         zoom_levels.append(round(axis_length / pow(2, i)))
     return zoom_levels
-
-
-def makeDifferencesEqual(x, x_prime, y, y_prime):
-    difference_x = abs(x_prime - x)
-    difference_y = abs(y_prime - y)
-
-    if difference_x != difference_y:
-        if difference_x < difference_y:
-            x_prime += difference_y - difference_x
-        else:
-            y_prime += difference_x - difference_y
-
-    return x_prime, y_prime
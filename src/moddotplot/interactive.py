@@ -2,68 +2,83 @@ import plotly.express as px
 from moddotplot.estimate_identity import (
     getInteractiveColor,
     getMatchingColors,
-    makeDifferencesEqual,
-    generateDictionaryFromList,
-    findValueInRange,
-    convertMatrixToBed,
+    convertMatrixToBedpeFrame,
+    convertMatrixToCool,
 )
 
-import numpy as np
 import dash
-from dash import Input, Output, html, dcc, State
-import math
+from dash import Input, Output, Patch, html, dcc, State, ctx
 import plotly.graph_objs as go
 import logging
 import os
+from moddotplot.pyramids import PyramidStore
+from moddotplot.viewport import (
+    IDENTITY_LEVELS,
+    HOVER_INTERVALS_JS,
+    RESTYLE_VIEWPORT_JS,
+    VIEWPORT_CACHE_MB,
+    ViewportCache,
+    ViewportResolver,
+    colorLut,
+    pyramidAxes,
+    encodePng,
+    hoverGrid,
+    identityPalette,
+    pngDataUri,
+    quantizeIdentity,
+    setPngPalette,
+    typedArray,
+)
 
 # Prevent HTTP protocol requests from showing up in terminal
 log = logging.getLogger("werkzeug")
 log.setLevel(logging.ERROR)
 
 
-def find_closest_elements(value, sorted_list):
-    # Initialize variables to store the indices of the closest elements
-    closest_index1 = None
-    closest_index2 = None
-
-    # Initialize a variable to store the minimum difference
-    min_difference = float("inf")
-
-    # Iterate through the sorted list
-    for i in range(len(sorted_list)):
-        # Calculate the absolute difference between the current element and the target value
-        current_difference = abs(sorted_list[i] - value)
-
-        # Update indices and minimum difference if a closer element is found
-        if current_difference < min_difference:
-            min_difference = current_difference
-            closest_index1 = i
-
-            # Check if there is a previous element to avoid index out of range
-            if i > 0:
-                closest_index2 = i - 1
-    if closest_index1 == None:
-        return closest_index2, closest_index2
-    elif closest_index2 == None:
-        return closest_index1, closest_index1
-    if closest_index1 > closest_index2:
-        return closest_index2, closest_index1
-    else:
-        return closest_index1, closest_index2
-
-
-def run_dash(matrices, metadata, axes, sparsity, identity, port_number, output_dir):
+def run_dash(
+    matrices,
+    metadata,
+    axes,
+    sparsity,
+    identity,
+    port_number,
+    output_dir,
+    cache_size=VIEWPORT_CACHE_MB,
+):
     # Run Dash app
-    app = dash.Dash(__name__, prevent_initial_callbacks="initial_duplicate")
-    app.title = "ModDotPlot"
+    app = create_app(
+        matrices, metadata, axes, sparsity, identity, output_dir, cache_size
+    )
     print(
         f"{app.title} interactive mode is successfully running on http://127.0.0.1:{port_number}/ \n"
     )
+    # TODO: Change debug to False for production
+    app.run(debug=False, use_reloader=False, port=port_number)
+
+
+def create_app(
+    matrices,
+    metadata,
+    axes,
+    sparsity,
+    identity,
+    output_dir,
+    cache_size=VIEWPORT_CACHE_MB,
+):
+    """
+    The interactive mode Dash app, without starting a server. Anything specific
+    to one user (clicked coordinates, the view on screen) is kept in their
+    browser, so `app.server` can be served by several processes at once; see
+    moddotplot.sessionServer.
+    """
+    app = dash.Dash(__name__, prevent_initial_callbacks="initial_duplicate")
+    app.title = "ModDotPlot"
+    # Pyramids can also be built as they are selected, see PyramidStore
+    if not isinstance(matrices, PyramidStore):
+        matrices = PyramidStore.fromPyramids(matrices)
     # Initialize first sequence
     image_pyramid = matrices[0]
     current_metadata = metadata[0]
-    x_name = metadata[0]["x_name"]
-    y_name = metadata[0]["y_name"]
 
     # Initialize color palette
     palette = "Spectral_11"
@@ -75,121 +90,187 @@ def run_dash(matrices, metadata, axes, sparsity, identity, port_number, output_d
     for i in range(len(metadata)):
         titles.append(metadata[i]["title"])
 
-    # Get zooming thresholds, adjust sparsity respectively.
-    def halving_sequence(size, start):
-        sequence = [start]
-        for _ in range(1, size):
-            start /= 2
-            sequence.append(start)
-        return sequence
+    # Zoom level and cell lookups, made when a matrix is first shown and again
+    # whenever the background worker has finished another of its layers
+    resolvers = {}
 
-    # print(current_metadata)
-    mod_thresholds_list = halving_sequence(
-        len(current_metadata["sparsities"]), current_metadata["x_size"]
-    )
-    # print(mod_thresholds_list)
+    def resolver_for(i):
+        pyramid = matrices[i]
+        # Finer layers are appended while we read, so only use those ready now
+        ready = len(pyramid)
+        cached = resolvers.get(i)
+        if cached is None or cached[0] is not pyramid or len(cached[1].layers) != ready:
+            layers = pyramid[:ready]
+            matrix_axes = (
+                axes[i][: 2 * ready] if axes else pyramidAxes(layers, metadata[i])
+            )
+            resolver = ViewportResolver(layers, matrix_axes, metadata[i]["x_size"])
+            resolvers[i] = (pyramid, resolver)
+        # Forget pyramids the store dropped, so their layers can be freed
+        for j in list(resolvers):
+            if not matrices.loaded(j):
+                resolvers.pop(j, None)
+        return resolvers[i][1]
 
-    # print(current_metadata["min_window_size"]* current_metadata["resolution"])
-    # print(current_metadata["max_window_size"])
-    numo = round(
-        math.log2(
-            current_metadata["max_window_size"] / current_metadata["min_window_size"]
-        )
-        + 1
-    )
-    # print(numo)
-    important = generateDictionaryFromList(mod_thresholds_list)
-    # print(f"this is imprtant: {important}")
+    def likely_next(i):
+        """
+        Matrices likely to be selected after matrix i: the next one in the
+        dropdown, then the others sharing a sequence with it.
+        """
+        names = {metadata[i]["x_name"], metadata[i]["y_name"]}
+        candidates = [(i + 1) % len(metadata)] + [
+            j
+            for j in range(len(metadata))
+            if names & {metadata[j]["x_name"], metadata[j]["y_name"]}
+        ]
+        return [j for j in dict.fromkeys(candidates) if j != i]
 
-    main_level = image_pyramid[0]
-    main_x_axis = axes[0][0]
-    main_y_axis = axes[0][1]
-    main_x_axis_np = np.array(main_x_axis)
+    # Viewports drawn before, whatever palette they were shown with
+    viewport_cache = ViewportCache(cache_size * 2**20)
 
-    # TODO: modify value here
-    main_x_axis_np += 3000
+    def plot_title(info):
+        # TODO: Fine tuning on the names
+        if info["self"]:
+            title = f"Self-Identity Plot: {info['x_name']}"
+            title_size = 20 if len(info["x_name"]) > 22 else 28
+        else:
+            title = f"Comparative Plot: {info['x_name']} vs. {info['y_name']}"
+            title_size = 18 if len(info["x_name"]) + len(info["y_name"]) > 22 else 28
+        return title, title_size
 
-    # Modify text so that hover shows interval format
-    # TODO: Add intervals in a way that's speedy
-    '''X, Y = np.meshgrid(main_x_axis, main_y_axis)
-    X = np.delete(X, -1, axis=1)
-    X, Y = np.meshgrid(main_x_axis, main_y_axis)
-    X = np.delete(X, -1, axis=1)
-    X_str = np.array([[f"{str(val)}-{str(val + current_metadata['max_window_size'])}" for val in row] for row in X])
-    Y = np.delete(Y, -1, axis=1)
-    Y_str = np.array([[f"{str(val)}-{str(val + current_metadata['max_window_size'])}" for val in row] for row in Y])
-    hover_template_text = "%{text}<br>%{customdata}<br>Identity: %{z:.1f}"'''
-    hover_template_text = "Identity: %{z:.2f}"
-    # Create initial heatmap
-    heatmap = go.Heatmap(
-        z=main_level,
-        zmin=identity,
-        zmax=100,
-        colorscale=current_color,
-        x=main_x_axis,
-        y=main_y_axis,
-        showscale=True,
-        colorbar=dict(title="Identity"),
-        hoverinfo="all",
-        hovertemplate=hover_template_text,
-        name="",
-        x0=0,
-        dx=current_metadata["max_window_size"],
-        xtype="scaled",
-        y0=0,
-        dy=current_metadata["max_window_size"],
-        ytype="scaled",
-    )
+    def viewport_placement(view, x_axis, y_axis):
+        """
+        Properties of the hover heatmap and of the layout image that put a viewport
+        on the axes. x_axis and y_axis hold the start of each column / row of
+        `view`, plus the end of the last one.
+        """
+        z, x, y = hoverGrid(view, x_axis, y_axis)
+        trace = dict(
+            z=typedArray(z),
+            x=x.tolist(),
+            y=y.tolist(),
+            # Whether hover cells cover more than one window, see HOVER_INTERVALS_JS
+            meta=dict(blocks=z.shape != view.shape),
+        )
+        image = dict(
+            x=float(x_axis[0]),
+            y=float(y_axis[-1]),
+            sizex=float(x_axis[-1] - x_axis[0]),
+            sizey=float(y_axis[-1] - y_axis[0]),
+        )
+        return trace, image
 
-    fig = go.Figure(data=[heatmap])
-    fig.update_xaxes(
-        showspikes=True,
-        spikemode="across",
-        ticks="outside",
-        showline=True,
-        linewidth=2,
-        linecolor="black",
-        mirror=True,
-    )
-    fig.update_xaxes(
-        nticks=10, title_text=metadata[0]["x_name"], title_font=dict(size=18)
-    )
+    def render_viewport(i, zoom_level, rows, cols):
+        """
+        Every cell of a viewport drawn into a palette PNG, along with its hover
+        heatmap and image placement (see viewport_placement). Taken from the cache
+        when the same cells were drawn before. The PNG's palette is a placeholder,
+        set by viewport_source.
+        """
+        key = (titles[i], zoom_level, rows.start, rows.stop, cols.start, cols.stop)
+        rendered = viewport_cache.get(key)
+        if rendered is None:
+            view, x_axis, y_axis = resolver_for(i).view(zoom_level, rows, cols)
+            png = encodePng(quantizeIdentity(view, identity))
+            trace, image = viewport_placement(view, x_axis, y_axis)
+            rendered = (png, trace, image)
+            viewport_cache.put(key, rendered, len(png) + len(trace["z"]["bdata"]))
+        return rendered
 
-    # Update y-axis properties directly within the heatmap trace
-    fig.update_yaxes(
-        showspikes=True,
-        spikemode="across",
-        ticks="outside",
-        showline=True,
-        linewidth=2,
-        linecolor="black",
-        mirror=True,
-    )
-    fig.update_yaxes(title_text=metadata[0]["y_name"], title_font=dict(size=18))
-    fig_title = ""
+    def viewport_source(png, colorscale, zmin, zmax, threshold_range):
+        """
+        A rendered viewport with its colours, as a data URI.
+        """
+        return pngDataUri(
+            setPngPalette(
+                png, identityPalette(colorscale, identity, zmin, zmax, threshold_range)
+            )
+        )
 
-    # TODO: Fine tuning on the names
-    title_size = 28
-    if metadata[0]["self"]:
-        fig_title = f"Self-Identity Plot: {x_name}"
-        if len(x_name) > 22:
-            title_size = 20
-    else:
-        fig_title = f"Comparative Plot: {x_name} vs. {y_name}"
-        if len(x_name) + len(y_name) > 22:
-            title_size = 18
+    def make_figure(info, rendered, colorscale, zmin, zmax, threshold_range):
+        """
+        Figure for one viewport. Every cell is drawn server side into a palette PNG
+        shown as a layout image; underneath it, a coarse heatmap of at most
+        HOVER_CELLS per side carries hover labels and the colorbar. Only the image
+        and the coarse heatmap are sent to the browser, however large the matrix.
+        """
+        png, trace, image = rendered
+        heatmap = go.Heatmap(
+            zmin=zmin,
+            zmax=zmax,
+            colorscale=colorscale,
+            showscale=True,
+            colorbar=dict(title="Identity"),
+            # Labelled by the hover tooltip
+            hoverinfo="none",
+            name="",
+            **trace,
+        )
+        fig = go.Figure(data=[heatmap])
+        fig.add_layout_image(
+            source=viewport_source(png, colorscale, zmin, zmax, threshold_range),
+            xref="x",
+            yref="y",
+            xanchor="left",
+            yanchor="top",
+            sizing="stretch",
+            layer="above",
+            **image,
+        )
+        fig.update_xaxes(
+            range=[image["x"], image["x"] + image["sizex"]],
+            showspikes=True,
+            spikemode="across",
+            ticks="outside",
+            showline=True,
+            linewidth=2,
+            linecolor="black",
+            mirror=True,
+        )
+        fig.update_xaxes(nticks=10, title_text=info["x_name"], title_font=dict(size=18))
+
+        # Update y-axis properties directly within the heatmap trace
+        fig.update_yaxes(
+            range=[image["y"] - image["sizey"], image["y"]],
+            showspikes=True,
+            spikemode="across",
+            ticks="outside",
+            showline=True,
+            linewidth=2,
+            linecolor="black",
+            mirror=True,
+        )
+        fig.update_yaxes(title_text=info["y_name"], title_font=dict(size=18))
+        fig_title, title_size = plot_title(info)
+
+        # Set layout properties
+        fig.update_layout(
+            height=800,
+            width=800,
+            hoverlabel=dict(bgcolor="white", font_size=16, font_family="Helvetica"),
+            yaxis_scaleanchor="x",
+            title=fig_title,
+            title_font=dict(size=title_size, family="Helvetica, Arial, sans-serif"),
+            title_x=0.5,
+            title_y=0.95,
+        )
+        return fig
 
-    # Set layout properties
-    fig.update_layout(
-        height=800,
-        width=800,
-        hoverlabel=dict(bgcolor="white", font_size=16, font_family="Helvetica"),
-        yaxis_scaleanchor="x",
-        title=fig_title,
-        title_font=dict(size=title_size, family="Helvetica, Arial, sans-serif"),
-        title_x=0.5,
-        title_y=0.95,
+    # Create initial figure from the coarsest layer
+    fig = make_figure(
+        current_metadata,
+        render_viewport(
+            0,
+            0,
+            slice(0, image_pyramid[0].shape[0]),
+            slice(0, image_pyramid[0].shape[1]),
+        ),
+        current_color,
+        identity,
+        100,
+        [identity, 100],
     )
+    matrices.prefetch(likely_next(0))
     colorscales = px.colors.named_colorscales()
     colornames = px.colors.named_colorscales()
 
@@ -209,7 +290,21 @@ def run_dash(matrices, metadata, axes, sparsity, identity, port_number, output_d
             html.Link(rel="icon", href="/assets/favicon.png"),
             html.Div(
                 [
-                    dcc.Graph(id="dotplot", figure=fig),
+                    html.Div(
+                        [
+                            dcc.Graph(id="dotplot", figure=fig, clear_on_unhover=True),
+                            dcc.Tooltip(
+                                id="dotplot-tooltip",
+                                background_color="white",
+                                style={
+                                    "whiteSpace": "pre",
+                                    "fontFamily": "Helvetica",
+                                    "fontSize": 16,
+                                },
+                            ),
+                        ],
+                        style={"position": "relative"},
+                    ),
                     html.Div(
                         dcc.RangeSlider(
                             id="threshold-slider",
@@ -276,6 +371,20 @@ def run_dash(matrices, metadata, axes, sparsity, identity, port_number, output_d
                                     ),
                                     html.Div(id="output-container"),
                                     dcc.Store(id="matrices-store", data=len(matrices)),
+                                    # Matrix, zoom level and cell ranges on screen
+                                    dcc.Store(
+                                        id="view-store",
+                                        data={
+                                            "matrix": 0,
+                                            "zoom": 0,
+                                            "x": [0, image_pyramid[0].shape[1]],
+                                            "y": [0, image_pyramid[0].shape[0]],
+                                        },
+                                    ),
+                                    # Colour lookup tables, filled in below
+                                    dcc.Store(id="palette-store"),
+                                    # Coordinates clicked so far, newest first
+                                    dcc.Store(id="clicked-store", data=[]),
                                 ],
                                 style={
                                     "display": "none" if len(titles) < 2 else "block",
@@ -299,6 +408,18 @@ def run_dash(matrices, metadata, axes, sparsity, identity, port_number, output_d
                                     },
                                 ),
                             ),
+                            html.Div(
+                                html.Button(
+                                    "Save Matrix to Cooler File",
+                                    id="save-cool",
+                                    n_clicks=0,
+                                    disabled=False,
+                                    style={
+                                        "marginLeft": "45px",
+                                        "marginTop": "10px",
+                                    },
+                                ),
+                            ),
                             html.Div(
                                 children=[
                                     f"Current Window Size: {current_metadata['max_window_size']}"
@@ -324,6 +445,33 @@ def run_dash(matrices, metadata, axes, sparsity, identity, port_number, output_d
                                     "textAlign": "left",
                                 },
                             ),
+                            html.Div(
+                                id="progress-div",
+                                style={
+                                    "fontFamily": "Helvetica, Arial, sans-serif",
+                                    "fontSize": "12px",
+                                    "color": "gray",
+                                    "paddingTop": "10px",
+                                    "paddingLeft": "45px",
+                                    "width": "220px",
+                                    "textAlign": "left",
+                                },
+                            ),
+                            dcc.Interval(id="progress-interval", interval=1000),
+                            dcc.Store(id="layers-store"),
+                            html.Div(
+                                viewport_cache.summary(),
+                                id="cache-div",
+                                style={
+                                    "fontFamily": "Helvetica, Arial, sans-serif",
+                                    "fontSize": "12px",
+                                    "color": "gray",
+                                    "paddingTop": "10px",
+                                    "paddingLeft": "45px",
+                                    "width": "220px",
+                                    "textAlign": "left",
+                                },
+                            ),
                             dcc.Checklist(
                                 id="gradient-toggle",
                                 options=[
@@ -1293,90 +1441,124 @@ def run_dash(matrices, metadata, axes, sparsity, identity, port_number, output_d
         ],
     )
 
+    # Every palette on offer, sampled once, so the browser can recolour the
+    # viewport on its own
+    app.layout["palette-store"].data = {
+        "identity": identity,
+        "levels": IDENTITY_LEVELS,
+        "palettes": {
+            option["value"]: {
+                "colorscale": scale,
+                "lut": colorLut(scale).tobytes().hex(),
+            }
+            for option in app.layout["color-options"].options
+            if not option.get("disabled")
+            for scale in [getInteractiveColor(getMatchingColors(option["value"]), "+")]
+        },
+    }
+
+    def matrix_index(timothy):
+        for i in range(len(titles)):
+            if timothy == titles[i]:
+                return i
+        return 0
+
+    def view_window(info, zoom_level):
+        return info["max_window_size"] // (2**zoom_level)
+
     @app.callback(
         Output("text-input", "value"),
+        Output("clicked-store", "data"),
         Input("dotplot", "clickData"),
         Input("invisible-div", "children"),
         Input("matrix-dropdown", "value"),
+        State("clicked-store", "data"),
     )
-    def update_text(click_data, zoom_level, timothy):
-        updated_info = ""
-        for i in range(len(titles)):
-            if timothy == titles[i]:
-                updated_info = metadata[i]
-        global clicked_values
-        tmp = updated_info["max_window_size"] // (2**zoom_level)
-        if click_data:
-            x_val = (
-                click_data["points"][0]["x"] if "x" in click_data["points"][0] else ""
-            )
-            y_val = (
-                click_data["points"][0]["y"] if "y" in click_data["points"][0] else ""
-            )
-            z_val = (
-                click_data["points"][0]["z"] if "z" in click_data["points"][0] else ""
-            )
+    def update_text(click_data, zoom_level, timothy, clicked_values):
+        i = matrix_index(timothy)
+        updated_info = metadata[i]
+        if click_data and "x" in click_data["points"][0]:
+            x_val = click_data["points"][0]["x"]
+            y_val = click_data["points"][0]["y"]
+            # Hover cells can cover several matrix cells, so look the clicked cell
+            # up in the layer on screen rather than trusting the hover value
+            resolver = resolver_for(i)
+            # The matrix may have been rebuilt since, from its coarsest layer
+            zoom_level = min(zoom_level, len(resolver.layers) - 1)
+            layer = resolver.layers[zoom_level]
+            x_axis = resolver.x_axes[zoom_level]
+            y_axis = resolver.y_axes[zoom_level]
+            row, col = resolver.cell(zoom_level, x_val, y_val)
+            z_val = layer[row, col]
 
-            # Create clicked_values list if it doesn't exist in the global scope
-            if "clicked_values" not in globals():
-                globals()["clicked_values"] = []
-
-            # Append x and y values to the list and keep only the last 5 values
-            # TODO: I shouldn't have to round, but I do :/
-            clicked_values.insert(
-                0,
-                f'{updated_info["x_name"]}: {round(x_val)}-{round(x_val + tmp)}\n{updated_info["y_name"]}: {round(y_val)}-{round(y_val + tmp)}\nIdentity: {round(z_val,2)}\n~',
-            )
-            clicked_values = clicked_values[-100:]
-            return "\n".join((clicked_values))
+            # Prepend x and y values to this user's list and keep the last 100
+            clicked_values = [
+                f'{updated_info["x_name"]}: {round(x_axis[col])}-{round(x_axis[col + 1])}\n{updated_info["y_name"]}: {round(y_axis[row])}-{round(y_axis[row + 1])}\nIdentity: {round(z_val,2)}\n~'
+            ] + clicked_values[:99]
+            return "\n".join((clicked_values)), clicked_values
         else:
-            return ""
+            return "", dash.no_update
 
     @app.callback(Output("save-button", "disabled"), Input("text-input", "value"))
     def update_button_state(text_value):
         return text_value == ""
 
+    def view_export(view, extension):
+        """
+        The cells on screen, read from the pyramid layer they were drawn from
+        rather than from the figure, with everything needed to export them:
+        (cells, window size, x offset, y offset, output path). Cells are
+        transposed so their rows run along the x axis, as the exports expect.
+        Returns None if that layer isn't in memory anymore.
+        """
+        updated_info = metadata[view["matrix"]]
+        pyramid = matrices[view["matrix"]]
+        if view["zoom"] >= len(pyramid):
+            return None
+        window_size = view_window(updated_info, view["zoom"])
+        cells = pyramid[view["zoom"]][slice(*view["y"]), slice(*view["x"])].T
+        if updated_info["self"]:
+            title_hi = updated_info["x_name"] + extension
+        else:
+            title_hi = updated_info["x_name"] + "-" + updated_info["y_name"] + extension
+        if not output_dir:
+            output = os.path.join("./", title_hi)
+        else:
+            output = os.path.join(output_dir, title_hi)
+            if (output_dir) and not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+        return (
+            cells,
+            window_size,
+            view["x"][0] * window_size,
+            view["y"][0] * window_size,
+            output,
+        )
+
     @app.callback(
         Output("text-input", "value", allow_duplicate=True),
         Output("save-bed", "n_clicks"),
         Input("save-bed", "n_clicks"),
-        Input("dotplot", "figure"),
+        State("view-store", "data"),
     )
-    def save_bed(n_clicks, figure):
-        global clicked_values
+    def save_bed(n_clicks, view):
         if n_clicks > 0:
-            window_size = figure["data"][0]["x"][1] - figure["data"][0]["x"][0]
-            try:
-                identity = round(
-                    min([val for val in figure["data"][0]["z"][0] if val > 0])
-                )
-                x_axis_name = figure["layout"]["xaxis"]["title"]["text"]
-                y_axis_name = figure["layout"]["yaxis"]["title"]["text"]
-                if x_axis_name == y_axis_name:
-                    selfy = True
-                    title_hi = x_axis_name + ".bed"
-                else:
-                    selfy = False
-                    title_hi = x_axis_name + "-" + y_axis_name + ".bed"
-            except:
-                identity = 86
-                x_axis_name = "x"
-                y_axis_name = "y"
-                selfy = False
-                title_hi = "x-y.bed"
-            pls = np.array(figure["data"][0]["z"])
-            tr = convertMatrixToBed(
-                pls, window_size, identity, x_axis_name, y_axis_name, selfy
+            export = view_export(view, ".bed")
+            if export is None:
+                return "Matrix is still being rebuilt, try again shortly\n", 0
+            cells, window_size, x_offset, y_offset, bedfile_output = export
+            updated_info = metadata[view["matrix"]]
+            bedpe = convertMatrixToBedpeFrame(
+                cells,
+                window_size,
+                identity,
+                updated_info["x_name"],
+                updated_info["y_name"],
+                updated_info["self"],
+                x_offset,
+                y_offset,
             )
-            if not output_dir:
-                bedfile_output = os.path.join("./", title_hi)
-            else:
-                bedfile_output = os.path.join(output_dir, title_hi)
-                if (output_dir) and not os.path.exists(output_dir):
-                    os.makedirs(output_dir)
-            with open(bedfile_output, "w") as bedfile:
-                for row in tr:
-                    bedfile.write("\t".join(map(str, row)) + "\n")
+            bedpe.to_csv(bedfile_output, sep="\t", index=False)
             msg = f"Saved bed file to {bedfile_output}\n"
             return msg, 0  # Make sure to return a tuple of values for the outputs
         else:
@@ -1385,13 +1567,44 @@ def run_dash(matrices, metadata, axes, sparsity, identity, port_number, output_d
                 dash.no_update,
             )  # Return dash.no_update for outputs not being updated
 
+    @app.callback(
+        Output("text-input", "value", allow_duplicate=True),
+        Output("save-cool", "n_clicks"),
+        Input("save-cool", "n_clicks"),
+        State("view-store", "data"),
+    )
+    def save_cool(n_clicks, view):
+        if n_clicks > 0:
+            export = view_export(view, ".cooler")
+            if export is None:
+                return "Matrix is still being rebuilt, try again shortly\n", 0
+            cells, window_size, x_offset, y_offset, cool_output = export
+            updated_info = metadata[view["matrix"]]
+            try:
+                convertMatrixToCool(
+                    matrix=cells,
+                    window_size=window_size,
+                    id_threshold=identity,
+                    x_name=updated_info["x_name"],
+                    y_name=updated_info["y_name"],
+                    self_identity=updated_info["self"],
+                    x_offset=x_offset,
+                    y_offset=y_offset,
+                    chromsizes=updated_info["x_size"],
+                    output_cool=cool_output,
+                )
+            except Exception as e:
+                return f"Error creating cooler file: {e}\n", 0
+            return f"Saved cooler file to {cool_output}\n", 0
+        else:
+            return dash.no_update, dash.no_update
+
     @app.callback(
         Output("text-input", "value", allow_duplicate=True),
         Input("save-button", "n_clicks"),
         State("text-input", "value"),
     )
     def save_to_file(n_clicks, content):
-        global clicked_values
         if n_clicks > 0 and content:
             content = content.replace("\n", ",")
             content = content.replace(": ", ", ")
@@ -1404,107 +1617,172 @@ def run_dash(matrices, metadata, axes, sparsity, identity, port_number, output_d
                 file.write(str(content))
             return msg
 
-    # Callback activates when panning, zooming, or changing color
+    # Colours and the identity threshold are applied in the browser. The server
+    # only hears about them when it draws a new viewport
+    app.clientside_callback(
+        RESTYLE_VIEWPORT_JS,
+        Output("dotplot", "figure", allow_duplicate=True),
+        Input("color-options", "value"),
+        Input("threshold-slider", "value"),
+        Input("gradient-toggle", "value"),
+        State("dotplot", "figure"),
+        State("palette-store", "data"),
+        prevent_initial_call=True,
+    )
+
+    # Genomic intervals under the cursor, worked out in the browser
+    app.clientside_callback(
+        HOVER_INTERVALS_JS,
+        Output("dotplot-tooltip", "show"),
+        Output("dotplot-tooltip", "bbox"),
+        Output("dotplot-tooltip", "children"),
+        Input("dotplot", "hoverData"),
+        State("dotplot", "figure"),
+    )
+
+    @app.callback(
+        Output("progress-div", "children"),
+        Output("progress-interval", "disabled"),
+        Output("layers-store", "data"),
+        Input("progress-interval", "n_intervals"),
+        Input("matrix-dropdown", "value"),
+        State("layers-store", "data"),
+    )
+    def update_progress(n_intervals, timothy, shown):
+        # Polls the background worker until the selected matrix is complete
+        i = matrix_index(timothy)
+        ready, depth = matrices.progress(i)
+        if ready >= depth:
+            text = f"All {depth} resolution levels ready"
+        else:
+            text = f"Resolution levels ready: {ready} of {depth}"
+        layers = {"matrix": i, "ready": ready}
+        return text, ready >= depth, dash.no_update if layers == shown else layers
+
+    # Callback activates when panning, zooming, selecting a matrix, or when a
+    # finer layer of the matrix on screen is ready
     @app.callback(
         Output("dotplot", "figure", allow_duplicate=True),
         Output("loading-output-2", "children"),
         Output("window-div", "children"),
         Output("invisible-div", "children"),
+        Output("view-store", "data"),
+        Output("cache-div", "children"),
         Input("dotplot", "relayoutData"),
-        Input("dotplot", "figure"),
-        Input("color-options", "value"),
-        Input("threshold-slider", "value"),
-        Input("gradient-toggle", "value"),
         Input("matrix-dropdown", "value"),
         Input("invisible-div", "children"),
+        Input("layers-store", "data"),
+        State("color-options", "value"),
+        State("threshold-slider", "value"),
+        State("gradient-toggle", "value"),
+        State("view-store", "data"),
         prevent_initial_call=True,
     )
     def update_dotplot(
         relayoutData,
-        figure,
+        timothy,
+        current_zoom,
+        layers_ready,
         color,
         threshold_range,
         button_states,
-        timothy,
-        current_zoom,
+        current_view,
     ):
-        updated_info = ""
-        updated_title = ""
-        title_size = 28
-        image_axes = []
         # Matrix dropdown value = Timothy
-        for i in range(len(titles)):
-            if timothy == titles[i]:
-                image_pyramid = matrices[i]
-                image_axes = axes[i]
-                updated_info = metadata[i]
-                if updated_info["self"]:
-                    updated_title = f"Self-Identity Plot: {updated_info['x_name']}"
-                    if len(updated_info["x_name"]) > 22:
-                        title_size = 20
-                else:
-                    updated_title = f"Comparative Plot: {updated_info['x_name']} vs. {updated_info['y_name']}"
-                    if len(updated_info["x_name"]) + len(updated_info["y_name"]) > 22:
-                        title_size = 16
-        new_main_level = image_pyramid[0]
-        fig = go.Figure(data=[heatmap])
+        i = matrix_index(timothy)
+        image_pyramid = matrices[i]
+        resolver = resolver_for(i)
+        updated_info = metadata[i]
         current_color = getInteractiveColor(getMatchingColors(color), "+")
-        new_heatmap = heatmap
-        new_heatmap.update(dict(colorscale=current_color, z=new_main_level))
-
-        masked_data = np.where(
-            (new_heatmap["z"] < threshold_range[0])
-            | (new_heatmap["z"] > threshold_range[1]),
-            0,
-            new_heatmap["z"],
-        )
-        fig = go.Figure(data=[new_heatmap])
-        fig.update_traces(z=masked_data)
-
         if "keep-original" in button_states:
-            fig.update_traces(zmin=threshold_range[0])
-            fig.update_traces(zmax=threshold_range[1])
+            zmin, zmax = threshold_range
         else:
-            fig.update_traces(zmin=identity)
-            fig.update_traces(zmax=100)
+            zmin, zmax = identity, 100
 
-        fig.update_xaxes(
-            showspikes=True,
-            spikemode="across",
-            ticks="outside",
-            showline=True,
-            linewidth=2,
-            linecolor="black",
-            mirror=True,
-        )
-        # TODO: nticks not working
-        fig.update_xaxes(
-            nticks=10, title_text=updated_info["x_name"], title_font=dict(size=18)
-        )
+        def show(zoom_factor, rows, cols, full=False):
+            rendered = render_viewport(i, zoom_factor, rows, cols)
+            if full:
+                new_fig = make_figure(
+                    updated_info,
+                    rendered,
+                    current_color,
+                    zmin,
+                    zmax,
+                    threshold_range,
+                )
+            else:
+                # Same matrix, same styling: only the data and the axes change
+                png, trace, image = rendered
+                new_fig = Patch()
+                for key, value in trace.items():
+                    new_fig["data"][0][key] = value
+                for key, value in image.items():
+                    new_fig["layout"]["images"][0][key] = value
+                new_fig["layout"]["images"][0]["source"] = viewport_source(
+                    png, current_color, zmin, zmax, threshold_range
+                )
+                new_fig["layout"]["xaxis"]["range"] = [
+                    image["x"],
+                    image["x"] + image["sizex"],
+                ]
+                new_fig["layout"]["yaxis"]["range"] = [
+                    image["y"] - image["sizey"],
+                    image["y"],
+                ]
+            return (
+                new_fig,
+                "",
+                f"Current Window Size: {view_window(updated_info, zoom_factor)}",
+                zoom_factor,
+                {
+                    "matrix": i,
+                    "zoom": zoom_factor,
+                    "x": [cols.start, cols.stop],
+                    "y": [rows.start, rows.stop],
+                },
+                viewport_cache.summary(),
+            )
 
-        # Update y-axis properties directly within the heatmap trace
-        fig.update_yaxes(
-            showspikes=True,
-            spikemode="across",
-            ticks="outside",
-            showline=True,
-            linewidth=2,
-            linecolor="black",
-            mirror=True,
-        )
-        fig.update_yaxes(title_text=updated_info["y_name"], title_font=dict(size=18))
+        def show_all():
+            # Occurs at startup, when double-clicked and when selecting a matrix
+            matrices.prefetch(likely_next(i))
+            return show(
+                0,
+                slice(0, image_pyramid[0].shape[0]),
+                slice(0, image_pyramid[0].shape[1]),
+                full=True,
+            )
 
-        fig.update_layout(
-            hoverlabel=dict(bgcolor="white", font_size=16, font_family="Helvetica"),
-            title=updated_title,  # Add your title here
-            title_font=dict(
-                size=title_size, family="Helvetica"
-            ),  # Adjust the title font size if needed
-            title_x=0.5,
-            title_y=0.95,
-        )
+        def keep(zoom_level):
+            # Happens when panning or zooming in/out within threshold
+            return (
+                dash.no_update,
+                "",
+                f"Current Window Size: {view_window(updated_info, zoom_level)}",
+                zoom_level,
+                dash.no_update,
+                dash.no_update,
+            )
+
+        if ctx.triggered_id == "matrix-dropdown" or current_view["matrix"] != i:
+            return show_all()
+
+        if ctx.triggered_id == "layers-store":
+            # Until now the view was drawn from the finest layer ready: redraw it
+            # if a finer one has been finished for it since
+            level = min(current_view["zoom"], len(resolver.layers) - 1)
+            x_axis = resolver.x_axes[level]
+            y_axis = resolver.y_axes[level]
+            zoom_factor, rows, cols = resolver.resolve(
+                x_axis[current_view["x"][0]],
+                x_axis[current_view["x"][1]],
+                y_axis[current_view["y"][0]],
+                y_axis[current_view["y"][1]],
+            )
+            if zoom_factor == current_view["zoom"]:
+                return (dash.no_update,) * 6
+            return show(zoom_factor, rows, cols)
 
-        fig.update_layout(yaxis_scaleanchor="x")
         if relayoutData is not None:
             # TODO: Pan mode should stay in pan mode
 
@@ -1539,179 +1817,32 @@ def run_dash(matrices, metadata, axes, sparsity, identity, port_number, output_d
                         y_end_range = updated_info["y_size"]
 
                 if x_start_range >= 0 and y_start_range >= 0:
-                    x_begin = round(relayoutData["xaxis.range[0]"])
-                    x_end = round(relayoutData["xaxis.range[1]"])
-
-                    y_begin = round(relayoutData["yaxis.range[0]"])
-                    y_end = round(relayoutData["yaxis.range[1]"])
-
-                    amount = x_end - x_begin
-
-                    # This function finds the correct level in the image pyramid
-                    try:
-                        zoom_factor = findValueInRange(amount, important)
-                    except ValueError as err:
-                        zoom_factor = 0
-                    # If zoom_factor is less than current_zoom, base tmp factors on the older amount
-
-                    if zoom_factor > len(image_pyramid) - 1:
-                        zoom_factor = len(image_pyramid) - 1
+                    # Finds the correct level in the image pyramid, and the cells
+                    # of it on screen
+                    zoom_factor, rows, cols = resolver.resolve(
+                        x_start_range, x_end_range, y_start_range, y_end_range
+                    )
                     if (zoom_factor != 0) or (zoom_factor != current_zoom):
-                        using_matrix = image_pyramid[zoom_factor]
-                        # Get the coordinates for the better matrix
-                        tmp1 = find_closest_elements(
-                            x_start_range, image_axes[2 * zoom_factor]
-                        )[0]
-                        tmp2 = find_closest_elements(
-                            x_end_range, image_axes[2 * zoom_factor]
-                        )[1]
-                        tmp3 = find_closest_elements(
-                            y_start_range, image_axes[(2 * zoom_factor) + 1]
-                        )[0]
-                        tmp4 = find_closest_elements(
-                            y_end_range, image_axes[(2 * zoom_factor) + 1]
-                        )[1]
-                        x_start_updated = math.floor(tmp1)
-                        x_end_updated = math.ceil(tmp2)
-                        y_start_updated = math.floor(tmp3)
-                        y_end_updated = math.ceil(tmp4)
-
-                        x_equi, y_equi = makeDifferencesEqual(
-                            x_start_updated,
-                            x_end_updated,
-                            y_start_updated,
-                            y_end_updated,
-                        )
-                        # TODO: flip axes here
-                        using_matrix = np.copy(
-                            using_matrix[y_start_updated:y_equi, x_start_updated:x_equi]
-                        )
-                        masked_matrix = np.where(
-                            (using_matrix < threshold_range[0])
-                            | (using_matrix > threshold_range[1]),
-                            0,
-                            using_matrix,
-                        )
-
-                        x_ax = image_axes[2 * zoom_factor][x_start_updated:x_equi]
-                        y_ax = image_axes[(2 * zoom_factor) + 1][y_start_updated:y_equi]
-
-                        new_hover_template_text = "Identity: %{z:.1f}"
-
-                        # Create figure
-                        new_heatmap = go.Heatmap(
-                            z=masked_matrix,
-                            zmin=identity,
-                            zmax=100,
-                            colorscale=current_color,
-                            x=x_ax,
-                            y=y_ax,
-                            showscale=True,  # Shows color scale bar
-                            colorbar=dict(title="Identity"),  # Color bar title
-                            hoverinfo="z",  # Hover info to display
-                            hovertemplate=new_hover_template_text,
-                            name="",
-                            x0=x_ax[0],
-                            dx=updated_info["max_window_size"] // (2**zoom_factor),
-                            xtype="scaled",
-                            y0=y_ax[0],
-                            dy=updated_info["max_window_size"] // (2**zoom_factor),
-                            ytype="scaled",
-                        )
-
-                        # Create the figure
-                        current_fig = go.Figure(data=[new_heatmap])
-                        current_fig.update_xaxes(
-                            showspikes=True,
-                            spikemode="across",
-                            ticks="outside",
-                            showline=True,
-                            linewidth=2,
-                            linecolor="black",
-                            mirror=True,
-                        )
-                        current_fig.update_xaxes(
-                            nticks=10,
-                            title_text=updated_info["x_name"],
-                            title_font=dict(size=18),
-                        )
-
-                        # Update y-axis properties directly within the heatmap trace
-                        current_fig.update_yaxes(
-                            showspikes=True,
-                            spikemode="across",
-                            ticks="outside",
-                            showline=True,
-                            linewidth=2,
-                            linecolor="black",
-                            mirror=True,
-                        )
-
-                        current_fig.update_yaxes(
-                            title_text=updated_info["y_name"], title_font=dict(size=18)
-                        )
-                        current_fig.update_layout(
-                            hoverlabel=dict(
-                                bgcolor="white", font_size=16, font_family="Helvetica"
-                            ),
-                            title=fig_title,  # Add your title here
-                            title_font=dict(size=28, family="Helvetica"),
-                            title_x=0.5,  # Center horizontally
-                            title_y=0.95,  # Center vertically
-                        )
-                        current_fig.update_layout(yaxis_scaleanchor="x")
-                        return (
-                            current_fig,
-                            "",
-                            f"Current Window Size: {updated_info['max_window_size']//(2**zoom_factor)}",
-                            zoom_factor,
-                        )
+                        return show(zoom_factor, rows, cols)
                     else:
-                        # Happens when panning or zooming in/out within threshold
-                        return (
-                            figure,
-                            "",
-                            f"Current Window Size: {updated_info['max_window_size']//(2**current_zoom)}",
-                            current_zoom,
-                        )
+                        return keep(current_zoom)
 
             elif "xaxis.autorange" in relayoutData:
                 # Triggers when double-clicked or reset axes
-                return (
-                    fig,
-                    "",
-                    f"Current Window Size: {updated_info['max_window_size']}",
-                    0,
-                )
+                return show_all()
 
             # TODO: disable Autosizing
             elif "autosize" in relayoutData:
                 # Autosize should be disabled: if not it gets handled here
-                return (
-                    figure,
-                    "",
-                    f"Current Window Size: {updated_info['max_window_size']}",
-                    zoom_factor,
-                )
+                return keep(current_zoom)
 
             else:
                 # Happens when user selects pan mode.
                 # TODO: get correct window size
-                return (
-                    figure,
-                    "",
-                    f"Current Window Size: {updated_info['max_window_size']//(2**current_zoom)}",
-                    current_zoom,
-                )
+                return keep(current_zoom)
         else:
-            # This occurs at startup and when selecting color. Return the base figure with color
-            # fig.update_layout(coloraxis=dict(colorscale=current_color))
-            return (
-                fig,
-                "",
-                f"Current Window Size: {updated_info['max_window_size']}",
-                current_zoom,
-            )
+            # This occurs at startup. Return the base figure
+            return show_all()
 
     # -------DO NOT DELETE! CUSTOM CSS FOR IDENTITY THRESHOLD SLIDER--------
     app.index_string = """
@@ -1739,6 +1870,10 @@ def run_dash(matrices, metadata, axes, sparsity, identity, port_number, output_d
             #main_color {
                 justify-content:center;
             }
+            /* Viewport images hold one pixel per cell, don't blur them */
+            #dotplot image {
+                image-rendering: pixelated;
+            }
         </style>
     </head>
     <body>
@@ -1751,5 +1886,4 @@ def run_dash(matrices, metadata, axes, sparsity, identity, port_number, output_d
     </body>
 </html>
 """
-    # TODO: Change debug to False for production
-    app.run(debug=False, use_reloader=False, port=port_number)
+    return app
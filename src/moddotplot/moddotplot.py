@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 import sys
 from moddotplot.parse_fasta import (
-    readKmersFromFile,
+    iterKmersFromFiles,
+    listSequences,
+    availableCores,
     getInputHeaders,
     isValidFasta,
     extractFiles,
@@ -9,25 +11,565 @@ from moddotplot.parse_fasta import (
 )
 
 from moddotplot.estimate_identity import (
-    convertToModimizers,
+    sketchModimizers,
+    modimizerPositions,
     selfContainmentMatrix,
     pairwiseContainmentMatrix,
     convertMatrixToBed,
     convertMatrixToCool,
     createSelfMatrix,
     createPairwiseMatrix,
-    partitionOverlaps,
+    partitionOffsets,
 )
-from moddotplot.interactive import run_dash
+from moddotplot.interactive import create_app, run_dash
+from moddotplot.checkpoint import (
+    CHECKPOINT_FILE,
+    KMER_CHECKPOINT_DIR,
+    Checkpoint,
+    fileStamp,
+)
+from moddotplot.tiling import (
+    DEFAULT_TILE_SIZE,
+    createPairwiseTiles,
+    createSelfTiles,
+    findShardSidecars,
+    mergeShards,
+    readBedpe,
+    writeShard,
+    writeTiles,
+)
+from moddotplot.pipeline import PIPELINE_DEPTH, BackgroundStage
+from moddotplot.pyramids import PYRAMID_CAPACITY, PyramidStore
+from moddotplot.viewport import VIEWPORT_CACHE_MB
 from moddotplot.const import ASCII_ART, VERSION
+from moddotplot.profiling import PROFILER
+from moddotplot.progress import setQuiet
 
 import argparse
 import math
+from functools import partial
 from moddotplot.static_plots import read_df_from_file, create_plots, create_grid
 import json
 import numpy as np
 import pickle
 import os
+import re
+
+
+def parseGenomicDistance(value):
+    """
+    Parse a distance such as 5000, 500kbp, 5Mbp or 1.5G into base pairs.
+    """
+    match = re.fullmatch(
+        r"\s*(\d+(?:\.\d+)?)\s*([kmg]?)(?:bp?)?\s*", str(value), re.IGNORECASE
+    )
+    if not match:
+        raise argparse.ArgumentTypeError(
+            f"Invalid distance '{value}'. Use e.g. 5000, 500kbp or 5Mbp."
+        )
+    multiplier = {"": 1, "k": 10**3, "m": 10**6, "g": 10**9}
+    return round(float(match.group(1)) * multiplier[match.group(2).lower()])
+
+
+def parseShard(value):
+    """
+    Parse a shard such as 0/4 into (shard index, number of shards).
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", str(value))
+    if not match or not int(match.group(1)) < int(match.group(2)):
+        raise argparse.ArgumentTypeError(
+            f"Invalid shard '{value}'. Use i/N with 0 <= i < N, e.g. 0/4."
+        )
+    return int(match.group(1)), int(match.group(2))
+
+
+def matrixCheckpoint(args, directory, params):
+    """
+    Checkpoint for one static mode matrix, kept in its output folder. Returns None
+    unless --resume is given, or when the matrix isn't saved anywhere it could be
+    reused from.
+    """
+    if not args.resume or (args.no_bedpe and not args.tile_size):
+        return None
+    name = CHECKPOINT_FILE
+    if args.shard:
+        name = "checkpoint-shard-{}-of-{}.json".format(*args.shard)
+    params = dict(
+        params,
+        kmer=args.kmer,
+        identity=args.identity,
+        delta=args.delta,
+        ambiguous=args.ambiguous,
+        tile_size=args.tile_size,
+        shard=args.shard,
+        cooler=args.cooler,
+    )
+    return Checkpoint(directory, params, name)
+
+
+def finishedMatrix(checkpoint, need_bedpe):
+    """
+    Record of a matrix finished by an earlier run, if its outputs are still there.
+    Empty pairwise matrices have no bedpe file, and only count when one isn't needed.
+    """
+    record = checkpoint.get("matrix") if checkpoint else None
+    if not record:
+        return None
+    if record["bedpe"] and os.path.exists(record["bedpe"]):
+        return record
+    if record.get("empty") and not need_bedpe:
+        return record
+    return None
+
+
+def loadLayer(checkpoint, layer_file):
+    """
+    Interactive pyramid layer saved by an earlier run with the same parameters, or
+    None if it still has to be computed.
+    """
+    if not checkpoint or not checkpoint.done(layer_file):
+        return None
+    path = os.path.join(checkpoint.directory, layer_file)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, allow_pickle=True)["data"]
+
+
+def saveLayer(checkpoint, layer_file, matrix_layer):
+    """
+    Save an interactive pyramid layer as soon as it is computed, in the --save
+    layout, and record it in the checkpoint.
+    """
+    if checkpoint:
+        with PROFILER.stage("save", label=layer_file):
+            np.savez_compressed(
+                os.path.join(checkpoint.directory, layer_file), data=matrix_layer
+            )
+        checkpoint.mark(layer_file)
+
+
+def sketchLayers(args, name, kmers, window_lengths, sparsities, expectation):
+    """
+    Sketch a sequence at the window length and sparsity of every interactive
+    pyramid layer. Self and pairwise matrices of a layer read the same sketches.
+
+    Returns:
+        List: (window sketches, delta-extended neighbor sketches) of each layer.
+    """
+    layers = []
+    for window, sparsity in zip(window_lengths, sparsities):
+        with PROFILER.stage("sketch", label=f"{name}:{window}") as stage:
+            neighbors = partitionOffsets(window, args.delta, len(kmers), args.kmer)
+            windows = partitionOffsets(window, 0, len(kmers), args.kmer)
+            stage["items"] = len(windows[0])
+            positions = modimizerPositions(kmers, sparsity, args.ambiguous, args.kmer)
+            layers.append(
+                (
+                    sketchModimizers(
+                        kmers,
+                        *windows,
+                        sparsity,
+                        args.ambiguous,
+                        args.kmer,
+                        expectation,
+                        positions,
+                    ),
+                    sketchModimizers(
+                        kmers,
+                        *neighbors,
+                        sparsity,
+                        args.ambiguous,
+                        args.kmer,
+                        expectation,
+                        positions,
+                    ),
+                )
+            )
+    return layers
+
+
+def interactiveMetadata(args, seq_list, seq_lengths, window_lengths, sparsities):
+    """
+    Metadata of every matrix of an interactive session: the self-identity matrix
+    of each sequence, then, with --compare or --compare-only, the comparative
+    matrix of each pair, the larger sequence on the x axis.
+    """
+    pairs = []
+    if not args.compare_only:
+        pairs += [(j, j) for j in range(len(seq_list))]
+    if args.compare or args.compare_only:
+        for a in range(len(seq_list)):
+            for b in range(a + 1, len(seq_list)):
+                pairs.append((a, b) if seq_lengths[a] > seq_lengths[b] else (b, a))
+    metadata = []
+    for x, y in pairs:
+        metadata.append(
+            {
+                "x_name": seq_list[x],
+                "y_name": seq_list[y],
+                "x_size": seq_lengths[x] + args.kmer - 1,
+                "y_size": seq_lengths[y] + args.kmer - 1,
+                "self": x == y,
+                "min_window_size": window_lengths[0],
+                "max_window_size": window_lengths[-1],
+                "resolution": args.resolution,
+                "kmer_length": args.kmer,
+                "title": (seq_list[x] if x == y else f"{seq_list[x]}-{seq_list[y]}"),
+                "sparsities": sparsities,
+            }
+        )
+    return metadata
+
+
+def pyramidLayers(args, info, sketches, window_lengths, layer_checkpoint):
+    """
+    Every layer of one interactive matrix, computed from the sequences' sketches
+    (see sketchLayers) or loaded from an earlier run's checkpoint.
+
+    Yields:
+        np.ndarray: Layers, coarsest first, so the matrix can be shown as soon
+        as the cheapest one is ready.
+    """
+    count = len(window_lengths)
+    if info["self"]:
+        kind = "self-identity"
+        description = f"for {info['x_name']}"
+    else:
+        kind = "pairwise"
+        description = f"for {info['x_name']} and {info['y_name']}"
+    if args.quick or count == 1:
+        print(
+            f"Building 1 {kind} matrix {description}, using a window size of {window_lengths[0]}.... \n"
+        )
+    else:
+        print(
+            f"Building {count} {kind} matrices {description}, using a minimum window size of {window_lengths[0]}.... \n"
+        )
+    for i in reversed(range(count)):
+        layer_window_size = window_lengths[i]
+        layer_file = f"{info['title']}_{count - 1 - i}.npz"
+        matrix_layer = loadLayer(layer_checkpoint, layer_file)
+        if matrix_layer is not None:
+            if not args.quick:
+                print(f"Layer {i+1} loaded from {layer_file}\n")
+            yield matrix_layer
+            continue
+        if not args.quick:
+            print(f"Layer {i+1} using window length {layer_window_size}\n")
+        x_sing, x_neigh = sketches[info["x_name"]][i]
+        if info["self"]:
+            with PROFILER.stage(
+                "self_layer", label=f"{info['title']}:{layer_window_size}"
+            ):
+                with PROFILER.stage("matrix", items=(len(x_sing.offsets) - 1) ** 2):
+                    matrix_layer = selfContainmentMatrix(
+                        x_sing, x_neigh, args.kmer, args.identity, args.ambiguous
+                    )
+        else:
+            y_sing, y_neigh = sketches[info["y_name"]][i]
+            with PROFILER.stage(
+                "pairwise_layer", label=f"{info['title']}:{layer_window_size}"
+            ):
+                with PROFILER.stage(
+                    "matrix",
+                    items=(len(x_sing.offsets) - 1) * (len(y_sing.offsets) - 1),
+                ):
+                    matrix_layer = pairwiseContainmentMatrix(
+                        x_sing,
+                        y_sing,
+                        x_neigh,
+                        y_neigh,
+                        args.identity,
+                        args.kmer,
+                        False,
+                    )
+        saveLayer(layer_checkpoint, layer_file, matrix_layer)
+        yield matrix_layer
+
+
+def plotMatrix(args, bed, directory, name_x, name_y, is_pairwise):
+    """
+    Plot one self-identity or comparative matrix from its bedpe rows.
+    """
+    label = f"{name_x}_{name_y}" if is_pairwise else name_x
+    with PROFILER.stage("plot", label=label):
+        create_plots(
+            sdf=[bed],
+            directory=directory,
+            name_x=name_x,
+            name_y=name_y,
+            palette=args.palette,
+            palette_orientation=args.palette_orientation,
+            no_hist=args.no_hist,
+            width=args.width,
+            dpi=args.dpi,
+            is_freq=args.bin_freq,
+            xlim=args.axes_limits,
+            custom_colors=args.colors,
+            custom_breakpoints=args.breakpoints,
+            from_file=None,
+            is_pairwise=is_pairwise,
+            axes_labels=args.axes_ticks,
+            axes_tick_number=args.axes_number,
+            vector_format=args.vector,
+            deraster=args.deraster,
+            annotation=args.bed,
+        )
+
+
+def exportSelfMatrix(
+    args, self_mat, seq_name, win, seq_length, seq_start_pos, checkpoint
+):
+    """
+    Convert a dense self-identity matrix to bedpe rows, then write the cooler and
+    bedpe files asked for.
+
+    Returns:
+        List: Bedpe rows of the matrix, header first.
+    """
+    cooler_output = None
+    with PROFILER.stage("bedpe", label=seq_name) as stage:
+        bed = convertMatrixToBed(
+            self_mat,
+            win,
+            args.identity,
+            seq_name,
+            seq_name,
+            True,
+            seq_start_pos,
+            seq_start_pos,
+            banded=bool(args.max_distance),
+        )
+        stage["items"] = len(bed) - 1
+    if args.cooler:
+        try:
+            cooler_path = "."
+            if not args.output_dir:
+                cooler_path = os.path.join(cooler_path, seq_name)
+            else:
+                cooler_path = os.path.join(args.output_dir, seq_name)
+            os.makedirs(cooler_path, exist_ok=True)
+            cooler_output = os.path.join(cooler_path, seq_name + ".cooler")
+            with PROFILER.stage("cooler", label=seq_name):
+                convertMatrixToCool(
+                    matrix=self_mat,
+                    window_size=win,
+                    id_threshold=args.identity,
+                    x_name=seq_name,
+                    y_name=seq_name,
+                    self_identity=True,
+                    x_offset=seq_start_pos,
+                    y_offset=seq_start_pos,
+                    chromsizes=seq_length,
+                    output_cool=cooler_output,
+                    banded=bool(args.max_distance),
+                )
+            print(f"Saved self-identity matrix as a cooler file to {cooler_output}\n")
+        except Exception as e:
+            print(f"Error creating cooler file: {e}")
+
+    if not args.no_bedpe:
+        # Log saving bed file
+        bedpe_path = "."
+        if not args.output_dir:
+            bedpe_path = os.path.join(bedpe_path, seq_name)
+            os.makedirs(bedpe_path, exist_ok=True)
+            bedfile_output = os.path.join(seq_name, seq_name + ".bedpe")
+        else:
+            bedpe_path = os.path.join(args.output_dir, seq_name)
+            os.makedirs(bedpe_path, exist_ok=True)
+            bedfile_output = os.path.join(bedpe_path, seq_name + ".bedpe")
+
+        with PROFILER.stage("write_bedpe", label=seq_name, items=len(bed)):
+            with open(bedfile_output, "w") as bedfile:
+                for row in bed:
+                    bedfile.write("\t".join(map(str, row)) + "\n")
+        print(
+            f"Saved self-identity matrix as a paired-end bed file to {bedfile_output}\n"
+        )
+        if checkpoint:
+            checkpoint.mark(
+                "matrix", {"bedpe": bedfile_output, "cooler": cooler_output}
+            )
+    return bed
+
+
+def exportPairwiseMatrix(
+    args,
+    pair_mat,
+    larger_seq_name,
+    smaller_seq_name,
+    win,
+    larger_length,
+    larger_seq_start_pos,
+    smaller_seq_start_pos,
+    is_empty,
+    checkpoint,
+):
+    """
+    Convert a dense comparative matrix to bedpe rows, then write the cooler and
+    bedpe files asked for.
+
+    Returns:
+        List: Bedpe rows of the matrix, header first.
+    """
+    bedfile_prefix = larger_seq_name + "_" + smaller_seq_name
+    cooler_output = None
+    if args.cooler:
+        try:
+            cooler_path = os.path.join(args.output_dir or ".", bedfile_prefix)
+            os.makedirs(cooler_path, exist_ok=True)
+            cooler_output = os.path.join(cooler_path, f"{bedfile_prefix}.cooler")
+            with PROFILER.stage("cooler", label=bedfile_prefix):
+                convertMatrixToCool(
+                    matrix=pair_mat,
+                    window_size=win,
+                    id_threshold=args.identity,
+                    x_name=larger_seq_name,
+                    y_name=smaller_seq_name,
+                    self_identity=False,
+                    x_offset=larger_seq_start_pos,
+                    y_offset=smaller_seq_start_pos,
+                    chromsizes=larger_length,
+                    output_cool=cooler_output,
+                )
+            print(f"Saved comparative matrix as a cooler file to {cooler_output}\n")
+        except Exception as e:
+            print(f"Error creating pairwise cooler file: {e}")
+    with PROFILER.stage("bedpe", label=bedfile_prefix) as stage:
+        bed = convertMatrixToBed(
+            pair_mat,
+            win,
+            args.identity,
+            # check if this is correct
+            larger_seq_name,
+            smaller_seq_name,
+            False,
+            larger_seq_start_pos,
+            smaller_seq_start_pos,
+        )
+        stage["items"] = len(bed) - 1
+    if not args.no_bedpe:
+        # Log saving bed file
+        bedpe_path = os.path.join(args.output_dir or ".", bedfile_prefix)
+        os.makedirs(bedpe_path, exist_ok=True)
+        bedfile_output = os.path.join(bedpe_path, bedfile_prefix + "_COMPARE.bedpe")
+        with PROFILER.stage("write_bedpe", label=bedfile_prefix, items=len(bed)):
+            with open(bedfile_output, "w") as bedfile:
+                for row in bed:
+                    bedfile.write("\t".join(map(str, row)) + "\n")
+        print(
+            f"Saved comparative matrix as a paired-end bed file to {bedfile_output}\n"
+        )
+        if checkpoint:
+            checkpoint.mark(
+                "matrix",
+                {
+                    "bedpe": bedfile_output,
+                    "cooler": cooler_output,
+                    "empty": bool(is_empty),
+                },
+            )
+    return bed
+
+
+def renderMatrix(args, make_bed, directory, name_x, name_y, is_pairwise, grid, key):
+    """
+    Render stage task for one finished matrix: export it with `make_bed`, keep its
+    bedpe rows under `key` when it is part of the grid, then plot it.
+    """
+    bed = make_bed()
+    if key is not None:
+        grid[key] = bed
+    if (not args.no_plot) and (not args.grid_only):
+        plotMatrix(args, bed, directory, name_x, name_y, is_pairwise)
+
+
+def addPlotArguments(parser):
+    """
+    Plot customization arguments shared by the static and merge commands.
+    """
+    parser.add_argument(
+        "--no-hist", action="store_true", help="Skip output of histogram color legend."
+    )
+
+    parser.add_argument(
+        "--width", default=9, type=float, help="Plot width (also height for _FULL)."
+    )
+
+    parser.add_argument("--dpi", default=300, type=int, help="Plot dpi.")
+
+    # TODO: Create list of accepted colors.
+    parser.add_argument(
+        "--palette",
+        default="Spectral_11",
+        help="Select color palette. See RColorBrewer for list of accepted palettes. Will default to Spectral_11 if not used.",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--palette-orientation",
+        default="+",
+        choices=["+", "-"],
+        help="Color palette orientation. + for forward, - for reverse.",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--colors",
+        default=None,
+        nargs="+",
+        help="Use a custom color palette, entered in either hexcode or rgb format.",
+    )
+
+    parser.add_argument(
+        "--breakpoints",
+        default=None,
+        nargs="+",
+        help="Introduce custom color thresholds. Must be between identity threshold and 100.",
+    )
+
+    parser.add_argument(
+        "-a",
+        "--axes-limits",
+        default=None,
+        type=float,
+        help="Change x and y axis limits for self identity plots. Default is length of the sequence. Can't be shorter than length of sequence.",
+    )
+
+    parser.add_argument(
+        "-t",
+        "--axes-ticks",
+        default=None,
+        nargs="+",
+        type=int,
+        help="Tick labels to include in x and y axis for custom plots.",
+    )
+    # CURRENTLY NOT WORKING
+    parser.add_argument(
+        "--axes-number",
+        default=7,
+        help="Number of axis ticks labels to include in x and y axis for custom plots, including 0 and seq_length. A minimum of 2 is required, maximum 25.",
+    )
+
+    parser.add_argument(
+        "--bin-freq",
+        action="store_true",
+        help="By default, histograms are evenly spaced based on the number of colors and the identity threshold. Select this argument to bin based on the frequency of observed identity values.",
+    )
+
+    parser.add_argument(
+        "--vector",
+        choices=["svg", "pdf", "ps"],
+        default="svg",
+        help="Output format for vector format.",
+    )
+
+    parser.add_argument(
+        "--deraster",
+        action="store_true",
+        help="De-rasterize dotplot in vector format. Note this can lead to large image sizes and make it unusable in image editing software.",
+    )
 
 
 def get_parser():
@@ -40,12 +582,15 @@ def get_parser():
         description="ModDotPlot: Visualization of Tandem Repeats",
     )
     subparsers = parser.add_subparsers(
-        dest="command", help="Choose mode: interactive or static"
+        dest="command", help="Choose mode: interactive, static or merge"
     )
     interactive_parser = subparsers.add_parser(
         "interactive", help="Interactive mode commands"
     )
     static_parser = subparsers.add_parser("static", help="Static mode commands")
+    merge_parser = subparsers.add_parser(
+        "merge", help="Combine static mode shards into the final outputs"
+    )
 
     # -----------INTERACTIVE MODE SUBCOMMANDS-----------
     interactive_input_group = interactive_parser.add_mutually_exclusive_group(
@@ -56,7 +601,7 @@ def get_parser():
         "-f",
         "--fasta",
         default=argparse.SUPPRESS,
-        help="Path to input fasta file(s).",
+        help="Path to input fasta (plain or bgzip) or .2bit file(s).",
         nargs="+",
     )
 
@@ -148,6 +693,20 @@ def get_parser():
         help="Port number for launching interactive mode on localhost. Only used in interactive mode.",
     )
 
+    interactive_parser.add_argument(
+        "--cache-size",
+        default=VIEWPORT_CACHE_MB,
+        type=int,
+        help=f"Memory, in MB, for keeping rendered views so returning to them is instant. Default is {VIEWPORT_CACHE_MB}.",
+    )
+
+    interactive_parser.add_argument(
+        "--max-matrices",
+        default=PYRAMID_CAPACITY,
+        type=int,
+        help=f"Number of matrices kept in memory at once. Others are rebuilt when selected again. Default is {PYRAMID_CAPACITY}.",
+    )
+
     interactive_parser.add_argument(
         "--ambiguous",
         action="store_true",
@@ -167,6 +726,31 @@ def get_parser():
         help="Prevent launching dash after saving. Must be used in combination with --save.",
     )
 
+    interactive_parser.add_argument(
+        "--threads",
+        default=None,
+        type=int,
+        help="Number of processes used to hash input sequences in parallel, one sequence per process. Defaults to all available cores.",
+    )
+
+    interactive_parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Hide progress bars. Progress bars are also hidden when output is not a terminal.",
+    )
+
+    interactive_parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Report wall time, CPU time, items processed and peak memory for each stage. Saved as JSON lines to moddotplot_profile.jsonl in the output directory.",
+    )
+
+    interactive_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Keep hashed sequences until the run completes, and reuse hashed sequences and layers left by an earlier run with --save and --resume in the same output directory.",
+    )
+
     # -----------STATIC MODE SUBCOMMANDS-----------
     static_input_group = static_parser.add_mutually_exclusive_group(required=True)
     static_input_group.add_argument(
@@ -189,7 +773,7 @@ def get_parser():
         "-f",
         "--fasta",
         default=argparse.SUPPRESS,
-        help="Path to input fasta file(s).",
+        help="Path to input fasta (plain or bgzip) or .2bit file(s).",
         nargs="+",
     )
 
@@ -252,6 +836,27 @@ def get_parser():
         help="Fraction of neighboring partition to include in identity estimation. Must be between 0 and 1, use > 0.5 is not recommended.",
     )
 
+    static_parser.add_argument(
+        "--max-distance",
+        default=None,
+        type=parseGenomicDistance,
+        help="Only compare windows at most this far apart in self-identity plots (e.g. 5Mbp). Runtime and memory become linear in sequence length. Useful for tandem repeats in whole chromosomes.",
+    )
+
+    static_parser.add_argument(
+        "--tile-size",
+        default=None,
+        type=int,
+        help="Compute identity matrices in tiles of this many windows per side, streaming each tile to the bedpe (and cooler) file instead of holding the full matrix in memory. Use for resolutions too large to fit in RAM. Bedpe files are always written in this mode.",
+    )
+
+    static_parser.add_argument(
+        "--shard",
+        default=None,
+        type=parseShard,
+        help="Only compute shard i of N, e.g. 0/4. Tile t of each matrix belongs to shard t %% N, so shards can run as separate processes or cluster jobs. Writes a partial bedpe and a JSON sidecar per matrix; combine them with `moddotplot merge`. Implies tiled computation (see --tile-size).",
+    )
+
     static_parser.add_argument(
         "-o",
         "--output-dir",
@@ -290,141 +895,160 @@ def get_parser():
         "--no-plot", action="store_true", help="Skip output of plots."
     )
 
-    static_parser.add_argument(
-        "--no-hist", action="store_true", help="Skip output of histogram color legend."
-    )
+    addPlotArguments(static_parser)
 
     static_parser.add_argument(
-        "--width", default=9, type=float, help="Plot width (also height for _FULL)."
+        "--ambiguous",
+        action="store_true",
+        help="Preserve diagonal when handling strings of ambiguous homopolymers (eg. long runs of N's).",
     )
 
-    static_parser.add_argument("--dpi", default=300, type=int, help="Plot dpi.")
-
-    # TODO: Create list of accepted colors.
     static_parser.add_argument(
-        "--palette",
-        default="Spectral_11",
-        help="Select color palette. See RColorBrewer for list of accepted palettes. Will default to Spectral_11 if not used.",
-        type=str,
+        "--grid",
+        action="store_true",
+        help="Plot comparative plots in an NxN grid like format.",
     )
 
     static_parser.add_argument(
-        "--palette-orientation",
-        default="+",
-        choices=["+", "-"],
-        help="Color palette orientation. + for forward, - for reverse.",
-        type=str,
+        "--grid-only",
+        action="store_true",
+        help="Plot comparative plots in an NxN grid like format, skipping individual plots.",
     )
 
     static_parser.add_argument(
-        "--colors",
+        "--threads",
         default=None,
-        nargs="+",
-        help="Use a custom color palette, entered in either hexcode or rgb format.",
+        type=int,
+        help="Number of processes used to hash input sequences in parallel, one sequence per process. Defaults to all available cores.",
     )
 
     static_parser.add_argument(
-        "--breakpoints",
-        default=None,
-        nargs="+",
-        help="Introduce custom color thresholds. Must be between identity threshold and 100.",
+        "--quiet",
+        action="store_true",
+        help="Hide progress bars. Progress bars are also hidden when output is not a terminal.",
     )
 
     static_parser.add_argument(
-        "-a",
-        "--axes-limits",
-        default=None,
-        type=float,
-        help="Change x and y axis limits for self identity plots. Default is length of the sequence. Can't be shorter than length of sequence.",
+        "--profile",
+        action="store_true",
+        help="Report wall time, CPU time, items processed and peak memory for each stage. Saved as JSON lines to moddotplot_profile.jsonl in the output directory.",
     )
 
     static_parser.add_argument(
-        "-t",
-        "--axes-ticks",
-        default=None,
-        nargs="+",
-        type=int,
-        help="Tick labels to include in x and y axis for custom plots.",
-    )
-    # CURRENTLY NOT WORKING
-    static_parser.add_argument(
-        "--axes-number",
-        default=7,
-        help="Number of axis ticks labels to include in x and y axis for custom plots, including 0 and seq_length. A minimum of 2 is required, maximum 25.",
+        "--resume",
+        action="store_true",
+        help="Save checkpoints as the run goes, and reuse the hashed sequences, matrices and rows of tiles finished by an earlier run with --resume and the same parameters in the same output directory.",
     )
 
-    static_parser.add_argument(
-        "--bin-freq",
-        action="store_true",
-        help="By default, histograms are evenly spaced based on the number of colors and the identity threshold. Select this argument to bin based on the frequency of observed identity values.",
+    # -----------MERGE SUBCOMMANDS-----------
+    merge_parser.add_argument(
+        "-i",
+        "--input",
+        required=True,
+        nargs="+",
+        help="Shard sidecar (.json) files, or directories to search for them. Usually the output directory of the sharded static runs.",
     )
 
-    static_parser.add_argument(
-        "--ambiguous",
-        action="store_true",
-        help="Preserve diagonal when handling strings of ambiguous homopolymers (eg. long runs of N's).",
+    merge_parser.add_argument(
+        "-o",
+        "--output-dir",
+        default=None,
+        help="Directory name for saving merged bed files and plots. Defaults to the directory holding each set of shards.",
     )
 
-    static_parser.add_argument(
-        "--grid",
-        action="store_true",
-        help="Plot comparative plots in an NxN grid like format.",
+    merge_parser.add_argument("-b", "--bed", default=None, help="Bed file annotation.")
+
+    merge_parser.add_argument(
+        "--cooler", action="store_true", help="Output matrix to cooler file."
     )
 
-    static_parser.add_argument(
-        "--grid-only",
-        action="store_true",
-        help="Plot comparative plots in an NxN grid like format, skipping individual plots.",
+    merge_parser.add_argument(
+        "--no-plot", action="store_true", help="Skip output of plots."
     )
 
-    static_parser.add_argument(
-        "--vector",
-        choices=["svg", "pdf", "ps"],
-        default="svg",
-        help="Output format for vector format.",
+    addPlotArguments(merge_parser)
+
+    merge_parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Hide progress bars. Progress bars are also hidden when output is not a terminal.",
     )
 
-    static_parser.add_argument(
-        "--deraster",
+    merge_parser.add_argument(
+        "--profile",
         action="store_true",
-        help="De-rasterize dotplot in vector format. Note this can lead to large image sizes and make it unusable in image editing software.",
+        help="Report wall time, CPU time, items processed and peak memory for each stage. Saved as JSON lines to moddotplot_profile.jsonl in the output directory.",
     )
 
     return parser
 
 
+def loadSession(folder_path, mmap=False):
+    """
+    Everything run_dash needs to serve an interactive session saved with --save.
+
+    Returns:
+        Tuple: (matrices, metadata, axes, sparsity), see extractFiles for `mmap`.
+    """
+    matrices, metadata = extractFiles(folder_path, mmap=mmap)
+    sparsity = math.ceil(
+        (metadata[0]["max_window_size"] + 1) / metadata[0]["resolution"]
+    )
+    sparsity = 2 ** math.floor(math.log2(sparsity))
+    axes = []
+    for i in range(len(matrices)):
+        matrix_axes = []
+        for matrix in matrices[i]:
+            # Rows run along the y axis, columns along the x axis
+            x_axis = [
+                j * round(metadata[i]["x_size"] / matrix.shape[1])
+                for j in range(matrix.shape[1])
+            ]
+            y_axis = [
+                j * round(metadata[i]["y_size"] / matrix.shape[0])
+                for j in range(matrix.shape[0])
+            ]
+            x_axis.append(metadata[i]["x_size"])
+            y_axis.append(metadata[i]["y_size"])
+            matrix_axes.append(x_axis)
+            matrix_axes.append(y_axis)
+        axes.append(matrix_axes)
+    return matrices, metadata, axes, sparsity
+
+
+def sessionServer(
+    folder_path, identity=86.0, output_dir=None, cache_size=VIEWPORT_CACHE_MB
+):
+    """
+    WSGI application serving a saved interactive session, for multi-process
+    servers such as gunicorn:
+
+        gunicorn -w 4 -b 0.0.0.0:8050 "moddotplot.moddotplot:sessionServer('interactive_matrices')"
+
+    Each worker memory-maps the same saved layers rather than loading its own
+    copy. Rendered views are cached per worker, `cache_size` MB each.
+    """
+    matrices, metadata, axes, sparsity = loadSession(folder_path, mmap=True)
+    app = create_app(
+        matrices, metadata, axes, sparsity, identity, output_dir, cache_size
+    )
+    return app.server
+
+
 def main():
     print(ASCII_ART)
     print(f"v{VERSION} \n")
     args = get_parser().parse_args()
+    if args.profile:
+        PROFILER.enable()
+    setQuiet(args.quiet)
     # -----------MUTUALLY EXCLUSIVE: INTERACTIVE OR STATIC MODE-----------
     if args.command == "interactive":
         print(f"Running ModDotPlot in interactive mode\n")
         # -----------LOAD MATRICES FOR INTERACTIVE MODE-----------
         if hasattr(args, "load") and args.load:
             print(f"Loading matrix hierarchy from {args.load}... \n")
-            matrices, metadata = extractFiles(args.load)
-            sparsity = math.ceil(
-                (metadata[0]["max_window_size"] + 1) / metadata[0]["resolution"]
-            )
-            sparsity = 2 ** math.floor(math.log2(sparsity))
-            axes = []
-            for i in range(len(matrices)):
-                matrix_axes = []
-                for matrix in matrices[i]:
-                    x_axis = [
-                        j * round(metadata[i]["x_size"] / matrix.shape[0])
-                        for j in range(matrix.shape[0])
-                    ]
-                    y_axis = [
-                        j * round(metadata[i]["y_size"] / matrix.shape[1])
-                        for j in range(matrix.shape[1])
-                    ]
-                    x_axis.append(metadata[i]["x_size"])
-                    y_axis.append(metadata[i]["y_size"])
-                    matrix_axes.append(x_axis)
-                    matrix_axes.append(y_axis)
-                axes.append(matrix_axes)
+            matrices, metadata, axes, sparsity = loadSession(args.load)
             run_dash(
                 matrices,
                 metadata,
@@ -433,6 +1057,7 @@ def main():
                 args.identity,
                 args.port,
                 args.output_dir,
+                args.cache_size,
             )
             sys.exit(0)
     elif args.command == "static":
@@ -454,6 +1079,8 @@ def main():
                 args.window = config.get("window", args.window)
                 args.identity = config.get("identity", args.identity)
                 args.delta = config.get("delta", args.delta)
+                if config.get("max_distance"):
+                    args.max_distance = parseGenomicDistance(config["max_distance"])
                 args.output_dir = config.get("output_dir", args.output_dir)
                 args.compare = config.get("compare", args.compare)
                 args.compare_only = config.get("compare_only", args.compare_only)
@@ -476,6 +1103,16 @@ def main():
                 args.axes_ticks = config.get("axes_ticks", args.axes_ticks)
                 args.vector = config.get("vector", args.vector)
                 args.deraster = config.get("deraster", args.deraster)
+                args.profile = config.get("profile", args.profile)
+                args.quiet = config.get("quiet", args.quiet)
+                args.threads = config.get("threads", args.threads)
+                args.tile_size = config.get("tile_size", args.tile_size)
+                args.resume = config.get("resume", args.resume)
+                if config.get("shard"):
+                    args.shard = parseShard(config["shard"])
+                setQuiet(args.quiet)
+                if args.profile:
+                    PROFILER.enable()
 
         # -----------INPUT COMMAND VALIDATION-----------
         # TODO: More tests!
@@ -492,6 +1129,20 @@ def main():
                 # Exit code 2: breakpoint value != identity threshold
                 sys.exit(2)
 
+        if args.shard:
+            # Each shard only holds part of every matrix, so whole-matrix outputs are
+            # left to `moddotplot merge`.
+            if not args.tile_size:
+                args.tile_size = DEFAULT_TILE_SIZE
+            if args.cooler or args.grid or args.grid_only or not args.no_plot:
+                print(
+                    f"Computing shard {args.shard[0]} of {args.shard[1]}. Cooler files, plots and grids are created by `moddotplot merge` once all shards are done.\n"
+                )
+            args.cooler = False
+            args.grid = False
+            args.grid_only = False
+            args.no_plot = True
+
         # -----------BEDFILE INPUT FOR STATIC MODE-----------
         if hasattr(args, "load") and args.load:
             if args.grid or args.grid_only:
@@ -519,28 +1170,29 @@ def main():
                     os.makedirs(args.output_dir)
                 if len(self_id_scores) > 1:
                     if not args.grid_only:
-                        create_plots(
-                            sdf=None,
-                            directory=args.output_dir if args.output_dir else ".",
-                            name_x=unique_query_names[0],
-                            name_y=unique_query_names[0],
-                            palette=args.palette,
-                            palette_orientation=args.palette_orientation,
-                            no_hist=args.no_hist,
-                            width=args.width,
-                            dpi=args.dpi,
-                            is_freq=args.bin_freq,
-                            xlim=args.axes_limits,
-                            custom_colors=args.colors,
-                            custom_breakpoints=args.breakpoints,
-                            from_file=df,
-                            is_pairwise=False,
-                            axes_labels=args.axes_ticks,
-                            axes_tick_number=args.axes_number,
-                            vector_format=args.vector,
-                            deraster=args.deraster,
-                            annotation=args.bed,
-                        )
+                        with PROFILER.stage("plot", label=unique_query_names[0]):
+                            create_plots(
+                                sdf=None,
+                                directory=args.output_dir if args.output_dir else ".",
+                                name_x=unique_query_names[0],
+                                name_y=unique_query_names[0],
+                                palette=args.palette,
+                                palette_orientation=args.palette_orientation,
+                                no_hist=args.no_hist,
+                                width=args.width,
+                                dpi=args.dpi,
+                                is_freq=args.bin_freq,
+                                xlim=args.axes_limits,
+                                custom_colors=args.colors,
+                                custom_breakpoints=args.breakpoints,
+                                from_file=df,
+                                is_pairwise=False,
+                                axes_labels=args.axes_ticks,
+                                axes_tick_number=args.axes_number,
+                                vector_format=args.vector,
+                                deraster=args.deraster,
+                                annotation=args.bed,
+                            )
                     if args.grid or args.grid_only:
                         single_vals.append(df)
                         single_val_name.append(unique_query_names[0])
@@ -557,28 +1209,32 @@ def main():
                 if len(pairwise_id_scores) > 1:
                     if not args.grid_only:
                         # Potentially sort
-                        create_plots(
-                            sdf=None,
-                            directory=args.output_dir if args.output_dir else ".",
-                            name_x=unique_query_names[0],
-                            name_y=unique_reference_names[0],
-                            palette=args.palette,
-                            palette_orientation=args.palette_orientation,
-                            no_hist=args.no_hist,
-                            width=args.width,
-                            dpi=args.dpi,
-                            is_freq=args.bin_freq,
-                            xlim=args.axes_limits,
-                            custom_colors=args.colors,
-                            custom_breakpoints=args.axes_ticks,
-                            from_file=df,
-                            is_pairwise=True,
-                            axes_labels=args.axes_ticks,
-                            axes_tick_number=args.axes_number,
-                            vector_format=args.vector,
-                            deraster=args.deraster,
-                            annotation=args.bed,
-                        )
+                        with PROFILER.stage(
+                            "plot",
+                            label=f"{unique_query_names[0]}_{unique_reference_names[0]}",
+                        ):
+                            create_plots(
+                                sdf=None,
+                                directory=args.output_dir if args.output_dir else ".",
+                                name_x=unique_query_names[0],
+                                name_y=unique_reference_names[0],
+                                palette=args.palette,
+                                palette_orientation=args.palette_orientation,
+                                no_hist=args.no_hist,
+                                width=args.width,
+                                dpi=args.dpi,
+                                is_freq=args.bin_freq,
+                                xlim=args.axes_limits,
+                                custom_colors=args.colors,
+                                custom_breakpoints=args.axes_ticks,
+                                from_file=df,
+                                is_pairwise=True,
+                                axes_labels=args.axes_ticks,
+                                axes_tick_number=args.axes_number,
+                                vector_format=args.vector,
+                                deraster=args.deraster,
+                                annotation=args.bed,
+                            )
                     if args.grid or args.grid_only:
                         double_vals.append(df)
                         double_val_name.append(
@@ -592,53 +1248,127 @@ def main():
                 print(
                     f"Creating a {len(single_val_name)}x{len(single_val_name)} grid.\n"
                 )
-                create_grid(
-                    singles=single_vals,
-                    doubles=double_vals,
-                    directory=args.output_dir if args.output_dir else ".",
+                with PROFILER.stage("grid", items=len(single_val_name)):
+                    create_grid(
+                        singles=single_vals,
+                        doubles=double_vals,
+                        directory=args.output_dir if args.output_dir else ".",
+                        palette=args.palette,
+                        palette_orientation=args.palette_orientation,
+                        single_names=single_val_name,
+                        double_names=double_val_name,
+                        is_freq=args.bin_freq,
+                        xlim=xlim_val_grid,
+                        custom_colors=args.colors,
+                        custom_breakpoints=args.axes_ticks,
+                        axes_label=args.axes_ticks,
+                        is_bed=True,
+                        width=args.width,
+                        breaks=args.axes_ticks,
+                        deraster=args.deraster,
+                        vector_format=args.vector,
+                    )
+            PROFILER.report(args.output_dir)
+            sys.exit(0)
+    elif args.command == "merge":
+        print(f"Running ModDotPlot in merge mode\n")
+        # -----------MERGE STATIC MODE SHARDS-----------
+        sidecars = findShardSidecars(args.input)
+        if not sidecars:
+            print(f"No shards found in {' '.join(args.input)}.\n")
+            sys.exit(7)
+        try:
+            merged = mergeShards(sidecars, args.output_dir, args.cooler)
+        except (ValueError, OSError) as e:
+            # Exit code 7: missing, incomplete or inconsistent shards
+            print(f"Unable to merge shards: {e}\n")
+            sys.exit(7)
+        for bedfile_output, metadata, written in merged:
+            print(
+                f"Merged {metadata['shards']} shards into a paired-end bed file at {bedfile_output}\n"
+            )
+            if args.cooler:
+                print(
+                    f"Saved matrix as a cooler file to {os.path.join(os.path.dirname(bedfile_output), metadata['cooler'])}\n"
+                )
+            if args.no_plot:
+                continue
+            if written == 0 and not metadata["self_identity"]:
+                print(
+                    f"The pairwise identity matrix for {metadata['x_name']} and {metadata['y_name']} is empty. Skipping.\n"
+                )
+                continue
+            with PROFILER.stage(
+                "plot", label=os.path.splitext(os.path.basename(bedfile_output))[0]
+            ):
+                create_plots(
+                    sdf=[readBedpe(bedfile_output)],
+                    directory=os.path.dirname(bedfile_output),
+                    name_x=metadata["x_name"],
+                    name_y=metadata["y_name"],
                     palette=args.palette,
                     palette_orientation=args.palette_orientation,
-                    single_names=single_val_name,
-                    double_names=double_val_name,
+                    no_hist=args.no_hist,
+                    width=args.width,
+                    dpi=args.dpi,
                     is_freq=args.bin_freq,
-                    xlim=xlim_val_grid,
+                    xlim=args.axes_limits,
                     custom_colors=args.colors,
-                    custom_breakpoints=args.axes_ticks,
-                    axes_label=args.axes_ticks,
-                    is_bed=True,
-                    width=args.width,
-                    breaks=args.axes_ticks,
-                    deraster=args.deraster,
+                    custom_breakpoints=args.breakpoints,
+                    from_file=None,
+                    is_pairwise=not metadata["self_identity"],
+                    axes_labels=args.axes_ticks,
+                    axes_tick_number=args.axes_number,
                     vector_format=args.vector,
+                    deraster=args.deraster,
+                    annotation=args.bed,
                 )
-            sys.exit(0)
+        PROFILER.report(args.output_dir)
+        sys.exit(0)
 
     # -----------INPUT SEQUENCE VALIDATION-----------
     seq_list = []
+    # Input file of each sequence, used to tell whether a checkpoint is still valid
+    seq_stamps = {}
     fasta_list = args.fasta.copy()
-    for i in args.fasta:
-        try:
-            isValidFasta(i)
-            headers = getInputHeaders(i)
-
-            if len(headers) > 1:
-                print(f"File {i} contains multiple fasta entries.\n")
-
-            seq_list.extend(headers)  # Add all headers to seq_list
-
-        except Exception as e:
-            print(
-                f"\nUnable to open {i}. Please check it is correctly formatted or compressed...\n"
-            )
-            fasta_list.remove(i)
+    with PROFILER.stage("fasta_load") as stage:
+        for i in args.fasta:
+            try:
+                # Indexes the file once; names and lengths are cached from here on
+                if not isValidFasta(i):
+                    raise ValueError(f"{i} has no indexable sequences")
+                headers = getInputHeaders(i)
+
+                if len(headers) > 1:
+                    print(f"File {i} contains multiple fasta entries.\n")
+
+                seq_list.extend(headers)  # Add all headers to seq_list
+                for header in headers:
+                    seq_stamps[header] = fileStamp(i)
+
+            except Exception as e:
+                print(
+                    f"\nUnable to open {i}. Please check it is correctly formatted or compressed...\n"
+                )
+                fasta_list.remove(i)
+        stage["items"] = len(seq_list)
 
     # -----------LOAD SEQUENCES INTO MEMORY-----------
-    kmer_list = []
-    for i in fasta_list:
-        kmer_list.append(readKmersFromFile(i, args.kmer, False))
-    k_list = [item for sublist in kmer_list for item in sublist]
+    if not args.threads:
+        args.threads = availableCores()
+    # Keep hashed sequences until the run is done, if there's something to resume
+    kmer_checkpoint = None
+    if args.resume and (
+        (args.command == "static" and not args.shard)
+        or (args.command == "interactive" and args.save)
+    ):
+        kmer_checkpoint = Checkpoint(
+            os.path.join(args.output_dir or ".", KMER_CHECKPOINT_DIR),
+            {"kmer": args.kmer},
+        )
+    jobs = listSequences(fasta_list, args.kmer)
     # Throw error if compare only selected with one sequence.
-    if len(k_list) < 2 and args.compare_only:
+    if len(jobs) < 2 and args.compare_only:
         print(
             f"Error: Can't create a comparative plot with only one sequence. Please re-run without --compare-only."
         )
@@ -646,8 +1376,15 @@ def main():
 
     # -----------LAUNCH INTERACTIVE MODE-----------
     if args.command == "interactive":
+        with PROFILER.stage("hashing", label=f"{args.threads} processes") as stage:
+            k_list = list(
+                iterKmersFromFiles(
+                    jobs, args.kmer, args.quiet, args.threads, kmer_checkpoint
+                )
+            )
+            stage["items"] = sum(len(kmers) for kmers in k_list)
         # Single sequence, can set window length immediately.
-        hgi = len(max(k_list))
+        hgi = max(len(kmers) for kmers in k_list)
         hgi = hgi + args.kmer - 1
         min_window_size = 0
         window_lengths = []
@@ -674,16 +1411,8 @@ def main():
             window_lengths.append(min_window_size)
             min_window_size = min_window_size * 2
 
-        # Set warning if >2 sequences detected
-        if len(seq_list) > 2:
-            print(
-                f"{len(seq_list)} sequences were detected, however interactive mode can only load two sequences at a time.\n"
-            )
-            print(
-                f"Interactive mode will proceed with {seq_list[0]} and {seq_list[1]}\n"
-            )
-        # Set warning if <1 sequence detected
-        elif len(seq_list) < 1:
+        # Set error if <1 sequence detected
+        if len(seq_list) < 1:
             print(f"Error: No sequences detected!")
             sys.exit(5)
 
@@ -704,242 +1433,149 @@ def main():
             else:
                 sparsities.append(1)
         expectation = round(window_lengths[-1] / sparsities[-1])
-        matrices = []
-        metadata = []
-        # -----------BUILD IMAGE PYRAMID FOR SELF MATRICES-----------
-        if not args.compare_only:
-            for j in range(min(len(seq_list), 2)):
-                image_pyramid = []
-                if args.quick or len(window_lengths) == 1:
-                    print(
-                        f"Building 1 self-identity matrix for {seq_list[j]}, using a window size of {window_lengths[0]}.... \n"
-                    )
-                else:
-                    print(
-                        f"Building {len(window_lengths)} self-identity matrices for {seq_list[j]}, using a minimum window size of {window_lengths[0]}.... \n"
-                    )
-                if not args.quick:
-                    print(
-                        f"Creating base layer using window length {window_lengths[0]}...\n"
-                    )
-
-                for i in range(len(window_lengths)):
-                    layer_sparsity = sparsities[i]
-                    layer_window_size = window_lengths[i]
-                    layer_neigh = partitionOverlaps(
-                        k_list[j],
-                        layer_window_size,
-                        args.delta,
-                        len(k_list[j]),
-                        args.kmer,
-                    )
-                    layer_sing = partitionOverlaps(
-                        k_list[j], layer_window_size, 0, len(k_list[j]), args.kmer
-                    )
-
-                    mods_neigh = convertToModimizers(
-                        layer_neigh,
-                        layer_sparsity,
-                        args.ambiguous,
-                        args.kmer,
-                        expectation,
-                    )
-                    mods_sing = convertToModimizers(
-                        layer_sing,
-                        layer_sparsity,
-                        args.ambiguous,
-                        args.kmer,
-                        expectation,
-                    )
-                    if not args.quick and i > 0:
-                        print(f"Layer {i+1} using window length {layer_window_size}\n")
-                    matrix_layer = selfContainmentMatrix(
-                        mods_sing, mods_neigh, args.kmer, args.identity, args.ambiguous
-                    )
-                    image_pyramid.insert(0, matrix_layer)
-                matrices.append(image_pyramid)
-                metadata.append(
-                    {
-                        "x_name": seq_list[j],
-                        "y_name": seq_list[j],
-                        "x_size": len(k_list[j]) + args.kmer - 1,
-                        "y_size": len(k_list[j]) + args.kmer - 1,
-                        "self": True,
-                        "min_window_size": window_lengths[0],
-                        "max_window_size": window_lengths[-1],
-                        "resolution": args.resolution,
-                        "kmer_length": args.kmer,
-                        "title": f"{seq_list[j]}",
-                        "sparsities": sparsities,
-                    }
-                )
-        # -----------BUILD IMAGE PYRAMID FOR COMPARATIVE MATRICES-----------
-        if (args.compare or args.compare_only) and len(seq_list) > 1:
-            # Determine which is smaller, which is larger
-            larger_name = ""
-            smaller_name = ""
-            larger_seq = []
-            smaller_seq = []
-            if len(k_list[0]) > len(k_list[1]):
-                larger_name = seq_list[0]
-                larger_seq = k_list[0]
-                smaller_name = seq_list[1]
-                smaller_seq = k_list[1]
-            else:
-                larger_name = seq_list[1]
-                larger_seq = k_list[1]
-                smaller_name = seq_list[0]
-                smaller_seq = k_list[0]
-            if args.quick:
-                print(
-                    f"Quickly building pairwise matrices for {seq_list[0]} and {seq_list[1]}, using a window size of {window_lengths[0]}.... \n"
-                )
-            else:
-                print(
-                    f"Building pairwise matrices for {seq_list[0]} and {seq_list[1]}, using a minimum window size of {window_lengths[0]}.... \n"
-                )
-            image_pyramid = []
-            for i in range(len(window_lengths)):
-                layer_sparsity = sparsities[i]
-                layer_window_size = window_lengths[i]
-                larger_neigh = partitionOverlaps(
-                    larger_seq,
-                    layer_window_size,
-                    args.delta,
-                    len(larger_seq),
-                    args.kmer,
-                )
-                larger_sing = partitionOverlaps(
-                    larger_seq, layer_window_size, 0, len(larger_seq), args.kmer
-                )
-                smaller_neigh = partitionOverlaps(
-                    smaller_seq,
-                    layer_window_size,
-                    args.delta,
-                    len(smaller_seq),
-                    args.kmer,
-                )
-                smaller_sing = partitionOverlaps(
-                    smaller_seq, layer_window_size, 0, len(smaller_seq), args.kmer
-                )
-
-                larger_mods_neigh = convertToModimizers(
-                    larger_neigh, layer_sparsity, args.ambiguous, args.kmer, expectation
-                )
-                larger_mods_sing = convertToModimizers(
-                    larger_sing, layer_sparsity, args.ambiguous, args.kmer, expectation
-                )
-                smaller_mods_neigh = convertToModimizers(
-                    smaller_neigh,
-                    layer_sparsity,
-                    args.ambiguous,
-                    args.kmer,
-                    expectation,
-                )
-                smaller_mods_sing = convertToModimizers(
-                    smaller_sing, layer_sparsity, args.ambiguous, args.kmer, expectation
-                )
-                if not args.quick:
-                    print(f"Layer {i+1} using window length {layer_window_size}\n")
-                matrix_layer = pairwiseContainmentMatrix(
-                    larger_mods_sing,
-                    smaller_mods_sing,
-                    larger_mods_neigh,
-                    smaller_mods_neigh,
-                    args.identity,
-                    args.kmer,
-                    False,
-                )
-                image_pyramid.insert(0, matrix_layer)
-            matrices.append(image_pyramid)
-            metadata.append(
-                {
-                    "x_name": larger_name,
-                    "y_name": smaller_name,
-                    "x_size": len(larger_seq) + args.kmer - 1,
-                    "y_size": len(smaller_seq) + args.kmer - 1,
-                    "self": False,
-                    "min_window_size": window_lengths[0],
-                    "max_window_size": window_lengths[-1],
-                    "resolution": args.resolution,
-                    "kmer_length": args.kmer,
-                    "title": f"{larger_name}-{smaller_name}",
-                    "sparsities": sparsities,
-                }
-            )
-
+        seq_lengths = [len(kmers) for kmers in k_list]
+        layer_checkpoint = None
         if args.save:
-            # Check if this value already exists
+            # Layers are saved as soon as they are computed, so an interrupted run can
+            # pick up where it left off.
             if not args.output_dir:
                 args.output_dir = os.getcwd()
             folder_path = os.path.join(args.output_dir, "interactive_matrices")
-            if not os.path.exists(folder_path):
-                print(f"Saving interactive matrices in {folder_path}\n")
-                os.makedirs(folder_path)
-            else:
-                print(f"Saving interactive matrices in {folder_path}\n")
+            print(f"Saving interactive matrices in {folder_path}\n")
+            existing = os.path.exists(folder_path)
+            os.makedirs(folder_path, exist_ok=True)
+            layer_checkpoint = Checkpoint(
+                folder_path,
+                {
+                    "sequences": [
+                        [seq_stamps.get(name), length]
+                        for name, length in zip(seq_list, seq_lengths)
+                    ],
+                    "kmer": args.kmer,
+                    "identity": args.identity,
+                    "delta": args.delta,
+                    "ambiguous": args.ambiguous,
+                    "window_lengths": window_lengths,
+                    "sparsities": sparsities,
+                    "expectation": expectation,
+                },
+                resume=args.resume,
+            )
+            if layer_checkpoint.units:
+                print(
+                    f"Reusing {len(layer_checkpoint.units)} layers finished by an earlier run in {folder_path}\n"
+                )
+            elif existing:
                 print(f"{folder_path} already exists, overwriting its contents.\n")
+        # -----------SKETCH EVERY SEQUENCE-----------
+        # Matrices are built from the sketches alone, so the k-mers can go
+        sketches = {}
+        for name, kmers in zip(seq_list, k_list):
+            sketches[name] = sketchLayers(
+                args, name, kmers, window_lengths, sparsities, expectation
+            )
+        del k_list, kmers
+        metadata = interactiveMetadata(
+            args, seq_list, seq_lengths, window_lengths, sparsities
+        )
+        build = partial(
+            pyramidLayers,
+            args,
+            sketches=sketches,
+            window_lengths=window_lengths,
+            layer_checkpoint=layer_checkpoint,
+        )
+        if args.save:
+            # Saved sessions hold every matrix
+            matrices = PyramidStore.fromPyramids(
+                [list(build(info)) for info in metadata]
+            )
+        else:
+            # Build each matrix when it is first selected, in the background
+            # from its coarsest layer on, so the app starts right away
+            matrices = PyramidStore(
+                lambda index: build(metadata[index]),
+                len(metadata),
+                len(window_lengths),
+                capacity=args.max_matrices,
+            )
 
-            for i in range(len(metadata)):
-                for j in range(len(matrices[i])):
-                    if metadata[i]["self"]:
-                        tmp = f"{metadata[i]['x_name']}_{j}.npz"
-                    else:
-                        tmp = f"{metadata[i]['x_name']}-{metadata[i]['y_name']}_{j}.npz"
-                    saved_path = os.path.join(folder_path, tmp)
-                    np.savez_compressed(saved_path, data=matrices[i][j])
+        if args.save:
             pickle_path = os.path.join(folder_path, "metadata.pkl")
             # Save the dictionary as a pickle file
             with open(pickle_path, "wb") as f:
                 pickle.dump(metadata, f)
+            if kmer_checkpoint:
+                kmer_checkpoint.discard()
             # Check if no plot arg is used
             if args.no_plot:
                 print(
                     f"Saved matrices to {folder_path}. Thank you for using ModDotPlot!\n"
                 )
+                PROFILER.report(args.output_dir)
                 sys.exit(0)
 
-        # Before running dash, change into intervals...
-        axes = []
-        for matrices_set, meta in zip(matrices, metadata):
-            matrix_axes = []
-            for matrix in matrices_set:
-                x_axis = np.linspace(0, meta["x_size"], matrix.shape[0] + 1)
-                y_axis = np.linspace(0, meta["y_size"], matrix.shape[1] + 1)
-                matrix_axes.append(x_axis)
-                matrix_axes.append(y_axis)
-            axes.append(matrix_axes)
+        PROFILER.report(args.output_dir)
         run_dash(
             matrices,
             metadata,
-            axes,
+            None,
             sparsities[0],
             args.identity,
             args.port,
             args.output_dir,
+            args.cache_size,
         )
 
     # -----------SETUP STATIC MODE-----------
     elif args.command == "static":
         # -----------SET SPARSITY VALUE-----------
         if args.grid or args.grid_only:
-            grid_val_singles = []
             grid_val_single_names = []
-        new_sequences = list(zip(seq_list, k_list))
+            grid_val_double_names = []
+            xlim_val_grid = 0
+        # Bedpe rows of grid plots, filled in by the render stage
+        grid_beds = {}
+        grid_keys = []
         if args.compare_order == "size":
-            sequences = sorted(new_sequences, key=lambda seq: len(seq[1]), reverse=True)
-        else:
-            sequences = new_sequences
-        if len(sequences) > 6 and (args.grid or args.grid_only):
+            # Sequences are hashed in this order, so sort on the fasta index lengths
+            jobs = sorted(jobs, key=lambda job: job[3], reverse=True)
+        if len(jobs) > 6 and (args.grid or args.grid_only):
             print("Too many sequences to create a grid. Skipping. \n")
 
         # Create output directory, if doesn't exist:
         if (args.output_dir) and not os.path.exists(args.output_dir):
             os.makedirs(args.output_dir, exist_ok=True)
-        # -----------COMPUTE SELF-IDENTITY PLOTS-----------
-        if not args.compare_only:
-            for i in range(len(sequences)):
-                seq_length = len(sequences[i][1])
+
+        # Hashing the next sequences, computing the current matrix and exporting or
+        # plotting the previous ones all overlap. Both queues in between are bounded.
+        # Name and number of k-mers of each sequence, from the fasta indexes
+        sequences = [(job[2], job[3]) for job in jobs]
+        hashed = []
+        with BackgroundStage("render") as render_stage:
+            kmer_stream = iterKmersFromFiles(
+                jobs,
+                args.kmer,
+                args.quiet,
+                args.threads,
+                kmer_checkpoint,
+                lookahead=PIPELINE_DEPTH,
+            )
+
+            def sequenceKmers(index):
+                # Sequences are only hashed once a matrix needs them, so a rerun
+                # whose matrices were all finished by an earlier run hashes nothing
+                while len(hashed) <= index:
+                    with PROFILER.stage("hashing", label=jobs[len(hashed)][2]) as stage:
+                        hashed.append(next(kmer_stream))
+                        stage["items"] = len(hashed[-1])
+                return hashed[index]
+
+            for i in range(len(jobs)):
+                # -----------COMPUTE SELF-IDENTITY PLOTS-----------
+                if args.compare_only:
+                    continue
+                seq_length = sequences[i][1]
                 seq_name = sequences[i][0]
                 seq_range = extractRegion(seq_name)
                 if seq_range:
@@ -1019,427 +1655,531 @@ def main():
                 print(f"\tWindow size w: {win}\n")
                 print(f"\tModimizer sketch size: {expectation}\n")
                 print(f"\tPlot Resolution r: {res}\n")
-                if args.region and seq_range:
-                    subseq = sequences[i][1][
-                        subseq_start_pos : (subseq_end_pos - args.kmer + 1)
-                    ]
-                    self_mat = createSelfMatrix(
-                        seq_length,
-                        subseq,
-                        win,
-                        seq_sparsity,
-                        args.delta,
-                        args.kmer,
-                        args.identity,
-                        args.ambiguous,
-                        expectation,
-                    )
-                else:
-                    self_mat = createSelfMatrix(
-                        seq_length,
-                        sequences[i][1],
-                        win,
-                        seq_sparsity,
-                        args.delta,
-                        args.kmer,
-                        args.identity,
-                        args.ambiguous,
-                        expectation,
-                    )
-                bed = convertMatrixToBed(
-                    self_mat,
-                    win,
-                    args.identity,
-                    seq_name,
-                    seq_name,
-                    True,
-                    seq_start_pos,
-                    seq_start_pos,
+                if args.max_distance:
+                    print(f"\tMaximum distance: {args.max_distance} bp\n")
+                bedpe_path = os.path.join(args.output_dir or ".", seq_name)
+                checkpoint = matrixCheckpoint(
+                    args,
+                    bedpe_path,
+                    {
+                        "sequence": seq_stamps.get(sequences[i][0]),
+                        "name": seq_name,
+                        "length": seq_length,
+                        "offset": seq_start_pos,
+                        "window": win,
+                        "sparsity": seq_sparsity,
+                        "expectation": expectation,
+                        "max_distance": args.max_distance,
+                    },
                 )
-                if args.grid or args.grid_only:
-                    grid_val_singles.append(bed)
-                    grid_val_single_names.append(seq_name)
-
-                if args.cooler:
-                    try:
-                        cooler_path = "."
-                        if not args.output_dir:
-                            cooler_path = os.path.join(cooler_path, seq_name)
+                record = finishedMatrix(checkpoint, True)
+                if not record:
+                    subseq = sequenceKmers(i)
+                    if args.region and seq_range:
+                        subseq = subseq[
+                            subseq_start_pos : (subseq_end_pos - args.kmer + 1)
+                        ]
+                if record:
+                    bedfile_output = record["bedpe"]
+                    print(
+                        f"Self-identity matrix for {seq_name} was finished by an earlier run, reusing {bedfile_output}\n"
+                    )
+                    if args.shard:
+                        continue
+                    make_bed = partial(readBedpe, bedfile_output)
+                elif args.tile_size:
+                    # Stream tiles straight to disk instead of building the matrix
+                    os.makedirs(bedpe_path, exist_ok=True)
+                    bedfile_output = os.path.join(bedpe_path, seq_name + ".bedpe")
+                    cooler_output = None
+                    if args.cooler:
+                        cooler_output = os.path.join(bedpe_path, seq_name + ".cooler")
+                    with PROFILER.stage("self_identity", label=seq_name):
+                        tiles = createSelfTiles(
+                            seq_length,
+                            subseq,
+                            win,
+                            seq_sparsity,
+                            args.delta,
+                            args.kmer,
+                            args.identity,
+                            args.ambiguous,
+                            expectation,
+                            args.max_distance,
+                        )
+                        if args.shard:
+                            shard_output, _ = writeShard(
+                                tiles,
+                                args.tile_size,
+                                *args.shard,
+                                win,
+                                args.identity,
+                                seq_name,
+                                seq_name,
+                                seq_start_pos,
+                                seq_start_pos,
+                                bedfile_output,
+                                os.path.join(bedpe_path, seq_name + ".cooler"),
+                                {
+                                    "kmer": args.kmer,
+                                    "identity": args.identity,
+                                    "delta": args.delta,
+                                    "sparsity": seq_sparsity,
+                                    "expectation": expectation,
+                                    "ambiguous": args.ambiguous,
+                                    "max_distance": args.max_distance,
+                                },
+                                checkpoint,
+                            )
                         else:
-                            cooler_path = os.path.join(args.output_dir, seq_name)
-                        os.makedirs(cooler_path, exist_ok=True)
-                        cooler_output = os.path.join(cooler_path, seq_name + ".cooler")
-                        convertMatrixToCool(
-                            matrix=self_mat,
-                            window_size=win,
-                            id_threshold=args.identity,
-                            x_name=seq_name,
-                            y_name=seq_name,
-                            self_identity=True,
-                            x_offset=seq_start_pos,
-                            y_offset=seq_start_pos,
-                            chromsizes=seq_length,
-                            output_cool=cooler_output,
+                            writeTiles(
+                                tiles,
+                                tiles.tiles(args.tile_size),
+                                win,
+                                args.identity,
+                                seq_name,
+                                seq_name,
+                                seq_start_pos,
+                                seq_start_pos,
+                                bedfile_output,
+                                cooler_output,
+                                checkpoint,
+                            )
+                    if args.shard:
+                        if checkpoint:
+                            checkpoint.mark("matrix", {"bedpe": shard_output})
+                        print(
+                            f"Saved shard {args.shard[0]} of {args.shard[1]} of the self-identity matrix to {shard_output}\n"
                         )
+                        continue
+                    if checkpoint:
+                        checkpoint.mark(
+                            "matrix", {"bedpe": bedfile_output, "cooler": cooler_output}
+                        )
+                    if cooler_output:
                         print(
                             f"Saved self-identity matrix as a cooler file to {cooler_output}\n"
                         )
-                    except Exception as e:
-                        print(f"Error creating cooler file: {e}")
-
-                if not args.no_bedpe:
-                    # Log saving bed file
-                    bedpe_path = "."
-                    if not args.output_dir:
-                        bedpe_path = os.path.join(bedpe_path, seq_name)
-                        os.makedirs(bedpe_path, exist_ok=True)
-                        bedfile_output = os.path.join(seq_name, seq_name + ".bedpe")
-                    else:
-                        bedpe_path = os.path.join(args.output_dir, seq_name)
-                        os.makedirs(bedpe_path, exist_ok=True)
-                        bedfile_output = os.path.join(bedpe_path, seq_name + ".bedpe")
-
-                    with open(bedfile_output, "w") as bedfile:
-                        for row in bed:
-                            bedfile.write("\t".join(map(str, row)) + "\n")
                     print(
                         f"Saved self-identity matrix as a paired-end bed file to {bedfile_output}\n"
                     )
-
-                if (not args.no_plot) and (not args.grid_only):
-                    create_plots(
-                        sdf=[bed],
-                        directory=bedpe_path,
-                        name_x=seq_name,
-                        name_y=seq_name,
-                        palette=args.palette,
-                        palette_orientation=args.palette_orientation,
-                        no_hist=args.no_hist,
-                        width=args.width,
-                        dpi=args.dpi,
-                        is_freq=args.bin_freq,
-                        xlim=args.axes_limits,
-                        custom_colors=args.colors,
-                        custom_breakpoints=args.breakpoints,
-                        from_file=None,
-                        is_pairwise=False,
-                        axes_labels=args.axes_ticks,
-                        axes_tick_number=args.axes_number,
-                        vector_format=args.vector,
-                        deraster=args.deraster,
-                        annotation=args.bed,
+                    make_bed = partial(readBedpe, bedfile_output)
+                else:
+                    with PROFILER.stage("self_identity", label=seq_name):
+                        self_mat = createSelfMatrix(
+                            seq_length,
+                            subseq,
+                            win,
+                            seq_sparsity,
+                            args.delta,
+                            args.kmer,
+                            args.identity,
+                            args.ambiguous,
+                            expectation,
+                            args.max_distance,
+                        )
+                    make_bed = partial(
+                        exportSelfMatrix,
+                        args,
+                        self_mat,
+                        seq_name,
+                        win,
+                        seq_length,
+                        seq_start_pos,
+                        checkpoint,
                     )
+                    # The render stage now holds the only reference to the matrix
+                    del self_mat
 
-        # -----------COMPUTE COMPARATIVE PLOTS-----------
-        # TODO: Optimize computations so that largest sequence doesn't need to be redone all the time
-        if (args.compare or args.compare_only or args.grid or args.grid_only) and len(
-            sequences
-        ) > 1:
-            # Set window size to args.window. Otherwise, set it to n/resolution
+                grid_key = None
+                if args.grid or args.grid_only:
+                    grid_key = i
+                    grid_keys.append(grid_key)
+                    grid_val_single_names.append(seq_name)
+                # Files on disk only need reading back when something is plotted
+                if (
+                    make_bed.func is exportSelfMatrix
+                    or grid_key is not None
+                    or not args.no_plot
+                ):
+                    render_stage.submit(
+                        renderMatrix,
+                        args,
+                        make_bed,
+                        bedpe_path,
+                        seq_name,
+                        seq_name,
+                        False,
+                        grid_beds,
+                        grid_key,
+                    )
 
-            if args.grid or args.grid_only:
-                grid_val_doubles = []
-                grid_val_double_names = []
-                xlim_val_grid = 0
+            # -----------COMPUTE COMPARATIVE PLOTS-----------
+            # TODO: Optimize computations so that largest sequence doesn't need to be redone all the time
+            if (
+                args.compare or args.compare_only or args.grid or args.grid_only
+            ) and len(sequences) > 1:
+                # Set window size to args.window. Otherwise, set it to n/resolution
+
+                for i in range(len(sequences)):
+                    for j in range(i + 1, len(sequences)):
+                        # Larger = x, smaller = y. This is pre-sorted earlier.
+                        larger_length = sequences[i][1]
+                        smaller_length = sequences[j][1]
+                        larger_seq_name = sequences[i][0]
+                        smaller_seq_name = sequences[j][0]
+                        larger_seq_range = extractRegion(larger_seq_name)
+                        if not larger_seq_range:
+                            larger_seq_start_pos = 1
+                        else:
+                            larger_seq_start_pos = int(larger_seq_range[1])
+                            larger_seq_name = larger_seq_range[0]
+                        smaller_seq_range = extractRegion(smaller_seq_name)
+                        if not smaller_seq_range:
+                            smaller_seq_start_pos = 1
+                        else:
+                            smaller_seq_start_pos = int(smaller_seq_range[1])
+                            smaller_seq_name = smaller_seq_range[0]
 
-            for i in range(len(sequences)):
-                for j in range(i + 1, len(sequences)):
-                    # Larger = x, smaller = y. This is pre-sorted earlier.
-                    larger_seq = sequences[i][1]
-                    smaller_seq = sequences[j][1]
-                    larger_length = len(larger_seq)
-                    smaller_length = len(smaller_seq)
-                    larger_seq_name = sequences[i][0]
-                    smaller_seq_name = sequences[j][0]
-                    larger_seq_range = extractRegion(larger_seq_name)
-                    if not larger_seq_range:
-                        larger_seq_start_pos = 1
-                    else:
-                        larger_seq_start_pos = int(larger_seq_range[1])
-                        larger_seq_name = larger_seq_range[0]
-                    smaller_seq_range = extractRegion(smaller_seq_name)
-                    if not smaller_seq_range:
-                        smaller_seq_start_pos = 1
-                    else:
-                        smaller_seq_start_pos = int(smaller_seq_range[1])
-                        smaller_seq_name = smaller_seq_range[0]
-
-                    try:
-                        if args.region:
-                            subseq_start_pos = None
-                            subseq_end_pos = None
-                            for region in args.region:
-                                chrom, lower_bound, upper_bound = extractRegion(region)
-                                if chrom == larger_seq_name:
-                                    larger_subseq_start_pos = lower_bound
-                                    larger_subseq_end_pos = upper_bound
-                                    larger_seq_start_pos = lower_bound
-                                    # Validate bounds
-                                    if (
-                                        larger_seq_start_pos < 1
-                                        or larger_subseq_end_pos > larger_length
-                                    ):
+                        try:
+                            if args.region:
+                                subseq_start_pos = None
+                                subseq_end_pos = None
+                                for region in args.region:
+                                    chrom, lower_bound, upper_bound = extractRegion(
+                                        region
+                                    )
+                                    if chrom == larger_seq_name:
+                                        larger_subseq_start_pos = lower_bound
+                                        larger_subseq_end_pos = upper_bound
+                                        larger_seq_start_pos = lower_bound
+                                        # Validate bounds
+                                        if (
+                                            larger_seq_start_pos < 1
+                                            or larger_subseq_end_pos > larger_length
+                                        ):
+                                            print(
+                                                f"Error: region {region} is out of bounds for {larger_seq_name}. Will use entire sequence.\n"
+                                            )
+                                            larger_subseq_start_pos = 1
+                                            larger_subseq_end_pos = larger_length
+                                            larger_seq_name = sequences[i][0]
+                                            break
                                         print(
-                                            f"Error: region {region} is out of bounds for {larger_seq_name}. Will use entire sequence.\n"
+                                            f"Using region {larger_seq_name}:{larger_subseq_start_pos}-{larger_subseq_end_pos}\n"
                                         )
-                                        larger_subseq_start_pos = 1
-                                        larger_subseq_end_pos = larger_length
-                                        larger_seq_name = sequences[i][0]
-                                        break
-                                    print(
-                                        f"Using region {larger_seq_name}:{larger_subseq_start_pos}-{larger_subseq_end_pos}\n"
-                                    )
-                                    # Change sequence length, and use a subsequence instead.
-                                    larger_length = (
-                                        larger_subseq_end_pos
-                                        - larger_subseq_start_pos
-                                        + 1
-                                        - args.kmer
-                                    )
-                                    larger_seq_range = (
-                                        larger_seq_name,
-                                        larger_subseq_start_pos,
-                                        larger_subseq_end_pos,
-                                    )
-                                    larger_seq_name = f"{larger_seq_name}:{larger_subseq_start_pos}-{larger_subseq_end_pos}"
-
-                                if chrom == smaller_seq_name:
-                                    smaller_subseq_start_pos = lower_bound
-                                    smaller_subseq_end_pos = upper_bound
-                                    smaller_seq_start_pos = lower_bound
-                                    # Validate bounds
-                                    if (
-                                        smaller_seq_start_pos < 1
-                                        or smaller_subseq_end_pos > smaller_length
-                                    ):
+                                        # Change sequence length, and use a subsequence instead.
+                                        larger_length = (
+                                            larger_subseq_end_pos
+                                            - larger_subseq_start_pos
+                                            + 1
+                                            - args.kmer
+                                        )
+                                        larger_seq_range = (
+                                            larger_seq_name,
+                                            larger_subseq_start_pos,
+                                            larger_subseq_end_pos,
+                                        )
+                                        larger_seq_name = f"{larger_seq_name}:{larger_subseq_start_pos}-{larger_subseq_end_pos}"
+
+                                    if chrom == smaller_seq_name:
+                                        smaller_subseq_start_pos = lower_bound
+                                        smaller_subseq_end_pos = upper_bound
+                                        smaller_seq_start_pos = lower_bound
+                                        # Validate bounds
+                                        if (
+                                            smaller_seq_start_pos < 1
+                                            or smaller_subseq_end_pos > smaller_length
+                                        ):
+                                            print(
+                                                f"Error: region {region} is out of bounds for {smaller_seq_name}. Will use entire sequence.\n"
+                                            )
+                                            smaller_subseq_start_pos = 1
+                                            smaller_subseq_end_pos = smaller_length
+                                            smaller_seq_name = sequences[j][0]
+                                            break
                                         print(
-                                            f"Error: region {region} is out of bounds for {smaller_seq_name}. Will use entire sequence.\n"
+                                            f"Using region {smaller_seq_name}:{smaller_subseq_start_pos}-{smaller_subseq_end_pos}\n"
+                                        )
+                                        # Change sequence length, and use a subsequence instead.
+                                        smaller_length = (
+                                            smaller_subseq_end_pos
+                                            - smaller_subseq_start_pos
+                                            + 1
+                                            - args.kmer
+                                        )
+                                        smaller_seq_range = (
+                                            smaller_seq_name,
+                                            smaller_subseq_start_pos,
+                                            smaller_subseq_end_pos,
                                         )
-                                        smaller_subseq_start_pos = 1
-                                        smaller_subseq_end_pos = smaller_length
-                                        smaller_seq_name = sequences[j][0]
-                                        break
+                                        smaller_seq_name = f"{smaller_seq_name}:{smaller_subseq_start_pos}-{smaller_subseq_end_pos}"
+                                # This is wrong. Might be fine to leave alone
+                                if (
+                                    not larger_subseq_end_pos
+                                    or not larger_subseq_start_pos
+                                ):
                                     print(
-                                        f"Using region {smaller_seq_name}:{smaller_subseq_start_pos}-{smaller_subseq_end_pos}\n"
-                                    )
-                                    # Change sequence length, and use a subsequence instead.
-                                    smaller_length = (
-                                        smaller_subseq_end_pos
-                                        - smaller_subseq_start_pos
-                                        + 1
-                                        - args.kmer
-                                    )
-                                    smaller_seq_range = (
-                                        smaller_seq_name,
-                                        smaller_subseq_start_pos,
-                                        smaller_subseq_end_pos,
+                                        f"Error: region {args.region} not found in {seq_name}. Will use entire sequence.\n"
                                     )
-                                    smaller_seq_name = f"{smaller_seq_name}:{smaller_subseq_start_pos}-{smaller_subseq_end_pos}"
-                            # This is wrong. Might be fine to leave alone
-                            if not larger_subseq_end_pos or not larger_subseq_start_pos:
-                                print(
-                                    f"Error: region {args.region} not found in {seq_name}. Will use entire sequence.\n"
-                                )
-                                seq_range = None
-                    except Exception as e:
-                        print(
-                            f"Error obtaining region for {seq_name}. Will use entire sequence: {e}\n"
-                        )
+                                    seq_range = None
+                        except Exception as e:
+                            print(
+                                f"Error obtaining region for {seq_name}. Will use entire sequence: {e}\n"
+                            )
 
-                    win = args.window
-                    res = args.resolution
-                    if args.window:
-                        res = math.ceil(smaller_length / args.window)
-                    else:
-                        win = math.ceil(smaller_length / args.resolution)
-                    if win < args.modimizer:
-                        args.modimizer = win
-
-                    seq_sparsity = round(win / args.modimizer)
-                    if seq_sparsity <= args.modimizer:
-                        seq_sparsity = 2 ** int(math.log2(seq_sparsity))
-                    else:
-                        seq_sparsity = 2 ** (int(math.log2(seq_sparsity - 1)) + 1)
-                    expectation = round(win / seq_sparsity)
-                    print(
-                        f"Computing pairwise identity matrix for {larger_seq_name} and {smaller_seq_name}... \n"
-                    )
-                    # TODO: Logging here
-                    print(
-                        f"\tSequence length {larger_seq_name}: {larger_length + args.kmer - 1}\n"
-                    )
-                    print(
-                        f"\tSequence length {smaller_seq_name}: {smaller_length + args.kmer - 1}\n"
-                    )
-                    print(f"\tWindow size w: {win}\n")
-                    print(f"\tModimizer sketch size: {expectation}\n")
-                    print(f"\tPlot Resolution r: {res}\n")
-
-                    if args.region and (larger_seq_range or smaller_seq_range):
-                        if larger_seq_range:
-                            larger_subseq = larger_seq[
-                                larger_subseq_start_pos : (
-                                    larger_subseq_end_pos - args.kmer + 1
-                                )
-                            ]
+                        win = args.window
+                        res = args.resolution
+                        if args.window:
+                            res = math.ceil(smaller_length / args.window)
                         else:
-                            larger_subseq = larger_seq
+                            win = math.ceil(smaller_length / args.resolution)
+                        if win < args.modimizer:
+                            args.modimizer = win
 
-                        if smaller_seq_range:
-                            smaller_subseq = smaller_seq[
-                                smaller_subseq_start_pos : (
-                                    smaller_subseq_end_pos - args.kmer + 1
-                                )
-                            ]
+                        seq_sparsity = round(win / args.modimizer)
+                        if seq_sparsity <= args.modimizer:
+                            seq_sparsity = 2 ** int(math.log2(seq_sparsity))
                         else:
-                            smaller_subseq = smaller_seq
-
-                        pair_mat = createPairwiseMatrix(
-                            smaller_length,
-                            larger_length,
-                            smaller_subseq,
-                            larger_subseq,
-                            win,
-                            seq_sparsity,
-                            args.delta,
-                            args.kmer,
-                            args.identity,
-                            args.ambiguous,
-                            expectation,
+                            seq_sparsity = 2 ** (int(math.log2(seq_sparsity - 1)) + 1)
+                        expectation = round(win / seq_sparsity)
+                        print(
+                            f"Computing pairwise identity matrix for {larger_seq_name} and {smaller_seq_name}... \n"
                         )
-                    else:
-                        pair_mat = createPairwiseMatrix(
-                            smaller_length,
-                            larger_length,
-                            smaller_seq,
-                            larger_seq,
-                            win,
-                            seq_sparsity,
-                            args.delta,
-                            args.kmer,
-                            args.identity,
-                            args.ambiguous,
-                            expectation,
+                        # TODO: Logging here
+                        print(
+                            f"\tSequence length {larger_seq_name}: {larger_length + args.kmer - 1}\n"
                         )
-                    # Throw error if the matrix is empty
-                    if np.all(pair_mat == 0) and (not (args.grid or args.grid_only)):
                         print(
-                            f"The pairwise identity matrix for {sequences[i][0]} and {sequences[j][0]} is empty. Skipping.\n"
+                            f"\tSequence length {smaller_seq_name}: {smaller_length + args.kmer - 1}\n"
+                        )
+                        print(f"\tWindow size w: {win}\n")
+                        print(f"\tModimizer sketch size: {expectation}\n")
+                        print(f"\tPlot Resolution r: {res}\n")
+
+                        bedfile_prefix = larger_seq_name + "_" + smaller_seq_name
+                        bedpe_path = os.path.join(
+                            args.output_dir or ".", bedfile_prefix
                         )
-                    else:
-                        if args.cooler:
-                            try:
-                                cooler_path = "."
-                                if not args.output_dir:
-                                    cooler_path = os.path.join(
-                                        cooler_path,
-                                        f"{larger_seq_name}_{smaller_seq_name}",
+                        checkpoint = matrixCheckpoint(
+                            args,
+                            bedpe_path,
+                            {
+                                "sequences": [
+                                    seq_stamps.get(sequences[i][0]),
+                                    seq_stamps.get(sequences[j][0]),
+                                ],
+                                "names": [larger_seq_name, smaller_seq_name],
+                                "lengths": [larger_length, smaller_length],
+                                "offsets": [
+                                    larger_seq_start_pos,
+                                    smaller_seq_start_pos,
+                                ],
+                                "window": win,
+                                "sparsity": seq_sparsity,
+                                "expectation": expectation,
+                            },
+                        )
+                        record = finishedMatrix(checkpoint, args.grid or args.grid_only)
+                        if not record:
+                            larger_subseq = sequenceKmers(i)
+                            smaller_subseq = sequenceKmers(j)
+                            if args.region and larger_seq_range:
+                                larger_subseq = larger_subseq[
+                                    larger_subseq_start_pos : (
+                                        larger_subseq_end_pos - args.kmer + 1
                                     )
-                                else:
-                                    cooler_path = os.path.join(
-                                        args.output_dir,
-                                        f"{larger_seq_name}_{smaller_seq_name}",
+                                ]
+                            if args.region and smaller_seq_range:
+                                smaller_subseq = smaller_subseq[
+                                    smaller_subseq_start_pos : (
+                                        smaller_subseq_end_pos - args.kmer + 1
                                     )
-                                os.makedirs(cooler_path, exist_ok=True)
+                                ]
+                        if record:
+                            bedfile_output = record["bedpe"]
+                            print(
+                                f"Comparative matrix for {larger_seq_name} and {smaller_seq_name} was finished by an earlier run, reusing {bedfile_output or 'its empty result'}\n"
+                            )
+                            if args.shard:
+                                continue
+                            is_empty = record.get("empty", False)
+                        elif args.tile_size:
+                            # Stream tiles straight to disk instead of building the matrix
+                            os.makedirs(bedpe_path, exist_ok=True)
+                            bedfile_output = os.path.join(
+                                bedpe_path, bedfile_prefix + "_COMPARE.bedpe"
+                            )
+                            cooler_output = None
+                            if args.cooler:
                                 cooler_output = os.path.join(
-                                    cooler_path,
-                                    f"{larger_seq_name}_{smaller_seq_name}.cooler",
+                                    bedpe_path, bedfile_prefix + ".cooler"
                                 )
-                                convertMatrixToCool(
-                                    matrix=pair_mat,
-                                    window_size=win,
-                                    id_threshold=args.identity,
-                                    x_name=larger_seq_name,
-                                    y_name=smaller_seq_name,
-                                    self_identity=False,
-                                    x_offset=larger_seq_start_pos,
-                                    y_offset=smaller_seq_start_pos,
-                                    chromsizes=larger_length,
-                                    output_cool=cooler_output,
+                            with PROFILER.stage(
+                                "pairwise_identity",
+                                label=f"{larger_seq_name}_{smaller_seq_name}",
+                            ):
+                                tiles = createPairwiseTiles(
+                                    smaller_length,
+                                    larger_length,
+                                    smaller_subseq,
+                                    larger_subseq,
+                                    win,
+                                    seq_sparsity,
+                                    args.delta,
+                                    args.kmer,
+                                    args.identity,
+                                    args.ambiguous,
+                                    expectation,
                                 )
+                                if args.shard:
+                                    shard_output, written = writeShard(
+                                        tiles,
+                                        args.tile_size,
+                                        *args.shard,
+                                        win,
+                                        args.identity,
+                                        larger_seq_name,
+                                        smaller_seq_name,
+                                        larger_seq_start_pos,
+                                        smaller_seq_start_pos,
+                                        bedfile_output,
+                                        os.path.join(
+                                            bedpe_path, bedfile_prefix + ".cooler"
+                                        ),
+                                        {
+                                            "kmer": args.kmer,
+                                            "identity": args.identity,
+                                            "delta": args.delta,
+                                            "sparsity": seq_sparsity,
+                                            "expectation": expectation,
+                                            "ambiguous": args.ambiguous,
+                                        },
+                                        checkpoint,
+                                    )
+                                else:
+                                    written = writeTiles(
+                                        tiles,
+                                        tiles.tiles(args.tile_size),
+                                        win,
+                                        args.identity,
+                                        larger_seq_name,
+                                        smaller_seq_name,
+                                        larger_seq_start_pos,
+                                        smaller_seq_start_pos,
+                                        bedfile_output,
+                                        cooler_output,
+                                        checkpoint,
+                                    )
+                            if args.shard:
+                                if checkpoint:
+                                    checkpoint.mark("matrix", {"bedpe": shard_output})
+                                print(
+                                    f"Saved shard {args.shard[0]} of {args.shard[1]} of the comparative matrix to {shard_output}\n"
+                                )
+                                continue
+                            if checkpoint:
+                                checkpoint.mark(
+                                    "matrix",
+                                    {
+                                        "bedpe": bedfile_output,
+                                        "cooler": cooler_output,
+                                        "empty": written == 0,
+                                    },
+                                )
+                            if cooler_output:
                                 print(
                                     f"Saved comparative matrix as a cooler file to {cooler_output}\n"
                                 )
-                            except Exception as e:
-                                print(f"Error creating pairwise cooler file: {e}")
-                        bed = convertMatrixToBed(
-                            pair_mat,
-                            win,
-                            args.identity,
-                            # check if this is correct
-                            larger_seq_name,
-                            smaller_seq_name,
-                            False,
-                            larger_seq_start_pos,
-                            smaller_seq_start_pos,
-                        )
-                        if args.grid or args.grid_only:
-                            grid_val_doubles.append(bed)
-                            grid_val_double_names.append(
-                                [larger_seq_name, smaller_seq_name]
+                            print(
+                                f"Saved comparative matrix as a paired-end bed file to {bedfile_output}\n"
                             )
-                            xlim_val_grid = max(larger_length, xlim_val_grid)
-                        if not args.no_bedpe:
-                            # Log saving bed file
-                            bedpe_path = "."
-                            if not args.output_dir:
-                                bedfile_prefix = (
-                                    larger_seq_name + "_" + smaller_seq_name
+                            is_empty = written == 0
+                        else:
+                            cooler_output = None
+                            with PROFILER.stage(
+                                "pairwise_identity",
+                                label=f"{larger_seq_name}_{smaller_seq_name}",
+                            ):
+                                pair_mat = createPairwiseMatrix(
+                                    smaller_length,
+                                    larger_length,
+                                    smaller_subseq,
+                                    larger_subseq,
+                                    win,
+                                    seq_sparsity,
+                                    args.delta,
+                                    args.kmer,
+                                    args.identity,
+                                    args.ambiguous,
+                                    expectation,
                                 )
-                                bedpe_path = os.path.join(bedpe_path, bedfile_prefix)
-                                os.makedirs(bedpe_path, exist_ok=True)
-                                bedfile_output = os.path.join(
-                                    bedpe_path,
-                                    bedfile_prefix + "_COMPARE.bedpe",
+                            is_empty = np.all(pair_mat == 0)
+                        # Throw error if the matrix is empty
+                        if is_empty and (not (args.grid or args.grid_only)):
+                            print(
+                                f"The pairwise identity matrix for {sequences[i][0]} and {sequences[j][0]} is empty. Skipping.\n"
+                            )
+                            if checkpoint and not (record or args.tile_size):
+                                checkpoint.mark(
+                                    "matrix", {"bedpe": None, "empty": True}
                                 )
+                        else:
+                            if record or args.tile_size:
+                                make_bed = partial(readBedpe, bedfile_output)
                             else:
-                                bedfile_prefix = (
-                                    larger_seq_name + "_" + smaller_seq_name
+                                make_bed = partial(
+                                    exportPairwiseMatrix,
+                                    args,
+                                    pair_mat,
+                                    larger_seq_name,
+                                    smaller_seq_name,
+                                    win,
+                                    larger_length,
+                                    larger_seq_start_pos,
+                                    smaller_seq_start_pos,
+                                    is_empty,
+                                    checkpoint,
                                 )
-                                bedpe_path = os.path.join(
-                                    args.output_dir, bedfile_prefix
+                            grid_key = None
+                            if args.grid or args.grid_only:
+                                grid_key = (i, j)
+                                grid_keys.append(grid_key)
+                                grid_val_double_names.append(
+                                    [larger_seq_name, smaller_seq_name]
                                 )
-                                os.makedirs(bedpe_path, exist_ok=True)
-                                bedfile_output = os.path.join(
+                                xlim_val_grid = max(larger_length, xlim_val_grid)
+                            if (
+                                make_bed.func is exportPairwiseMatrix
+                                or grid_key is not None
+                                or not args.no_plot
+                            ):
+                                render_stage.submit(
+                                    renderMatrix,
+                                    args,
+                                    make_bed,
                                     bedpe_path,
-                                    larger_seq_name
-                                    + "_"
-                                    + smaller_seq_name
-                                    + "_COMPARE.bedpe",
+                                    larger_seq_name,
+                                    smaller_seq_name,
+                                    True,
+                                    grid_beds,
+                                    grid_key,
                                 )
-                            with open(bedfile_output, "w") as bedfile:
-                                for row in bed:
-                                    bedfile.write("\t".join(map(str, row)) + "\n")
-                            print(
-                                f"Saved comparative matrix as a paired-end bed file to {bedfile_output}\n"
-                            )
-
-                        if (not args.no_plot) and (not args.grid_only):
-                            create_plots(
-                                sdf=[bed],
-                                directory=bedpe_path,
-                                name_x=larger_seq_name,
-                                name_y=smaller_seq_name,
-                                palette=args.palette,
-                                palette_orientation=args.palette_orientation,
-                                no_hist=args.no_hist,
-                                width=args.width,
-                                dpi=args.dpi,
-                                is_freq=args.bin_freq,
-                                xlim=args.axes_limits,
-                                custom_colors=args.colors,
-                                custom_breakpoints=args.breakpoints,
-                                from_file=None,
-                                is_pairwise=True,
-                                axes_labels=args.axes_ticks,
-                                axes_tick_number=args.axes_number,
-                                vector_format=args.vector,
-                                deraster=args.deraster,
-                                annotation=args.bed,
-                            )
-
-            if args.grid or args.grid_only:
-                print(f"Creating a {len(sequences)}x{len(sequences)} grid.\n")
+                        # The render stage now holds the only reference to the matrix
+                        pair_mat = None
+            # Shuts down the hashing processes
+            kmer_stream.close()
+
+        if (args.grid or args.grid_only) and len(sequences) > 1:
+            # The render stage has finished, so every grid matrix is in grid_beds
+            grid_val_singles = [
+                grid_beds[key] for key in grid_keys if not isinstance(key, tuple)
+            ]
+            grid_val_doubles = [
+                grid_beds[key] for key in grid_keys if isinstance(key, tuple)
+            ]
+            print(f"Creating a {len(sequences)}x{len(sequences)} grid.\n")
+            with PROFILER.stage("grid", items=len(sequences)):
                 create_grid(
                     singles=grid_val_singles,
                     doubles=grid_val_doubles,
@@ -1460,6 +2200,6 @@ def main():
                     vector_format=args.vector,
                 )
 
-
-if __name__ == "__main__":
-    main()
+        if kmer_checkpoint:
+            kmer_checkpoint.discard()
+        PROFILER.report(args.output_dir)
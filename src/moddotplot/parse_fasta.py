@@ -1,5 +1,6 @@
 from enum import unique
-from typing import Iterable, List, Sequence
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+import hashlib
 import pysam
 import sys
 import mmh3
@@ -7,10 +8,36 @@ import os
 import pickle
 import re
 import numpy as np
-import gzip
+import json
+import multiprocessing
+from collections import deque
+from contextlib import closing
+from itertools import islice
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+
+from moddotplot.checkpoint import Checkpoint, fileStamp
+from moddotplot.twobit import TwoBitFile
+from moddotplot.progress import ProgressReporter
 
 tab_b = bytes.maketrans(b"ACTG", b"TGAC")
 
+# Number of k-mers hashed between progress updates.
+KMER_CHUNK_SIZE = 1 << 16
+
+# Number of k-mers fetched from a sequence file at a time, so a contig never has to
+# be held in memory as one string.
+FETCH_CHUNK_SIZE = 1 << 20
+
+TWOBIT_EXTENSIONS = (".2bit",)
+
+# Where fasta indexes are built when the fasta's own directory isn't writable.
+FASTA_INDEX_CACHE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "moddotplot",
+    "fasta_indexes",
+)
+
 
 def extractRegion(seq_name):
     """Extract chromosome and region from seq_name.
@@ -37,60 +64,213 @@ def extractRegion(seq_name):
     return None
 
 
-def generateKmersFromFasta(seq: Sequence[str], k: int, quiet: bool) -> Iterable[int]:
-    n = len(seq)
+def hashKmerChunks(
+    chunks: Iterable[str], total: int, k: int, quiet: bool
+) -> Iterable[int]:
+    """
+    Canonical hash of every k-mer in a sequence given as consecutive chunks, each
+    overlapping the next by k - 1 bases.
+    """
+    progress = ProgressReporter(total)
     if not quiet:
-        progress_thresholds = round(n / 77)
-        printProgressBar(0, n - k + 1, prefix="Progress:", suffix="Complete", length=40)
+        progress.start()
 
-    for i in range(n - k + 1):
-        if not quiet:
-            if i % progress_thresholds == 0:
-                printProgressBar(
-                    i, n - k + 1, prefix="Progress:", suffix="Complete", length=40
-                )
-            if i == n - k:
-                printProgressBar(
-                    n - k + 1,
-                    n - k + 1,
-                    prefix="Progress:",
-                    suffix="Completed",
-                    length=40,
-                )
-        # Remove case sensitivity
-        kmer = seq[i : i + k].upper()
-        fh = mmh3.hash(kmer)
-
-        # Calculate reverse complement hash directly without the need for translation
-        rc = mmh3.hash(kmer[::-1].translate(tab_b))
-
-        yield fh if fh < rc else rc
+    try:
+        for seq in chunks:
+            n = len(seq) - k + 1
+            # Hash in chunks so the progress counter is only touched once per chunk.
+            for chunk_start in range(0, n, KMER_CHUNK_SIZE):
+                chunk_end = min(chunk_start + KMER_CHUNK_SIZE, n)
+                for i in range(chunk_start, chunk_end):
+                    # Remove case sensitivity
+                    kmer = seq[i : i + k].upper()
+                    fh = mmh3.hash(kmer)
+
+                    # Calculate reverse complement hash directly without the need for translation
+                    rc = mmh3.hash(kmer[::-1].translate(tab_b))
+
+                    yield fh if fh < rc else rc
+                progress.advance(chunk_end - chunk_start)
+    finally:
+        progress.stop(finished=progress.completed >= total)
+
+
+def generateKmersFromFasta(seq: Sequence[str], k: int, quiet: bool) -> Iterable[int]:
+    total = len(seq) - k + 1
+    chunks = (
+        seq[start : min(start + FETCH_CHUNK_SIZE, total) + k - 1]
+        for start in range(0, total, FETCH_CHUNK_SIZE)
+    )
+    return hashKmerChunks(chunks, total, k, quiet)
+
+
+def openSequenceFile(filename: str):
+    """
+    Open a fasta (plain or bgzip-compressed) or a UCSC .2bit file for random access.
+    Both readers expose references, lengths, get_reference_length and
+    fetch(reference, start, end).
+    """
+    if filename.lower().endswith(TWOBIT_EXTENSIONS):
+        return TwoBitFile(filename)
+    fai, gzi = fastaIndexPaths(filename)
+    # Only bgzip-compressed fastas have a .gzi index
+    return pysam.FastaFile(
+        filename,
+        filepath_index=fai,
+        filepath_index_compressed=gzi if os.path.exists(gzi) else None,
+    )
+
+
+def isFreshIndex(index_path: str, file_path: str) -> bool:
+    return os.path.exists(index_path) and os.path.getmtime(
+        index_path
+    ) >= os.path.getmtime(file_path)
+
+
+def fastaIndexPaths(file_path: str) -> Tuple[str, str]:
+    """
+    Paths of the .fai index and .gzi index (bgzip only) of a fasta. These sit next
+    to the fasta, like samtools faidx, unless there's no up to date index there and
+    its directory isn't writable. Such indexes go in FASTA_INDEX_CACHE instead, in a
+    directory named after the fasta's absolute path.
+    """
+    fai, gzi = file_path + ".fai", file_path + ".gzi"
+    directory = os.path.dirname(os.path.abspath(file_path))
+    if isFreshIndex(fai, file_path) or os.access(directory, os.W_OK):
+        return fai, gzi
+    key = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()[:16]
+    name = os.path.join(FASTA_INDEX_CACHE, key, os.path.basename(file_path))
+    return name + ".fai", name + ".gzi"
+
+
+def buildFastaIndex(file_path: str, fai: str, gzi: str) -> None:
+    """
+    Index a fasta with samtools faidx, writing its indexes to `fai` and `gzi`.
+
+    Raises:
+        PermissionError: If the index can't be written.
+        ValueError: If the fasta can't be indexed.
+    """
+    directory = os.path.dirname(fai)
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        raise PermissionError(
+            f"Unable to write the index of {file_path} to {directory}: {e}"
+        ) from e
+    if not os.access(directory, os.W_OK):
+        raise PermissionError(
+            f"Unable to write the index of {file_path} to {directory}: not writable"
+        )
+    try:
+        pysam.faidx(file_path, "--fai-idx", fai, "--gzi-idx", gzi)
+    except pysam.SamtoolsError as e:
+        raise ValueError(f"Unable to index {file_path}: {e}") from e
+
+
+def fetchChunks(seq, seq_id: str, k: int) -> Iterable[str]:
+    """
+    Fetch a sequence FETCH_CHUNK_SIZE k-mers at a time, each chunk overlapping the
+    next by k - 1 bases. bgzip files only decompress the blocks each chunk covers.
+    """
+    total = seq.get_reference_length(seq_id) - k + 1
+    for start in range(0, total, FETCH_CHUNK_SIZE):
+        end = min(start + FETCH_CHUNK_SIZE, total)
+        yield seq.fetch(seq_id, start, end + k - 1)
+
+
+# Sequence names and lengths of each fasta read so far, keyed by absolute path.
+# Entries are dropped when the file's stamp changes.
+_fasta_indexes = {}
+
+
+def readFastaIndex(file_path: str) -> Tuple[List[str], List[int]]:
+    """
+    Names and lengths of every sequence in a fasta, read from its .fai index, or
+    from the header of a .2bit file.
+
+    The index (and the .gzi index of a bgzip-compressed fasta) is built on first
+    use, and rebuilt if the fasta is newer than it, so the sequence itself is only
+    ever scanned once. Results are cached for the rest of the run. See
+    fastaIndexPaths for where indexes are written.
+
+    Raises:
+        FileNotFoundError: If the fasta does not exist.
+        PermissionError: If there's nowhere writable to put the index.
+        OSError, ValueError: If the fasta can't be indexed, eg. it is malformed or
+            compressed with plain gzip rather than bgzip.
+    """
+    stamp = fileStamp(file_path)
+    cached = _fasta_indexes.get(stamp[0])
+    if cached and cached[0] == stamp:
+        return cached[1], cached[2]
+    if file_path.lower().endswith(TWOBIT_EXTENSIONS):
+        # .2bit files carry their own index
+        with TwoBitFile(file_path) as seq:
+            names, lengths = list(seq.references), list(seq.lengths)
+        _fasta_indexes[stamp[0]] = (stamp, names, lengths)
+        return names, lengths
+    fai, gzi = fastaIndexPaths(file_path)
+    if not isFreshIndex(fai, file_path):
+        # Missing, or a stale index from an earlier version of the file
+        buildFastaIndex(file_path, fai, gzi)
+    with openSequenceFile(file_path) as seq:
+        names, lengths = list(seq.references), list(seq.lengths)
+    _fasta_indexes[stamp[0]] = (stamp, names, lengths)
+    return names, lengths
 
 
 def isValidFasta(file_path):
+    """
+    Check that a fasta can be indexed and holds at least one sequence, without
+    reading the sequences themselves.
+    """
     try:
-        open_func = gzip.open if file_path.endswith(".gz") else open
-        with open_func(file_path, "rt") as file:
-            in_sequence = False
-            for line in file:
-                line = line.strip()
-                if line.startswith(">"):
-                    in_sequence = True
-                elif in_sequence and not line:
-                    # Empty line encountered after the sequence header
-                    in_sequence = False
-                elif in_sequence:
-                    pass
-            return in_sequence
+        names, _ = readFastaIndex(file_path)
+        return len(names) > 0
     except FileNotFoundError:
         print(f"Unable to find fasta {file_path}. Check filename and/or directory!\n")
         sys.exit(5)
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
-        sys.exit(6)
+    except PermissionError as e:
+        print(
+            f"{e}. Check permissions on the fasta's directory or {FASTA_INDEX_CACHE}\n"
+        )
+        sys.exit(5)
+    except (OSError, ValueError):
+        return False
+
+
+def mappedLayer(npz_path):
+    """
+    A saved interactive layer as a read-only memory map, so every process serving
+    the session shares one copy of it through the page cache. Compressed .npz
+    files can't be mapped, so the layer is unpacked once into a .npy next to it,
+    and again whenever the .npz is newer.
+    """
+    npy_path = os.path.splitext(npz_path)[0] + ".npy"
+    if not os.path.exists(npy_path) or os.path.getmtime(npy_path) < os.path.getmtime(
+        npz_path
+    ):
+        # Several server processes may unpack the same layer at once
+        tmp_path = f"{npy_path}.{os.getpid()}.tmp"
+        with np.load(npz_path, allow_pickle=True) as ff, open(tmp_path, "wb") as f:
+            np.save(f, ff["data"])
+        os.replace(tmp_path, npy_path)
+    return np.load(npy_path, mmap_mode="r")
+
+
+def extractFiles(folder_path, mmap=False):
+    """
+    Matrices and metadata of an interactive session saved with --save.
 
+    Args:
+        folder_path (str): The session's interactive_matrices directory.
+        mmap (bool): Memory-map the layers (see mappedLayer) instead of reading
+            them into memory.
 
-def extractFiles(folder_path):
+    Returns:
+        Tuple: (matrices, metadata), with each matrix a list of its layers.
+    """
     # Check to see at least one compressed numpy matrix, and one metadata pickle are included
     metadata = []
     matrices = []
@@ -106,7 +286,10 @@ def extractFiles(folder_path):
         if filename.endswith(".npz"):
             pattern = rf"_(\d+)\.npz"  # Using f-string to include the value of i in the regex pattern
             tmp2 = re.split(pattern, filename, maxsplit=1)
-            ff = np.load(file_path, allow_pickle=True)
+            if mmap:
+                ff = {"data": mappedLayer(file_path)}
+            else:
+                ff = np.load(file_path, allow_pickle=True)
             tmp.append((tmp2[0], tmp2[1], ff))
     sorted_list = sorted(tmp, key=lambda x: (x[0], x[1]))
 
@@ -132,55 +315,254 @@ def extractFiles(folder_path):
     return matrices, metadata
 
 
-def printProgressBar(
-    iteration,
-    total,
-    prefix="",
-    suffix="",
-    decimals=1,
-    length=100,
-    fill="█",
-    printEnd="\r",
-):
-    percent = f"{100 * (iteration / total):.{decimals}f}"
-    filledLength = int(length * iteration // total)
-    bar = [fill] * filledLength + ["-"] * (length - filledLength)
-    bar_str = "".join(bar)
-    print(f"\r{prefix} |{bar_str}| {percent}% {suffix}", end=printEnd)
-    if iteration == total:
-        print()
-
-
-def readKmersFromFile(filename: str, ksize: int, quiet: bool) -> List[List[int]]:
-    """
-    Given a filename and an integer k, returns a list of all k-mers found in the sequences in the file.
-    """
-    all_kmers = []
-    seq = pysam.FastaFile(filename)
-
-    for seq_id in seq.references:
-        print(f"Retrieving k-mers from {seq_id}.... \n")
-        kmers_for_seq = []
-        for kmer_hash in generateKmersFromFasta(seq.fetch(seq_id), ksize, quiet):
-            kmers_for_seq.append(kmer_hash)
-        all_kmers.append(kmers_for_seq)
-        print(f"\n{seq_id} k-mers retrieved! \n")
+def availableCores() -> int:
+    """
+    Number of cores this process may run on. Respects CPU affinity (eg. cluster
+    allocations) where the platform supports it.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
 
-    return all_kmers
+
+def hashSequence(filename: str, seq_id: str, ksize: int, quiet: bool) -> np.ndarray:
+    """
+    Hash every k-mer of a single sequence into a NumPy array of 32-bit hashes. The
+    sequence is fetched in chunks rather than read into one string.
+    """
+    with openSequenceFile(filename) as seq:
+        count = max(seq.get_reference_length(seq_id) - ksize + 1, 0)
+    kmers = np.empty(count, dtype=np.int32)
+    hashSequenceInto(kmers, filename, seq_id, ksize, quiet)
+    return kmers
 
 
-def getInputHeaders(filename: str) -> List[str]:
-    header_list = []
+def hashSequenceInto(
+    kmers: np.ndarray, filename: str, seq_id: str, ksize: int, quiet: bool
+) -> None:
+    """
+    Hash every k-mer of a single sequence into `kmers`, an int32 array with one
+    entry per k-mer, KMER_CHUNK_SIZE hashes at a time.
+    """
+    with openSequenceFile(filename) as seq, closing(
+        hashKmerChunks(fetchChunks(seq, seq_id, ksize), len(kmers), ksize, quiet)
+    ) as hashes:
+        for start in range(0, len(kmers), KMER_CHUNK_SIZE):
+            block = kmers[start : start + KMER_CHUNK_SIZE]
+            block[:] = np.fromiter(
+                islice(hashes, len(block)), dtype=np.int32, count=len(block)
+            )
+
+
+def hashSequenceToSharedMemory(
+    filename: str, seq_id: str, ksize: int, shm_name: str, count: int
+) -> str:
+    """
+    Worker for readKmersFromFiles: hash one sequence in place into a shared memory
+    block allocated by the parent, so no hash array is built in the worker or
+    pickled back.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        kmers = np.ndarray((count,), dtype=np.int32, buffer=shm.buf)
+        hashSequenceInto(kmers, filename, seq_id, ksize, True)
+        del kmers
+    finally:
+        shm.close()
+    return seq_id
+
+
+def listSequences(filenames: List[str], ksize: int) -> List[Tuple[int, str, str, int]]:
+    """
+    Every sequence in every file, read from the fasta indexes without loading any
+    sequence.
+
+    Returns:
+        List[Tuple[int, str, str, int]]: File index, filename, sequence name and
+        number of k-mers of each sequence, in file order.
+    """
+    jobs = []
+    for file_index, filename in enumerate(filenames):
+        for seq_id, length in zip(*readFastaIndex(filename)):
+            jobs.append((file_index, filename, seq_id, max(length - ksize + 1, 0)))
+    return jobs
+
+
+def iterKmersFromFiles(
+    jobs: List[Tuple[int, str, str, int]],
+    ksize: int,
+    quiet: bool,
+    threads: int = 1,
+    checkpoint: Optional[Checkpoint] = None,
+    lookahead: Optional[int] = None,
+) -> Iterator[np.ndarray]:
+    """
+    Hash the k-mers of each sequence from listSequences, one sequence per process,
+    yielding each array of hashes in the order of `jobs`.
+
+    Each worker hashes in place into a shared memory block sized from the fasta
+    index. The parent copies the block out once, when the worker is done, so the
+    block can be freed straight away rather than living as long as the array.
+    With a `lookahead`, at most `threads + lookahead` sequences are hashed ahead of
+    the consumer, so hashing the next sequences overlaps with whatever the consumer
+    does with the current one while memory stays bounded. Without one, every
+    sequence is hashed under a single progress bar before the first is yielded.
+    With a checkpoint, each sequence is saved as soon as it is hashed and sequences
+    hashed by an earlier, interrupted run are loaded instead of hashed again.
+    """
+    units = [None] * len(jobs)
+    cached = [False] * len(jobs)
+    if checkpoint:
+        for job_index, (_, filename, seq_id, _) in enumerate(jobs):
+            # Editing or replacing the file changes its stamp, and so the unit
+            units[job_index] = json.dumps(fileStamp(filename) + [seq_id])
+            cached[job_index] = checkpoint.hasArray(units[job_index])
+
+    def load(job_index):
+        print(f"Loaded {jobs[job_index][2]} k-mers from checkpoint. \n")
+        return checkpoint.loadArray(units[job_index])
+
+    def save(job_index, kmers):
+        if checkpoint:
+            checkpoint.saveArray(units[job_index], kmers)
+        return kmers
+
+    pending = deque(i for i in range(len(jobs)) if not cached[i])
+    threads = min(threads, len(pending))
+    if threads <= 1:
+        for job_index, (_, filename, seq_id, _) in enumerate(jobs):
+            if cached[job_index]:
+                yield load(job_index)
+                continue
+            print(f"Retrieving k-mers from {seq_id}.... \n")
+            kmers = save(job_index, hashSequence(filename, seq_id, ksize, quiet))
+            print(f"\n{seq_id} k-mers retrieved! \n")
+            yield kmers
+        return
+
+    bounded = lookahead is not None
+    progress = ProgressReporter(sum(jobs[job_index][3] for job_index in pending))
+    if not bounded:
+        lookahead = len(jobs)
+        print(
+            f"Retrieving k-mers from {len(pending)} sequences using {threads} processes.... \n"
+        )
+        if not quiet:
+            progress.start()
+    results = {}
+    blocks = {}
+    running = {}
     try:
-        seq = pysam.FastaFile(filename)
-    except OSError:
-        seq = None
-    for seq_id in seq.references:
-        header_list.append(seq_id)
+        # Fork isn't safe once the progress thread is running; workers get their
+        # input through shared memory, so nothing relies on inheriting state
+        with ProcessPoolExecutor(
+            max_workers=threads, mp_context=multiprocessing.get_context("forkserver")
+        ) as pool:
+
+            def submit():
+                # Jobs are submitted in order, so the job the consumer waits for is
+                # always running or finished before any later job takes up a slot.
+                while (
+                    pending
+                    and len(running) < threads
+                    and len(running) + len(results) < threads + lookahead
+                ):
+                    job_index = pending.popleft()
+                    _, filename, seq_id, count = jobs[job_index]
+                    # SharedMemory can't be zero-sized
+                    shm = shared_memory.SharedMemory(
+                        create=True, size=max(count, 1) * 4
+                    )
+                    blocks[job_index] = shm
+                    future = pool.submit(
+                        hashSequenceToSharedMemory,
+                        filename,
+                        seq_id,
+                        ksize,
+                        shm.name,
+                        count,
+                    )
+                    running[future] = job_index
+
+            def collect():
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job_index = running.pop(future)
+                    future.result()
+                    count = jobs[job_index][3]
+                    shm = blocks.pop(job_index)
+                    shared = np.ndarray((count,), dtype=np.int32, buffer=shm.buf)
+                    results[job_index] = save(job_index, shared.copy())
+                    del shared
+                    shm.close()
+                    shm.unlink()
+                    progress.advance(count)
+                    if bounded:
+                        print(f"{jobs[job_index][2]} k-mers retrieved! \n")
+
+            submit()
+            if not bounded:
+                while running:
+                    collect()
+                    submit()
+                progress.stop()
+            for job_index in range(len(jobs)):
+                if cached[job_index]:
+                    yield load(job_index)
+                    continue
+                while job_index not in results:
+                    collect()
+                    submit()
+                if not bounded:
+                    print(f"{jobs[job_index][2]} k-mers retrieved! \n")
+                kmers = results.pop(job_index)
+                submit()
+                yield kmers
+    finally:
+        progress.stop(finished=not pending and not running)
+        for future in running:
+            future.cancel()
+        for shm in blocks.values():
+            shm.close()
+            shm.unlink()
 
-    return header_list
+
+def readKmersFromFiles(
+    filenames: List[str],
+    ksize: int,
+    quiet: bool,
+    threads: int = 1,
+    checkpoint: Optional[Checkpoint] = None,
+) -> List[List[np.ndarray]]:
+    """
+    Hash the k-mers of every sequence in every file, one sequence per process. See
+    iterKmersFromFiles.
+
+    Returns:
+        List[List[np.ndarray]]: For each file, one array of k-mer hashes per sequence.
+    """
+    jobs = listSequences(filenames, ksize)
+    all_kmers = [[] for _ in filenames]
+    for (file_index, _, _, _), kmers in zip(
+        jobs, iterKmersFromFiles(jobs, ksize, quiet, threads, checkpoint)
+    ):
+        all_kmers[file_index].append(kmers)
+    return all_kmers
+
+
+def readKmersFromFile(
+    filename: str, ksize: int, quiet: bool, threads: int = 1
+) -> List[np.ndarray]:
+    """
+    Given a filename and an integer k, returns an array of k-mer hashes for each sequence in the file.
+    """
+    return readKmersFromFiles([filename], ksize, quiet, threads)[0]
+
+
+def getInputHeaders(filename: str) -> List[str]:
+    return readFastaIndex(filename)[0]
 
 
 def getInputSeqLength(filename: str) -> List[int]:
-    seq = pysam.FastaFile(filename)
-    return seq.lengths
+    return readFastaIndex(filename)[1]
@@ -0,0 +1,70 @@
+import queue
+import threading
+
+# Finished matrices waiting to be exported or plotted. Each one holds a bedpe row
+# list (and for dense runs the matrix), so this bounds the extra memory used.
+PIPELINE_DEPTH = 2
+
+
+class BackgroundStage:
+    """
+    Runs tasks on one background thread, fed through a bounded queue.
+
+    `submit` blocks while the queue is full, so a fast producer can never get more
+    than `maxsize` tasks ahead of the stage. Tasks run in the order submitted. Once
+    a task raises, the stage skips every task after it, and the exception is
+    re-raised in the producer on every later `submit` and on `close`. Leaving the
+    context waits for every submitted task to finish, even when the producer itself
+    failed.
+    """
+
+    _DONE = object()
+
+    def __init__(self, name, maxsize=PIPELINE_DEPTH):
+        self.name = name
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is self._DONE:
+                return
+            if self._error is not None:
+                continue  # drain the queue without running anything else
+            fn, args, kwargs = task
+            try:
+                fn(*args, **kwargs)
+            except BaseException as e:
+                self._error = e
+
+    def _raiseError(self):
+        # The error stays set, so the stage keeps skipping tasks after it's raised
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, fn, *args, **kwargs):
+        self._raiseError()
+        self._queue.put((fn, args, kwargs))
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(self._DONE)
+            self._thread.join()
+        self._raiseError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return False
+        # Don't hide the producer's exception behind one from the stage
+        try:
+            self.close()
+        except BaseException:
+            pass
+        return False
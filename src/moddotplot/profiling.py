@@ -0,0 +1,164 @@
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def getPeakMemory():
+    """
+    Return the peak resident set size of this process (and reaped children) in MB.
+
+    Returns None on platforms without the resource module.
+    """
+    if resource is None:
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # ru_maxrss is reported in bytes on macOS and in kilobytes everywhere else.
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def getCpuTime():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class Profiler:
+    """
+    Collects wall time, CPU time, items processed and peak memory for each pipeline stage.
+
+    Stages can be nested; every record keeps the name and id of its enclosing stage
+    so that e.g. the sketching time of one sequence can be told apart from another.
+    Each thread nests its own stages, so stages running on a background thread are
+    never attributed to whatever the main thread is doing. When the profiler is
+    disabled, `stage` hands back a throwaway record and does no timing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.records = []
+        self._local = threading.local()
+        # Ids in start order, shared by every thread
+        self._ids = itertools.count()
+
+    @property
+    def _stack(self):
+        # Each thread nests its own stages, eg. plotting on a pipeline thread.
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def enable(self):
+        self.enabled = True
+
+    @contextmanager
+    def stage(self, name, label=None, items=None):
+        record = {"stage": name, "label": label, "items": items}
+        if not self.enabled:
+            yield record
+            return
+
+        stack = self._stack
+        record["id"] = next(self._ids)
+        record["parent"] = stack[-1][1] if stack else None
+        record["parent_id"] = stack[-1][0] if stack else None
+        record["thread"] = threading.current_thread().name
+        record["depth"] = len(stack)
+        stack.append((record["id"], f"{name}:{label}" if label else name))
+        peak_before = getPeakMemory()
+        cpu_start = getCpuTime()
+        wall_start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_s"] = round(time.perf_counter() - wall_start, 6)
+            record["cpu_s"] = round(getCpuTime() - cpu_start, 6)
+            peak_after = getPeakMemory()
+            if peak_after is not None:
+                record["peak_rss_mb"] = round(peak_after, 2)
+                record["rss_growth_mb"] = round(peak_after - peak_before, 2)
+            else:
+                record["peak_rss_mb"] = None
+                record["rss_growth_mb"] = None
+            stack.pop()
+            self.records.append(record)
+
+    def writeJson(self, output_path):
+        """
+        Write one JSON object per finished stage, in completion order.
+        """
+        with open(output_path, "w") as f:
+            for record in self.records:
+                f.write(json.dumps(record) + "\n")
+
+    def summary(self):
+        """
+        Format the finished stages as a table, indented by nesting depth.
+        """
+        header = f"{'Stage':<48}{'Items':>14}{'Wall (s)':>12}{'CPU (s)':>12}{'Peak RSS (MB)':>16}"
+        lines = [header, "-" * len(header)]
+        # Records are appended when a stage finishes, so parents come after their
+        # children. List them in start order, each under its parent.
+        for record in self._orderedRecords():
+            name = record["stage"]
+            if record["label"]:
+                name = f"{name} ({record['label']})"
+            if record["depth"] == 0 and record["thread"] != "MainThread":
+                name = f"{name} [{record['thread']} thread]"
+            name = ("  " * record["depth"] + name)[:47]
+            items = "" if record["items"] is None else f"{record['items']:,}"
+            peak = (
+                "" if record["peak_rss_mb"] is None else f"{record['peak_rss_mb']:.1f}"
+            )
+            lines.append(
+                f"{name:<48}{items:>14}{record['wall_s']:>12.3f}{record['cpu_s']:>12.3f}{peak:>16}"
+            )
+        return "\n".join(lines)
+
+    def _orderedRecords(self):
+        records = sorted(self.records, key=lambda r: r["id"])
+        children = {}
+        for record in records:
+            children.setdefault(record["parent_id"], []).append(record)
+        ordered = []
+        # Stages whose parent is still running when the summary is made go at the
+        # top level rather than being lost
+        finished = {record["id"] for record in records}
+        stack = [r for r in reversed(records) if r["parent_id"] not in finished]
+        while stack:
+            record = stack.pop()
+            ordered.append(record)
+            stack.extend(reversed(children.get(record["id"], [])))
+        return ordered
+
+    def report(self, output_dir):
+        """
+        Print the summary table and save the JSON lines log to `output_dir`.
+        """
+        if not self.enabled or not self.records:
+            return
+        print("Profile summary:\n")
+        print(self.summary())
+        print()
+        if not output_dir:
+            output_dir = os.getcwd()
+        os.makedirs(output_dir, exist_ok=True)
+        profile_path = os.path.join(output_dir, "moddotplot_profile.jsonl")
+        self.writeJson(profile_path)
+        print(f"Saved profile to {profile_path}\n")
+
+
+# Shared instance used by every module; enabled from the command line with --profile.
+PROFILER = Profiler()
@@ -0,0 +1,113 @@
+import sys
+import threading
+
+# Set from the command line with --quiet. Progress bars are also skipped when stdout
+# isn't a terminal, so batch logs don't fill up with carriage returns.
+QUIET = False
+
+
+def printProgressBar(
+    iteration,
+    total,
+    prefix="",
+    suffix="",
+    decimals=1,
+    length=100,
+    fill="█",
+    printEnd="\r",
+):
+    percent = f"{100 * (iteration / total):.{decimals}f}"
+    filledLength = int(length * iteration // total)
+    bar = [fill] * filledLength + ["-"] * (length - filledLength)
+    bar_str = "".join(bar)
+    print(f"\r{prefix} |{bar_str}| {percent}% {suffix}", end=printEnd, flush=True)
+    if iteration == total:
+        print()
+
+
+def setQuiet(quiet: bool):
+    global QUIET
+    QUIET = quiet
+
+
+def progressEnabled() -> bool:
+    if QUIET:
+        return False
+    try:
+        return sys.stdout.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+
+class ProgressReporter:
+    """
+    Draw a progress bar from a background thread on a fixed time interval.
+
+    Hot loops only bump an integer with `advance`, ideally once per batch of work,
+    and never format or write anything themselves. The counter has a single writer
+    (the loop) and a single reader (the drawing thread), so no lock is needed. When
+    progress is disabled every method is a no-op.
+
+    Usage:
+        with ProgressReporter(total) as progress:
+            for chunk in work:
+                ...
+                progress.advance(len(chunk))
+    """
+
+    def __init__(self, total, prefix="Progress:", interval=0.2, length=40):
+        self.total = max(int(total), 1)
+        self.prefix = prefix
+        self.interval = interval
+        self.length = length
+        self.completed = 0
+        self.enabled = progressEnabled()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def advance(self, n=1):
+        self.completed += n
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return self
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, finished=True):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        if finished:
+            printProgressBar(
+                self.total,
+                self.total,
+                prefix=self.prefix,
+                suffix="Completed",
+                length=self.length,
+            )
+        else:
+            print()
+
+    def _run(self):
+        printProgressBar(
+            0, self.total, prefix=self.prefix, suffix="Complete", length=self.length
+        )
+        while not self._stop.wait(self.interval):
+            printProgressBar(
+                min(self.completed, self.total - 1),
+                self.total,
+                prefix=self.prefix,
+                suffix="Complete",
+                length=self.length,
+            )
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop(finished=exc_type is None)
+        return False
@@ -0,0 +1,191 @@
+import threading
+from collections import OrderedDict
+
+# Image pyramids interactive mode keeps in memory at once, by default.
+PYRAMID_CAPACITY = 4
+
+
+class PyramidStore:
+    """
+    Image pyramids of the matrices in an interactive session, built in the
+    background instead of all before the app starts.
+
+    Indexed like the list of pyramids run_dash takes: `store[i]` returns the
+    layers of matrix i, coarsest first. Only the coarsest layer is waited for,
+    built by the caller itself so it never queues behind other work; finer ones
+    are appended to the same list by a worker thread as they are computed, so
+    callers should use the finest layer present. The worker finishes the most
+    recently used pyramid first, then the ones asked for with `prefetch`, one
+    layer at a time.
+
+    At most `capacity` pyramids are kept; the least recently used one is dropped
+    when another is added, and rebuilt if asked for again.
+
+    Args:
+        build (callable): Called with a matrix index, returns an iterator over
+            its layers, coarsest first.
+        count (int): Number of matrices.
+        depth (int): Layers in each pyramid.
+        capacity (int): Pyramids kept in memory, None for no limit.
+    """
+
+    def __init__(self, build, count, depth, capacity=PYRAMID_CAPACITY):
+        self._build = build
+        self._count = count
+        self.depth = depth
+        self.capacity = capacity
+        self._pyramids = OrderedDict()
+        # Layer iterators of pyramids still being built
+        self._builders = {}
+        self._errors = {}
+        self._wanted = []
+        self._cond = threading.Condition()
+        self._worker = None
+
+    @classmethod
+    def fromPyramids(cls, pyramids):
+        """
+        Store holding pyramids that are already built, such as loaded ones.
+        """
+        depth = len(pyramids[0]) if pyramids else 0
+        store = cls(None, len(pyramids), depth, capacity=None)
+        store._pyramids.update(enumerate(pyramids))
+        return store
+
+    def __len__(self):
+        return self._count
+
+    def loaded(self, index):
+        with self._cond:
+            return index in self._pyramids
+
+    def progress(self, index):
+        """
+        Number of layers of a pyramid ready so far, out of `depth`.
+        """
+        with self._cond:
+            return len(self._pyramids.get(index, ())), self.depth
+
+    def complete(self, index):
+        ready, depth = self.progress(index)
+        return ready >= depth
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        with self._cond:
+            while True:
+                # Restarted if another request evicted it while waiting
+                if index not in self._pyramids:
+                    pyramid = self._pyramids[index] = []
+                    self._evict(index)
+                    break
+                self._pyramids.move_to_end(index)
+                self._cond.notify_all()
+                pyramid = self._pyramids[index]
+                if pyramid:
+                    return pyramid
+                if index in self._errors:
+                    # Prefetching failed before any layer: drop it so the next
+                    # request tries again
+                    del self._pyramids[index]
+                    raise self._errors.pop(index)
+                self._cond.wait()
+
+        builder = self._build(index)
+        try:
+            layer = next(builder, None)
+            if layer is None:
+                raise ValueError(f"Matrix {index} has no layers")
+        except BaseException:
+            # Drop it so the next request tries again
+            with self._cond:
+                if self._pyramids.get(index) is pyramid:
+                    del self._pyramids[index]
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            pyramid.append(layer)
+            # The worker takes it from here, unless it was dropped meanwhile
+            if self._pyramids.get(index) is pyramid:
+                self._builders[index] = builder
+                self._startWorker()
+            self._cond.notify_all()
+        return pyramid
+
+    def prefetch(self, indices):
+        """
+        Build the pyramids at `indices` in the background once the ones in memory
+        are complete, most likely first. Replaces any earlier prefetch request,
+        and never asks for more than fits next to the most recently used pyramid.
+        """
+        if self.capacity is not None:
+            indices = indices[: max(self.capacity - 1, 0)]
+        with self._cond:
+            self._wanted = [i for i in indices if i not in self._pyramids]
+            if self._wanted:
+                self._cond.notify_all()
+                self._startWorker()
+
+    def _prefetchOne(self, index):
+        # Called with the lock held, by the worker
+        current = next(reversed(self._pyramids), None)
+        self._pyramids[index] = []
+        self._builders[index] = self._build(index)
+        if current is not None:
+            # Prefetched pyramids never push out the one being looked at
+            self._pyramids.move_to_end(current)
+        self._evict(current)
+
+    def _evict(self, keep):
+        # Called with the lock held: drop least recently used pyramids over
+        # capacity, never `keep`
+        while self.capacity and len(self._pyramids) > self.capacity:
+            dropped = next(i for i in self._pyramids if i != keep)
+            del self._pyramids[dropped]
+            self._builders.pop(dropped, None)
+
+    def _startWorker(self):
+        if self._worker is None:
+            self._worker = threading.Thread(
+                target=self._run, name="pyramids", daemon=True
+            )
+            self._worker.start()
+
+    def _nextWork(self):
+        # Most recently used unfinished pyramid first, then prefetched ones
+        for index in reversed(self._pyramids):
+            if index in self._builders:
+                return index
+        while self._wanted:
+            index = self._wanted.pop(0)
+            if index not in self._pyramids:
+                self._prefetchOne(index)
+                return index
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                index = self._nextWork()
+                while index is None:
+                    self._cond.wait()
+                    index = self._nextWork()
+                builder = self._builders[index]
+                pyramid = self._pyramids[index]
+            try:
+                layer = next(builder, None)
+                error = None
+            except Exception as e:
+                layer, error = None, e
+            with self._cond:
+                if layer is not None:
+                    # Appended even if evicted meanwhile, no one else sees it then
+                    pyramid.append(layer)
+                elif self._builders.get(index) is builder:
+                    del self._builders[index]
+                    if error is not None:
+                        print(f"Unable to build matrix {index}: {error}\n")
+                        if not pyramid:
+                            self._errors[index] = error
+                self._cond.notify_all()
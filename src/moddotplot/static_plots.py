@@ -39,7 +39,7 @@ import os
 import xml.etree.ElementTree as ET
 import sys
 import re
-from moddotplot.parse_fasta import printProgressBar
+from moddotplot.progress import ProgressReporter
 from lxml import etree
 from pygenometracks.utilities import get_region
 import matplotlib.pyplot as plt
@@ -1559,8 +1559,7 @@ def create_grid(
     if n > 9:
         print(f"This might take a while\n...\n")
 
-    printProgressBar(0, n, prefix="Progress:", suffix="Complete", length=40)
-    tots = 0
+    progress = ProgressReporter(n).start()
     col_names = pw.Brick(figsize=(width / 4.5, width))
     row_names = pw.Brick(figsize=(width, width / 4.5))
     for i in range(single_length):
@@ -1587,12 +1586,12 @@ def create_grid(
                 row_grid = g1
             else:
                 row_grid = row_grid | g1
-            tots += 1
-            printProgressBar(tots, n, prefix="Progress:", suffix="Complete", length=40)
+            progress.advance()
         if i == 0:
             start_grid = row_grid
         else:
             start_grid = row_grid / start_grid
+    progress.stop()
     for w in range(single_length):
         p1 = (
             ggplot()
@@ -0,0 +1,683 @@
+import heapq
+import json
+import math
+import os
+import re
+import numpy as np
+import pandas as pd
+import cooler
+
+from moddotplot.estimate_identity import (
+    BEDPE_HEADER,
+    asPackedSketches,
+    bedpeRows,
+    containmentScores,
+    coolerBins,
+    countIntersections,
+    encodeSketches,
+    sketchLengths,
+    sketchSequence,
+)
+from moddotplot.profiling import PROFILER
+from moddotplot.progress import ProgressReporter
+
+# Windows per side of a tile. A tile of float64 identities takes 8 MB.
+DEFAULT_TILE_SIZE = 1024
+
+# Shard outputs are named <bedpe name>.shard-<i>-of-<N>.bedpe/.json
+SHARD_PATTERN = re.compile(r"\.shard-(\d+)-of-(\d+)\.json$")
+
+# Bedpe rows per cooler pixel chunk when reading bedpe files back.
+PIXEL_CHUNK_SIZE = 1 << 20
+
+
+class ContainmentTiles:
+    """
+    Computes rectangular blocks (tiles) of a self or pairwise containment matrix.
+
+    Sketches are encoded once up front, after which any tile can be computed on its
+    own. Only one tile is held in memory at a time, so the full matrix never has to
+    exist. Rows are y windows and columns are x windows, as in
+    pairwiseContainmentMatrix. For self-identity matrices only the diagonal and the
+    cells above it are computed, and with a `bandwidth` only cells at most that many
+    windows from the diagonal.
+    """
+
+    def __init__(
+        self,
+        mod_set_x,
+        mod_set_y,
+        mod_set_x_neighbors,
+        mod_set_y_neighbors,
+        identity,
+        k,
+        ambiguous=False,
+        self_identity=False,
+        bandwidth=None,
+    ):
+        self.identity = identity
+        self.k = k
+        self.ambiguous = ambiguous
+        self.self_identity = self_identity
+        self.bandwidth = bandwidth if self_identity else None
+
+        self.x = asPackedSketches(mod_set_x)
+        self.x_neighbors = asPackedSketches(mod_set_x_neighbors)
+        if self_identity:
+            (self.x_ids, self.x_neighbor_ids), vocabulary_size = encodeSketches(
+                self.x, self.x_neighbors
+            )
+            self.y, self.y_neighbors = self.x, self.x_neighbors
+            self.y_ids, self.y_neighbor_ids = self.x_ids, self.x_neighbor_ids
+        else:
+            self.y = asPackedSketches(mod_set_y)
+            self.y_neighbors = asPackedSketches(mod_set_y_neighbors)
+            (
+                self.x_ids,
+                self.x_neighbor_ids,
+                self.y_ids,
+                self.y_neighbor_ids,
+            ), vocabulary_size = encodeSketches(
+                self.x, self.x_neighbors, self.y, self.y_neighbors
+            )
+        self.x_lengths = sketchLengths(self.x)
+        self.y_lengths = sketchLengths(self.y)
+        self.rows = len(self.y_lengths)
+        self.cols = len(self.x_lengths)
+        self._marked = np.zeros(vocabulary_size, dtype=bool)
+
+    def _count(self, window_ids, window_offsets, w, ids, offsets, start, end):
+        window = window_ids[window_offsets[w] : window_offsets[w + 1]]
+        self._marked[window] = True
+        counts = countIntersections(self._marked, ids, offsets, start, end)
+        self._marked[window] = False
+        return counts
+
+    def tile(self, row_start, row_end, col_start, col_end):
+        """
+        Compute matrix[row_start:row_end, col_start:col_end]. Cells that are not
+        computed (below the diagonal or outside the band) are 0.
+        """
+        block = np.zeros((row_end - row_start, col_end - col_start))
+        for w in range(row_start, row_end):
+            start, end = col_start, col_end
+            if self.self_identity:
+                if col_start <= w < col_end:
+                    diagonal = 100.0
+                    if self.y_lengths[w] == 0 and not self.ambiguous:
+                        diagonal = 0
+                    block[w - row_start, w - col_start] = diagonal
+                start = max(start, w + 1)
+                if self.bandwidth is not None:
+                    end = min(end, w + self.bandwidth + 1)
+            if start >= end:
+                continue
+
+            if self.self_identity:
+                # A = row window w, B = every column window r
+                intersection_a_b_prime = self._count(
+                    self.y_ids,
+                    self.y.offsets,
+                    w,
+                    self.x_neighbor_ids,
+                    self.x_neighbors.offsets,
+                    start,
+                    end,
+                )
+                intersection_a_prime_b = self._count(
+                    self.y_neighbor_ids,
+                    self.y_neighbors.offsets,
+                    w,
+                    self.x_ids,
+                    self.x.offsets,
+                    start,
+                    end,
+                )
+                scores = containmentScores(
+                    intersection_a_b_prime,
+                    self.y_lengths[w],
+                    intersection_a_prime_b,
+                    self.x_lengths[start:end],
+                    self.identity,
+                    self.k,
+                )
+            else:
+                # A = every column (x) window q, B = row (y) window w
+                intersection_a_b_prime = self._count(
+                    self.y_neighbor_ids,
+                    self.y_neighbors.offsets,
+                    w,
+                    self.x_ids,
+                    self.x.offsets,
+                    start,
+                    end,
+                )
+                intersection_a_prime_b = self._count(
+                    self.y_ids,
+                    self.y.offsets,
+                    w,
+                    self.x_neighbor_ids,
+                    self.x_neighbors.offsets,
+                    start,
+                    end,
+                )
+                scores = containmentScores(
+                    intersection_a_b_prime,
+                    self.x_lengths[start:end],
+                    intersection_a_prime_b,
+                    self.y_lengths[w],
+                    self.identity,
+                    self.k,
+                )
+            block[w - row_start, start - col_start : end - col_start] = scores
+        return block
+
+    def tiles(self, tile_size=DEFAULT_TILE_SIZE):
+        """
+        Every tile that holds computed cells, in row-major order. The order only
+        depends on the matrix shape, tile size and band, so tile numbers are stable
+        between runs.
+
+        Returns:
+            List[Tuple[int, int, int, int]]: (row_start, row_end, col_start, col_end) of each tile.
+        """
+        tiles = []
+        for row_start in range(0, self.rows, tile_size):
+            row_end = min(row_start + tile_size, self.rows)
+            for col_start in range(0, self.cols, tile_size):
+                col_end = min(col_start + tile_size, self.cols)
+                if self.self_identity and col_end <= row_start:
+                    continue
+                if (
+                    self.bandwidth is not None
+                    and col_start > row_end - 1 + self.bandwidth
+                ):
+                    continue
+                tiles.append((row_start, row_end, col_start, col_end))
+        return tiles
+
+    def cells(self, block, row_start, col_start, id_threshold):
+        """
+        Row index, column index and value of the cells of a tile to export.
+        """
+        keep = block >= id_threshold / 100
+        if self.self_identity:
+            rows = np.arange(row_start, row_start + block.shape[0])[:, None]
+            cols = np.arange(col_start, col_start + block.shape[1])[None, :]
+            keep &= cols >= rows
+            if self.bandwidth is not None:
+                keep &= cols - rows <= self.bandwidth
+        x, y = np.nonzero(keep)
+        return x + row_start, y + col_start, block[x, y]
+
+    def rowBands(self, tiles, id_threshold):
+        """
+        Compute the given tiles and yield their exported cells one row of tiles at a
+        time, sorted by row then column, so the output matches a full matrix export.
+        """
+        band = []
+        progress = ProgressReporter(len(tiles)).start()
+        try:
+            for i, (row_start, row_end, col_start, col_end) in enumerate(tiles):
+                block = self.tile(row_start, row_end, col_start, col_end)
+                band.append(self.cells(block, row_start, col_start, id_threshold))
+                progress.advance()
+                if i + 1 == len(tiles) or tiles[i + 1][0] != row_start:
+                    x, y, values = (np.concatenate(parts) for parts in zip(*band))
+                    order = np.lexsort((y, x))
+                    band = []
+                    yield x[order], y[order], values[order]
+        finally:
+            progress.stop(finished=progress.completed >= len(tiles))
+
+
+def createSelfTiles(
+    sequence_length,
+    sequence,
+    window_size,
+    sparsity,
+    delta,
+    k,
+    identity,
+    ambiguous,
+    expectation,
+    max_distance=None,
+):
+    """
+    Sketch a sequence and prepare its self-identity matrix for tiled computation.
+    """
+    mods, neighbor_mods = sketchSequence(
+        sequence_length,
+        sequence,
+        window_size,
+        sparsity,
+        delta,
+        k,
+        ambiguous,
+        expectation,
+    )
+    bandwidth = None
+    if max_distance:
+        bandwidth = math.ceil(max_distance / window_size)
+    return ContainmentTiles(
+        mods,
+        mods,
+        neighbor_mods,
+        neighbor_mods,
+        identity,
+        k,
+        ambiguous,
+        self_identity=True,
+        bandwidth=bandwidth,
+    )
+
+
+def createPairwiseTiles(
+    larger_length,
+    smaller_length,
+    larger_seq,
+    smaller_seq,
+    window_size,
+    sparsity,
+    delta,
+    k,
+    identity,
+    ambiguous,
+    expectation,
+):
+    """
+    Sketch two sequences and prepare their pairwise matrix for tiled computation.
+    Takes the same arguments as createPairwiseMatrix.
+    """
+    mods_large, neighbor_mods_large = sketchSequence(
+        larger_length,
+        larger_seq,
+        window_size,
+        sparsity,
+        delta,
+        k,
+        ambiguous,
+        expectation,
+    )
+    mods_small, neighbor_mods_small = sketchSequence(
+        smaller_length,
+        smaller_seq,
+        window_size,
+        sparsity,
+        delta,
+        k,
+        ambiguous,
+        expectation,
+    )
+    return ContainmentTiles(
+        mods_large, mods_small, neighbor_mods_large, neighbor_mods_small, identity, k
+    )
+
+
+def writeTiles(
+    tiles,
+    tile_list,
+    window_size,
+    id_threshold,
+    x_name,
+    y_name,
+    x_offset,
+    y_offset,
+    bedpe_output,
+    cool_output=None,
+    checkpoint=None,
+):
+    """
+    Compute the tiles in `tile_list` and stream them to a bedpe file, and optionally
+    a cooler file, one row of tiles at a time.
+
+    With a checkpoint, the bedpe length after each finished row of tiles is recorded.
+    A rerun truncates the bedpe file back to the last finished row and carries on
+    from there, reading the finished rows back for the cooler file.
+
+    Returns:
+        int: Number of bedpe rows written, excluding the header.
+    """
+    layout = {
+        "window_size": window_size,
+        "x_offset": x_offset,
+        "y_offset": y_offset,
+        "rows": tiles.rows,
+    }
+    band_starts = sorted({tile[0] for tile in tile_list})
+    resumed = checkpoint.get("bands") if checkpoint else None
+    if (
+        resumed
+        and os.path.exists(bedpe_output)
+        and os.path.getsize(bedpe_output) >= resumed["offset"]
+    ):
+        bands_done, written = resumed["bands"], resumed["rows"]
+        with open(bedpe_output, "r+") as bedfile:
+            bedfile.truncate(resumed["offset"])
+        print(
+            f"Resuming {bedpe_output} after {bands_done} of {len(band_starts)} rows of tiles.\n"
+        )
+        if bands_done < len(band_starts):
+            tile_list = [t for t in tile_list if t[0] >= band_starts[bands_done]]
+        else:
+            tile_list = []
+    else:
+        bands_done, written = 0, 0
+        with open(bedpe_output, "w") as bedfile:
+            bedfile.write("\t".join(BEDPE_HEADER) + "\n")
+
+    with open(bedpe_output, "a") as bedfile:
+
+        def pixelChunks():
+            nonlocal written, bands_done
+            if bands_done:
+                yield from bedpePixels(readBedpeRows(bedpe_output), layout)
+            for x, y, values in tiles.rowBands(tile_list, id_threshold):
+                for row in bedpeRows(
+                    x, y, values, window_size, x_name, y_name, x_offset, y_offset
+                ):
+                    bedfile.write("\t".join(map(str, row)) + "\n")
+                written += len(x)
+                bands_done += 1
+                if checkpoint:
+                    bedfile.flush()
+                    checkpoint.mark(
+                        "bands",
+                        {
+                            "bands": bands_done,
+                            "offset": bedfile.tell(),
+                            "rows": written,
+                        },
+                    )
+                yield pd.DataFrame(
+                    {
+                        "bin1_id": x,
+                        "bin2_id": tiles.rows + y,  # offset y bins after x bins
+                        "count": values.astype(float),
+                    }
+                )
+
+        with PROFILER.stage("tiles", items=len(tile_list)):
+            if cool_output:
+                bins = coolerBins(
+                    tiles.rows,
+                    tiles.cols,
+                    window_size,
+                    x_name,
+                    y_name,
+                    x_offset,
+                    y_offset,
+                )
+                cooler.create_cooler(
+                    cool_output, bins=bins, pixels=pixelChunks(), ordered=True
+                )
+            else:
+                for _ in pixelChunks():
+                    pass
+    return written
+
+
+def readBedpe(bedpe_path):
+    """
+    Read a bedpe file back into the list of rows returned by convertMatrixToBed.
+    """
+    df = pd.read_csv(bedpe_path, delimiter="\t", float_precision="round_trip")
+    return [BEDPE_HEADER] + list(df.itertuples(index=False, name=None))
+
+
+def shardTiles(tile_list, shard, shards):
+    """
+    Tiles belonging to one shard: tile t goes to shard t % shards. Interleaving
+    spreads the expensive rows near the diagonal evenly over the shards.
+    """
+    return tile_list[shard::shards]
+
+
+def shardPaths(bedpe_output, shard, shards):
+    """
+    Partial bedpe and JSON sidecar paths of one shard of `bedpe_output`.
+    """
+    prefix = os.path.splitext(bedpe_output)[0]
+    stem = f"{prefix}.shard-{shard}-of-{shards}"
+    return stem + ".bedpe", stem + ".json"
+
+
+def writeShard(
+    tiles,
+    tile_size,
+    shard,
+    shards,
+    window_size,
+    id_threshold,
+    x_name,
+    y_name,
+    x_offset,
+    y_offset,
+    bedpe_output,
+    cool_output,
+    params,
+    checkpoint=None,
+):
+    """
+    Compute one shard of a tiled matrix into a partial bedpe file, alongside a JSON
+    sidecar describing the matrix so mergeShards can put the shards back together.
+    The sidecar is written last, so its presence means the shard is complete.
+
+    Args:
+        tiles (ContainmentTiles): Matrix to compute.
+        tile_size (int): Windows per side of a tile.
+        shard (int): Index of this shard, from 0 to shards - 1.
+        shards (int): Total number of shards.
+        bedpe_output (str): Path of the final, merged bedpe file.
+        cool_output (str): Path of the final cooler file, if merged with --cooler.
+        params (dict): Parameters the matrix was computed with. All shards of a
+            matrix must agree on them.
+        checkpoint (Checkpoint): Records finished rows of tiles, see writeTiles.
+
+    Returns:
+        Tuple[str, int]: Partial bedpe path, and number of rows written to it.
+    """
+    tile_list = tiles.tiles(tile_size)
+    shard_tiles = shardTiles(tile_list, shard, shards)
+    shard_bedpe, sidecar = shardPaths(bedpe_output, shard, shards)
+    written = writeTiles(
+        tiles,
+        shard_tiles,
+        window_size,
+        id_threshold,
+        x_name,
+        y_name,
+        x_offset,
+        y_offset,
+        shard_bedpe,
+        checkpoint=checkpoint,
+    )
+    metadata = {
+        "bedpe": os.path.basename(bedpe_output),
+        "cooler": os.path.basename(cool_output),
+        "shard": shard,
+        "shards": shards,
+        "tile_size": tile_size,
+        "tiles": len(tile_list),
+        "shard_tiles": len(shard_tiles),
+        "rows_written": written,
+        "x_name": x_name,
+        "y_name": y_name,
+        "x_offset": x_offset,
+        "y_offset": y_offset,
+        "window_size": window_size,
+        "rows": tiles.rows,
+        "cols": tiles.cols,
+        "self_identity": tiles.self_identity,
+        "bandwidth": tiles.bandwidth,
+        "params": params,
+    }
+    with open(sidecar, "w") as f:
+        json.dump(metadata, f, indent=2)
+    return shard_bedpe, written
+
+
+def findShardSidecars(paths):
+    """
+    Shard sidecar files among `paths`, searching directories recursively.
+    """
+    sidecars = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                sidecars.extend(
+                    os.path.join(root, name)
+                    for name in sorted(files)
+                    if SHARD_PATTERN.search(name)
+                )
+        else:
+            sidecars.append(path)
+    return sidecars
+
+
+def readBedpeRows(bedpe_path):
+    """
+    Lines of a bedpe file, keyed by their query and reference start.
+    """
+    with open(bedpe_path) as f:
+        next(f)  # header
+        for line in f:
+            fields = line.split("\t", 6)
+            yield int(fields[1]), int(fields[4]), line
+
+
+def mergeShardBedpe(shard_bedpes, metadata, bedpe_output, cool_output=None):
+    """
+    Merge sorted partial bedpe files into `bedpe_output`, and optionally a cooler
+    file. Every shard is sorted by query then reference start and no cell belongs to
+    two shards, so the merged file is identical to an unsharded run.
+
+    Returns:
+        int: Number of bedpe rows written, excluding the header.
+    """
+    written = 0
+    with open(bedpe_output, "w") as bedfile:
+        bedfile.write("\t".join(BEDPE_HEADER) + "\n")
+
+        def mergedRows():
+            nonlocal written
+            for row in heapq.merge(*(readBedpeRows(path) for path in shard_bedpes)):
+                bedfile.write(row[2])
+                written += 1
+                yield row
+
+        with PROFILER.stage("merge", label=metadata["bedpe"], items=len(shard_bedpes)):
+            if cool_output:
+                bins = coolerBins(
+                    metadata["rows"],
+                    metadata["cols"],
+                    metadata["window_size"],
+                    metadata["x_name"],
+                    metadata["y_name"],
+                    metadata["x_offset"],
+                    metadata["y_offset"],
+                )
+                cooler.create_cooler(
+                    cool_output,
+                    bins=bins,
+                    pixels=bedpePixels(mergedRows(), metadata),
+                    ordered=True,
+                )
+            else:
+                for _ in mergedRows():
+                    pass
+    return written
+
+
+def bedpePixels(rows, layout):
+    """
+    Cooler pixel chunks for keyed bedpe rows from readBedpeRows, using the bin layout
+    of writeTiles.
+    """
+    x, y, values = [], [], []
+    for query_start, reference_start, line in rows:
+        x.append(query_start)
+        y.append(reference_start)
+        values.append(float(line.rsplit("\t", 1)[1]))
+        if len(x) == PIXEL_CHUNK_SIZE:
+            yield pixelFrame(x, y, values, layout)
+            x, y, values = [], [], []
+    if x:
+        yield pixelFrame(x, y, values, layout)
+
+
+def pixelFrame(query_starts, reference_starts, values, layout):
+    """
+    Cooler pixels for bedpe rows, using the bin layout of writeTiles.
+    """
+    window_size = layout["window_size"]
+    x = (np.array(query_starts) - layout["x_offset"]) // window_size
+    y = (np.array(reference_starts) - layout["y_offset"]) // window_size
+    return pd.DataFrame(
+        {
+            "bin1_id": x,
+            "bin2_id": layout["rows"] + y,
+            "count": np.array(values, dtype=float),
+        }
+    )
+
+
+def mergeShards(sidecars, output_dir=None, cool=False):
+    """
+    Group shard sidecars by matrix, check every matrix has all of its shards and
+    that they were computed with the same parameters, then merge each matrix.
+
+    Args:
+        sidecars (List[str]): Shard sidecar paths, see findShardSidecars.
+        output_dir (str): Directory for the merged files. Defaults to the directory
+            holding the shards; otherwise each matrix keeps its folder name.
+        cool (bool): Also write a cooler file per matrix.
+
+    Returns:
+        List[Tuple[str, dict, int]]: Merged bedpe path, sidecar metadata and number
+        of rows written, for each matrix.
+
+    Raises:
+        ValueError: If a shard is missing, or shards of one matrix disagree.
+    """
+    matrices = {}
+    for sidecar in sidecars:
+        with open(sidecar) as f:
+            metadata = json.load(f)
+        key = (os.path.dirname(os.path.abspath(sidecar)), metadata["bedpe"])
+        matrices.setdefault(key, []).append((sidecar, metadata))
+
+    # Fields that legitimately differ between shards of the same matrix
+    per_shard = {"shard", "shard_tiles", "rows_written"}
+    merged = []
+    for (directory, bedpe_name), shards in matrices.items():
+        shards.sort(key=lambda shard: shard[1]["shard"])
+        first = shards[0][1]
+        expected = {k: v for k, v in first.items() if k not in per_shard}
+        for sidecar, metadata in shards:
+            if {k: v for k, v in metadata.items() if k not in per_shard} != expected:
+                raise ValueError(
+                    f"Shard {sidecar} was computed with different parameters than {shards[0][0]}."
+                )
+        found = [metadata["shard"] for _, metadata in shards]
+        if found != list(range(first["shards"])):
+            missing = sorted(set(range(first["shards"])) - set(found))
+            raise ValueError(
+                f"Missing shards {missing} of {first['shards']} for {bedpe_name} in {directory}."
+            )
+
+        merge_dir = directory
+        if output_dir:
+            merge_dir = os.path.join(output_dir, os.path.basename(directory))
+        os.makedirs(merge_dir, exist_ok=True)
+        bedpe_output = os.path.join(merge_dir, bedpe_name)
+        cool_output = None
+        if cool:
+            cool_output = os.path.join(merge_dir, first["cooler"])
+        shard_bedpes = [
+            shardPaths(os.path.join(directory, bedpe_name), m["shard"], m["shards"])[0]
+            for _, m in shards
+        ]
+        written = mergeShardBedpe(shard_bedpes, first, bedpe_output, cool_output)
+        merged.append((bedpe_output, first, written))
+    return merged
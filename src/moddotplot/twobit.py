@@ -0,0 +1,134 @@
+import struct
+import numpy as np
+
+TWOBIT_SIGNATURE = 0x1A412743
+
+# Each byte of packed DNA holds four bases, first base in the high bits.
+_BASES = np.frombuffer(b"TCAG", dtype=np.uint8)
+_BYTE_TO_BASES = _BASES[
+    (np.arange(256, dtype=np.uint8)[:, None] >> np.array([6, 4, 2, 0], np.uint8)) & 3
+]
+
+
+class TwoBitFile:
+    """
+    Random-access reader for UCSC .2bit files, with the parts of the
+    pysam.FastaFile interface the rest of ModDotPlot uses.
+
+    Only the header and sequence index are read when the file is opened. `fetch`
+    reads just the packed bytes covering the requested range and decodes them
+    with a lookup table, restoring N blocks and soft-masked (lowercase) blocks.
+
+    Sequences are decoded back to strings rather than hashed straight from the
+    packed bases, so .2bit input goes through the same fetchChunks and k-mer
+    hashing path as fasta input and gives identical hashes. Decoding is a table
+    lookup per byte, small next to the hashing itself.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        try:
+            self._readIndex()
+        except Exception:
+            self._file.close()
+            raise
+
+    def _read(self, fmt, offset=None):
+        if offset is not None:
+            self._file.seek(offset)
+        size = struct.calcsize(self._order + fmt)
+        data = self._file.read(size)
+        if len(data) != size:
+            raise ValueError(f"{self.filename} is truncated")
+        return struct.unpack(self._order + fmt, data)
+
+    def _readIndex(self):
+        header = self._file.read(16)
+        if len(header) != 16:
+            raise ValueError(f"{self.filename} is not a 2bit file")
+        for order in "<>":
+            if struct.unpack(order + "I", header[:4])[0] == TWOBIT_SIGNATURE:
+                self._order = order
+                break
+        else:
+            raise ValueError(f"{self.filename} is not a 2bit file")
+        version, count, _ = struct.unpack(self._order + "III", header[4:])
+        if version not in (0, 1):
+            raise ValueError(f"Unsupported 2bit version {version} in {self.filename}")
+        # Version 1 files use 64-bit offsets, for files over 4 GB
+        offset_format = "Q" if version == 1 else "I"
+
+        offsets = []
+        self.references = []
+        for _ in range(count):
+            (name_size,) = self._read("B")
+            self.references.append(self._file.read(name_size).decode())
+            offsets.append(self._read(offset_format)[0])
+
+        self._records = {}
+        self.lengths = []
+        for name, offset in zip(self.references, offsets):
+            dna_size, n_count = self._read("II", offset)
+            n_blocks = np.array(self._read(f"{2 * n_count}I"), dtype=np.int64)
+            (mask_count,) = self._read("I")
+            mask_blocks = np.array(self._read(f"{2 * mask_count}I"), dtype=np.int64)
+            self._read("I")  # reserved
+            # Blocks are stored as starts then sizes; keep starts and ends
+            self._records[name] = (
+                dna_size,
+                self._file.tell(),
+                n_blocks[:n_count],
+                n_blocks[:n_count] + n_blocks[n_count:],
+                mask_blocks[:mask_count],
+                mask_blocks[:mask_count] + mask_blocks[mask_count:],
+            )
+            self.lengths.append(dna_size)
+
+    def get_reference_length(self, reference):
+        return self._records[reference][0]
+
+    def fetch(self, reference, start=None, end=None):
+        """
+        Bases [start, end) of `reference`, 0-based, as an uppercase/lowercase
+        string like pysam.FastaFile.fetch.
+        """
+        dna_size, dna_offset, n_starts, n_ends, mask_starts, mask_ends = self._records[
+            reference
+        ]
+        start = 0 if start is None else max(start, 0)
+        end = dna_size if end is None else min(end, dna_size)
+        if start >= end:
+            return ""
+        first_byte = start // 4
+        self._file.seek(dna_offset + first_byte)
+        packed = np.frombuffer(
+            self._file.read((end + 3) // 4 - first_byte), dtype=np.uint8
+        )
+        bases = _BYTE_TO_BASES[packed].ravel()[start - first_byte * 4 :][: end - start]
+        for lo, hi in self._overlaps(n_starts, n_ends, start, end):
+            bases[lo:hi] = ord("N")
+        for lo, hi in self._overlaps(mask_starts, mask_ends, start, end):
+            bases[lo:hi] |= 32  # lowercase
+        return bases.tobytes().decode("ascii")
+
+    @staticmethod
+    def _overlaps(block_starts, block_ends, start, end):
+        # Blocks are sorted and disjoint, so binary search for those overlapping
+        # [start, end) and clip them to it
+        first = np.searchsorted(block_ends, start, side="right")
+        last = np.searchsorted(block_starts, end)
+        for block_start, block_end in zip(
+            block_starts[first:last], block_ends[first:last]
+        ):
+            yield max(block_start, start) - start, min(block_end, end) - start
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
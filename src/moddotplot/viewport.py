@@ -0,0 +1,426 @@
+import base64
+import io
+import math
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+from plotly.colors import sample_colorscale, unlabel_rgb
+
+# Palette index of empty cells (no identity, or below the identity threshold).
+# Indices 1-255 cover identity..100 in equal steps.
+EMPTY_INDEX = 0
+IDENTITY_LEVELS = 255
+
+# Largest number of cells per side sent to the browser for hover labels.
+HOVER_CELLS = 200
+
+# Default memory cap of the interactive viewport cache, in MB.
+VIEWPORT_CACHE_MB = 256
+
+
+def quantizeIdentity(view, identity):
+    """
+    Map identity values onto palette indices, so the colours of a rendered image
+    can change without touching its pixels.
+
+    Args:
+        view (np.ndarray): Identity values, 0 (or below `identity`) for empty cells.
+        identity (float): Identity threshold the matrix was computed with.
+
+    Returns:
+        np.ndarray: uint8 indices of the same shape. Empty cells get EMPTY_INDEX,
+        anything else 1 + its position between `identity` and 100 in
+        IDENTITY_LEVELS - 1 steps.
+    """
+    scaled = (np.asarray(view, dtype=np.float32) - identity) * (
+        (IDENTITY_LEVELS - 1) / max(100 - identity, 1e-9)
+    )
+    indices = np.rint(np.clip(scaled, 0, IDENTITY_LEVELS - 1)).astype(np.uint8) + 1
+    indices[~(view >= identity) | (view <= 0)] = EMPTY_INDEX
+    return indices
+
+
+def levelValues(identity):
+    """
+    Identity value each palette index stands for. EMPTY_INDEX maps to 0.
+    """
+    values = np.empty(IDENTITY_LEVELS + 1, dtype=np.float64)
+    values[EMPTY_INDEX] = 0
+    values[1:] = identity + np.arange(IDENTITY_LEVELS) * (
+        (100 - identity) / (IDENTITY_LEVELS - 1)
+    )
+    return values
+
+
+def colorLut(colorscale, size=256):
+    """
+    A plotly colorscale sampled at `size` evenly spaced positions.
+
+    Returns:
+        np.ndarray: (size, 3) uint8 RGB values.
+    """
+    colors = sample_colorscale(colorscale, np.linspace(0, 1, size).tolist())
+    return np.array([unlabel_rgb(color) for color in colors]).round().astype(np.uint8)
+
+
+def identityPalette(colorscale, identity, zmin, zmax, threshold_range):
+    """
+    RGB colour of each palette index, matching how a plotly heatmap with the same
+    colorscale and zmin/zmax would draw the value it stands for. Values outside
+    `threshold_range` are drawn like empty cells. The browser rebuilds the same
+    palette in RESTYLE_VIEWPORT_JS, so keep the two in step.
+
+    Returns:
+        np.ndarray: (256, 3) uint8 palette.
+    """
+    values = levelValues(identity)
+    masked = (values < threshold_range[0]) | (values > threshold_range[1])
+    values[masked] = 0
+    positions = np.clip((values - zmin) / max(zmax - zmin, 1e-9), 0, 1)
+    lut = colorLut(colorscale)
+    return lut[np.floor(positions * (len(lut) - 1) + 0.5).astype(np.intp)]
+
+
+def encodePng(indices, palette=None):
+    """
+    Encode a matrix of palette indices as a palette PNG, with row 0 at the bottom
+    as on a plot's y axis. Without a palette every index is black, for images
+    coloured later with setPngPalette.
+
+    Returns:
+        bytes: PNG file contents.
+    """
+    if palette is None:
+        palette = np.zeros((IDENTITY_LEVELS + 1, 3), dtype=np.uint8)
+    image = Image.fromarray(np.ascontiguousarray(indices[::-1]), mode="L")
+    image.putpalette(palette.tobytes())
+    buffer = io.BytesIO()
+    # Palette images compress well already, favour speed
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def setPngPalette(png, palette):
+    """
+    Swap the palette of a PNG written by encodePng, leaving the pixel data alone.
+
+    Returns:
+        bytes: PNG file contents.
+    """
+    offset = 8  # signature
+    while offset + 12 <= len(png):
+        (length,) = struct.unpack(">I", png[offset : offset + 4])
+        if png[offset + 4 : offset + 8] == b"PLTE":
+            chunk = b"PLTE" + palette.tobytes()[:length].ljust(length, b"\0")
+            return b"".join(
+                [
+                    png[: offset + 4],
+                    chunk,
+                    struct.pack(">I", zlib.crc32(chunk)),
+                    png[offset + 12 + length :],
+                ]
+            )
+        offset += length + 12
+    raise ValueError("PNG has no palette")
+
+
+def pngDataUri(png):
+    return "data:image/png;base64," + base64.b64encode(png).decode("ascii")
+
+
+def hoverGrid(view, x_axis, y_axis, max_cells=HOVER_CELLS):
+    """
+    Coarse grid over a viewport for hover labels and the colorbar, at most
+    `max_cells` cells per side.
+
+    Args:
+        view (np.ndarray): Viewport rows (y) by columns (x).
+        x_axis, y_axis: Start coordinate of each column / row of `view`, plus the
+            end coordinate of the last one.
+
+    Returns:
+        Tuple: (z, x, y) for a go.Heatmap whose cells line up with the rendered
+        image. Each hover cell covers a block of viewport cells and holds the
+        highest identity among them; x and y hold the edges of the blocks, taken
+        from the axes so they fall on window boundaries.
+    """
+    rows, cols = view.shape
+    row_starts = np.arange(0, rows, max(1, math.ceil(rows / max_cells)))
+    col_starts = np.arange(0, cols, max(1, math.ceil(cols / max_cells)))
+    z = np.maximum.reduceat(view, row_starts, axis=0)
+    z = np.maximum.reduceat(z, col_starts, axis=1)
+    return (
+        z,
+        np.append(x_axis[col_starts], x_axis[-1]),
+        np.append(y_axis[row_starts], y_axis[-1]),
+    )
+
+
+def typedArray(array):
+    """
+    plotly.js typed array spec of a 2D array, as plotly builds for figures. Far
+    smaller than a nested JSON list when sent in a partial (Patch) update.
+    """
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    return {
+        "dtype": "f4",
+        "bdata": base64.b64encode(array.tobytes()).decode("ascii"),
+        "shape": ", ".join(map(str, array.shape)),
+    }
+
+
+def pyramidAxes(pyramid, info):
+    """
+    Axes of every layer of a pyramid, evenly dividing each sequence: the x axis
+    then the y axis of each layer, each holding the start of every column / row
+    plus the end of the last one.
+    """
+    axes = []
+    for layer in pyramid:
+        # Rows run along the y axis, columns along the x axis
+        axes.append(np.linspace(0, info["x_size"], layer.shape[1] + 1))
+        axes.append(np.linspace(0, info["y_size"], layer.shape[0] + 1))
+    return axes
+
+
+class ViewportResolver:
+    """
+    Resolves an axis range on screen into the pyramid layer to draw it from and
+    the rows and columns of that layer covering it.
+
+    Layer i is the one drawn for spans between x_size / 2**i and
+    x_size / 2**(i + 1), finer layers for anything narrower. Axes are converted
+    to arrays once, so each lookup is a few binary searches, and viewports are
+    views of the layers rather than copies.
+
+    Args:
+        layers (list): Matrices of the pyramid, coarsest first, rows along y.
+        axes (list): x axis then y axis of each layer, as built for run_dash:
+            the start of each column / row, plus the end of the last one.
+        x_size (int): Length of the x axis sequence.
+    """
+
+    def __init__(self, layers, axes, x_size):
+        self.layers = layers
+        self.x_axes = [np.asarray(axis, dtype=np.float64) for axis in axes[0::2]]
+        self.y_axes = [np.asarray(axis, dtype=np.float64) for axis in axes[1::2]]
+        # Smallest span for each layer but the coarsest, ascending
+        self._spans = x_size / 2.0 ** np.arange(len(layers) - 1, 0, -1)
+
+    def level(self, span):
+        """
+        Pyramid layer to draw an x span of `span` from.
+        """
+        return len(self._spans) - int(np.searchsorted(self._spans, span, side="right"))
+
+    @staticmethod
+    def _cells(axis, start, end):
+        # Cells overlapping [start, end], at least one
+        cells = len(axis) - 1
+        first = int(np.searchsorted(axis, start, side="right")) - 1
+        first = min(max(first, 0), cells - 1)
+        last = int(np.searchsorted(axis, end, side="left"))
+        return slice(first, min(max(last, first + 1), cells))
+
+    def resolve(self, x_start, x_end, y_start, y_end):
+        """
+        Layer and cells covering an axis range.
+
+        Returns:
+            Tuple: (level, rows, cols), with rows and cols as slices of the layer.
+        """
+        level = self.level(x_end - x_start)
+        rows = self._cells(self.y_axes[level], y_start, y_end)
+        cols = self._cells(self.x_axes[level], x_start, x_end)
+        return level, rows, cols
+
+    def view(self, level, rows, cols):
+        """
+        Cells of a layer, with the axis coordinates bounding them.
+
+        Returns:
+            Tuple: (view, x_axis, y_axis). `view` is a view of the layer, x_axis
+            and y_axis hold one more entry than it has columns / rows.
+        """
+        return (
+            self.layers[level][rows, cols],
+            self.x_axes[level][cols.start : cols.stop + 1],
+            self.y_axes[level][rows.start : rows.stop + 1],
+        )
+
+    def cell(self, level, x, y):
+        """
+        Row and column of the cell of a layer holding the point (x, y).
+        """
+        rows = self._cells(self.y_axes[level], y, y)
+        cols = self._cells(self.x_axes[level], x, x)
+        return rows.start, cols.start
+
+
+class ViewportCache:
+    """
+    Least recently used cache of rendered viewports, bounded by memory.
+
+    Entries are evicted oldest first once the sizes passed to `put` add up to more
+    than `max_bytes`. Safe to share between the threads serving callbacks. Hits
+    and misses are counted for reporting.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self._entries.popitem(last=False)[1][1]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def summary(self):
+        return (
+            f"Viewport cache: {self.hits} hits, {self.misses} misses, "
+            f"{len(self)} views ({self.nbytes / 2**20:.1f} MB)"
+        )
+
+
+# Clientside callback recolouring the viewport on screen when the palette, identity
+# threshold or gradient option changes. Builds the same palette as identityPalette
+# from the lookup tables in the palette store and swaps it into the PNG's PLTE
+# chunk, so neither the pixels nor the server are touched.
+RESTYLE_VIEWPORT_JS = """
+function(color, thresholdRange, gradient, figure, store) {
+    const images = figure && figure.layout && figure.layout.images;
+    const palette = store.palettes[color];
+    if (!images || !images.length || !palette) {
+        return window.dash_clientside.no_update;
+    }
+    const identity = store.identity;
+    const levels = store.levels;
+    let zmin = identity;
+    let zmax = 100;
+    if (gradient && gradient.includes("keep-original")) {
+        [zmin, zmax] = thresholdRange;
+    }
+    const lutSize = palette.lut.length / 6;
+    const rgb = new Uint8Array(3 * (levels + 1));
+    for (let k = 0; k <= levels; k++) {
+        let value = k === 0 ? 0 : identity + (k - 1) * ((100 - identity) / (levels - 1));
+        if (value < thresholdRange[0] || value > thresholdRange[1]) {
+            value = 0;
+        }
+        const t = Math.min(Math.max((value - zmin) / Math.max(zmax - zmin, 1e-9), 0), 1);
+        const entry = Math.floor(t * (lutSize - 1) + 0.5) * 6;
+        for (let c = 0; c < 3; c++) {
+            rgb[3 * k + c] = parseInt(palette.lut.substr(entry + 2 * c, 2), 16);
+        }
+    }
+
+    const prefix = "data:image/png;base64,";
+    const binary = atob(images[0].source.slice(prefix.length));
+    const png = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        png[i] = binary.charCodeAt(i);
+    }
+    const crcTable = new Uint32Array(256);
+    for (let n = 0; n < 256; n++) {
+        let c = n;
+        for (let k = 0; k < 8; k++) {
+            c = c & 1 ? 0xedb88320 ^ (c >>> 1) : c >>> 1;
+        }
+        crcTable[n] = c >>> 0;
+    }
+    const view = new DataView(png.buffer);
+    for (let offset = 8; offset + 12 <= png.length; ) {
+        const length = view.getUint32(offset);
+        const type = String.fromCharCode(...png.subarray(offset + 4, offset + 8));
+        if (type === "PLTE") {
+            png.set(rgb.subarray(0, length), offset + 8);
+            let crc = 0xffffffff;
+            for (const byte of png.subarray(offset + 4, offset + 8 + length)) {
+                crc = crcTable[(crc ^ byte) & 0xff] ^ (crc >>> 8);
+            }
+            view.setUint32(offset + 8 + length, (crc ^ 0xffffffff) >>> 0);
+            break;
+        }
+        offset += length + 12;
+    }
+    let encoded = "";
+    for (let i = 0; i < png.length; i += 0x8000) {
+        encoded += String.fromCharCode(...png.subarray(i, i + 0x8000));
+    }
+
+    const newFigure = Object.assign({}, figure);
+    newFigure.data = figure.data.slice();
+    newFigure.data[0] = Object.assign({}, figure.data[0], {
+        colorscale: palette.colorscale,
+        zmin: zmin,
+        zmax: zmax,
+    });
+    newFigure.layout = Object.assign({}, figure.layout);
+    newFigure.layout.images = images.slice();
+    newFigure.layout.images[0] = Object.assign({}, images[0], {
+        source: prefix + btoa(encoded),
+    });
+    return newFigure;
+}
+"""
+
+
+# Clientside callback filling the hover tooltip. The hover heatmap's x and y hold
+# the edges of its cells, taken from the layer's axes (see hoverGrid), so the
+# interval under the cursor is the pair of edges around the point's coordinates,
+# with nothing extra sent per zoom. When its cells are blocks of several windows
+# (trace.meta.blocks), a cell's value is the highest identity in its block and is
+# labelled as such.
+HOVER_INTERVALS_JS = """
+function(hoverData, figure) {
+    const noUpdate = window.dash_clientside.no_update;
+    if (!hoverData || !figure) {
+        return [false, noUpdate, noUpdate];
+    }
+    const point = hoverData.points[0];
+    const trace = figure.data[0];
+    const interval = (edges, centre) => {
+        let i = 0;
+        while (i < edges.length - 2 && edges[i + 1] <= centre) {
+            i++;
+        }
+        return Math.round(edges[i]) + "-" + Math.round(edges[i + 1]);
+    };
+    return [
+        true,
+        point.bbox,
+        [
+            figure.layout.xaxis.title.text + ": " + interval(trace.x, point.x),
+            figure.layout.yaxis.title.text + ": " + interval(trace.y, point.y),
+            (trace.meta && trace.meta.blocks ? "Max identity: " : "Identity: ") +
+                Number(point.z).toFixed(2),
+        ].join("\\n"),
+    ];
+}
+"""
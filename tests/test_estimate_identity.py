@@ -0,0 +1,62 @@
+import numpy as np
+
+from moddotplot.estimate_identity import (
+    ambiguousHashes,
+    partitionOffsets,
+    sketchModimizers,
+)
+
+K = 21
+
+
+def halvingSketch(window, sparsity, expectation, ambiguous):
+    # Reference definition: halve the sparsity until the window has at least half
+    # the expected modimizers
+    while True:
+        sketch = set(window[window % sparsity == 0].tolist())
+        if not ambiguous:
+            sketch -= ambiguousHashes(K)
+        if len(sketch) >= round(expectation / 2) or sparsity == 1:
+            return sketch
+        sparsity //= 2
+
+
+def lowComplexityKmers(seed=0):
+    rng = np.random.default_rng(seed)
+    kmers = rng.integers(-(2**31), 2**31, 20000, dtype=np.int64).astype(np.int32)
+    # A satellite-like stretch cycling through a handful of odd hashes, with a
+    # single hash divisible by 16, and an ambiguous homopolymer run
+    repeat = rng.integers(-(2**30), 2**30, 40, dtype=np.int64) * 2 + 1
+    repeat[0] = 16 * 12345
+    kmers[4000:9000] = np.resize(repeat, 5000)
+    kmers[12000:12500] = next(iter(ambiguousHashes(K)))
+    return kmers
+
+
+def checkSketches(kmers, window, sparsity, ambiguous):
+    expectation = round(window / sparsity)
+    starts, ends = partitionOffsets(window, 0, len(kmers), K)
+    sketches = sketchModimizers(
+        kmers, starts, ends, sparsity, ambiguous, K, expectation
+    )
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        sketch = sketches.values[sketches.offsets[i] : sketches.offsets[i + 1]]
+        assert len(sketch) == len(set(sketch.tolist()))
+        assert set(sketch.tolist()) == halvingSketch(
+            kmers[start:end], sparsity, expectation, ambiguous
+        )
+
+
+def test_low_complexity_windows_fall_back_to_lower_sparsity():
+    kmers = lowComplexityKmers()
+    checkSketches(kmers, 1000, 16, ambiguous=False)
+    # The satellite windows only have one hash divisible by 16, so their sketch
+    # must come from a lower sparsity
+    starts, ends = partitionOffsets(1000, 0, len(kmers), K)
+    sketches = sketchModimizers(kmers, starts, ends, 16, False, K, 62)
+    satellite = np.searchsorted(starts, 5000, side="right") - 1
+    assert np.diff(sketches.offsets)[satellite] >= 31
+
+
+def test_ambiguous_homopolymers_are_kept_when_asked():
+    checkSketches(lowComplexityKmers(1), 500, 8, ambiguous=True)
@@ -0,0 +1,78 @@
+import os
+
+import pysam
+import pytest
+
+from moddotplot import parse_fasta
+from moddotplot.parse_fasta import (
+    fastaIndexPaths,
+    hashSequence,
+    isValidFasta,
+    readFastaIndex,
+)
+
+RECORDS = {"chr1": "ACGTACGTTTGACCA" * 7, "chr2": "GGGTTTAACCCA" * 5}
+
+
+@pytest.fixture
+def fasta(tmp_path, request):
+    directory = tmp_path / "input"
+    directory.mkdir()
+    path = directory / "test.fa"
+    with open(path, "w") as f:
+        for name, sequence in RECORDS.items():
+            f.write(f">{name}\n{sequence}\n")
+    if request.param == "bgzip":
+        pysam.tabix_compress(str(path), str(path) + ".gz")
+        path = directory / "test.fa.gz"
+    return str(path)
+
+
+@pytest.fixture
+def readOnlyInput(tmp_path, monkeypatch):
+    # Tests may run as root, which can write anywhere, so fake the permissions
+    cache = tmp_path / "cache"
+    monkeypatch.setattr(parse_fasta, "FASTA_INDEX_CACHE", str(cache))
+    access = os.access
+    read_only = str(tmp_path / "input")
+    monkeypatch.setattr(
+        os,
+        "access",
+        lambda path, mode: access(path, mode)
+        and not (mode & os.W_OK and str(path).startswith(read_only)),
+    )
+    return cache
+
+
+@pytest.mark.parametrize("fasta", ["plain", "bgzip"], indirect=True)
+def test_index_is_cached_when_input_is_read_only(fasta, readOnlyInput):
+    assert isValidFasta(fasta)
+    assert readFastaIndex(fasta) == (list(RECORDS), list(map(len, RECORDS.values())))
+    assert not os.path.exists(fasta + ".fai")
+    fai, _ = fastaIndexPaths(fasta)
+    assert fai.startswith(str(readOnlyInput)) and os.path.exists(fai)
+    kmers = hashSequence(fasta, "chr2", 5, True)
+    assert len(kmers) == len(RECORDS["chr2"]) - 4
+
+
+@pytest.mark.parametrize("fasta", ["plain"], indirect=True)
+def test_index_is_written_next_to_input(fasta):
+    assert isValidFasta(fasta)
+    assert fastaIndexPaths(fasta)[0] == fasta + ".fai"
+    assert os.path.exists(fasta + ".fai")
+
+
+@pytest.mark.parametrize("fasta", ["plain"], indirect=True)
+def test_unwritable_index_is_reported(fasta, readOnlyInput, capsys):
+    readOnlyInput.write_text("not a directory")
+    with pytest.raises(PermissionError, match="Unable to write the index"):
+        readFastaIndex(fasta)
+    with pytest.raises(SystemExit):
+        isValidFasta(fasta)
+    assert "Unable to write the index" in capsys.readouterr().out
+
+
+def test_malformed_fasta_is_invalid(tmp_path):
+    path = tmp_path / "test.fa"
+    path.write_text("not a fasta\n")
+    assert not isValidFasta(str(path))
@@ -0,0 +1,27 @@
+import threading
+
+import pytest
+
+from moddotplot.pipeline import BackgroundStage
+
+
+def test_failed_task_stops_the_stage_for_good():
+    release = threading.Event()
+    ran = []
+
+    def fail():
+        release.wait()
+        raise ValueError("task failed")
+
+    stage = BackgroundStage("test")
+    stage.submit(fail)
+    stage.submit(ran.append, 1)
+    release.set()
+    with pytest.raises(ValueError):
+        stage.close()
+    # Raising the error doesn't clear it: later tasks are still refused
+    with pytest.raises(ValueError):
+        stage.submit(ran.append, 2)
+    with pytest.raises(ValueError):
+        stage.close()
+    assert ran == []
@@ -0,0 +1,144 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from moddotplot.pyramids import PyramidStore
+
+TIMEOUT = 5
+
+
+class GatedBuilds:
+    """
+    Pyramid builder whose layers are only produced once released, so tests decide
+    exactly how far each background build gets.
+    """
+
+    def __init__(self, depth, released=0):
+        self.depth = depth
+        self.released = released
+        self.calls = []
+        self.started = {}
+        self._cond = threading.Condition()
+
+    def release(self, layers):
+        with self._cond:
+            self.released = layers
+            self._cond.notify_all()
+
+    def __call__(self, index):
+        self.calls.append(index)
+        self.started.setdefault(index, threading.Event()).set()
+        return self._layers(index)
+
+    def _layers(self, index):
+        for level in range(self.depth):
+            with self._cond:
+                if not self._cond.wait_for(
+                    lambda: self.released > level, timeout=TIMEOUT
+                ):
+                    raise TimeoutError(f"Layer {level} of matrix {index} not released")
+            yield np.full((2**level, 2**level), index)
+
+    def waitStarted(self, index):
+        assert self.started.setdefault(index, threading.Event()).wait(TIMEOUT)
+
+
+def waitForLayers(store, index, layers):
+    deadline = time.monotonic() + TIMEOUT
+    while store.progress(index)[0] < layers:
+        assert (
+            time.monotonic() < deadline
+        ), f"Matrix {index} stuck at {store.progress(index)}"
+        time.sleep(0.001)
+
+
+def test_least_recently_used_pyramid_is_evicted():
+    builds = GatedBuilds(depth=1, released=1)
+    store = PyramidStore(builds, count=4, depth=1, capacity=2)
+    store[0]
+    store[1]
+    store[0]  # now the most recently used
+    store[2]
+    assert [store.loaded(i) for i in range(4)] == [True, False, True, False]
+    store[3]
+    assert [store.loaded(i) for i in range(4)] == [False, False, True, True]
+    # Dropped pyramids are rebuilt when asked for again
+    assert store[1][0][0, 0] == 1
+    assert builds.calls == [0, 1, 2, 3, 1]
+
+
+def test_prefetch_never_evicts_the_pyramid_on_screen():
+    builds = GatedBuilds(depth=1, released=1)
+    store = PyramidStore(builds, count=4, depth=1, capacity=2)
+    store[0]
+    store[1]
+    store.prefetch([2, 3])  # only one fits next to the pyramid on screen
+    builds.waitStarted(2)
+    waitForLayers(store, 2, 1)
+    assert [store.loaded(i) for i in range(4)] == [False, True, True, False]
+    assert builds.calls == [0, 1, 2]
+
+
+def test_layers_requested_before_background_build_finishes():
+    builds = GatedBuilds(depth=3, released=1)
+    store = PyramidStore(builds, count=1, depth=3)
+    pyramid = store[0]
+    # Only the coarsest layer is waited for
+    assert len(pyramid) == 1
+    assert store.progress(0) == (1, 3)
+    assert not store.complete(0)
+    # Asking again doesn't wait for, or restart, the background build
+    assert store[0] is pyramid
+
+    builds.release(2)
+    waitForLayers(store, 0, 2)
+    builds.release(3)
+    waitForLayers(store, 0, 3)
+    assert store.complete(0)
+    assert [layer.shape for layer in pyramid] == [(1, 1), (2, 2), (4, 4)]
+    assert builds.calls == [0]
+
+
+def test_request_waits_for_a_prefetch_in_progress():
+    builds = GatedBuilds(depth=2)
+    store = PyramidStore(builds, count=2, depth=2)
+    store.prefetch([1])
+    builds.waitStarted(1)
+
+    result = []
+    request = threading.Thread(target=lambda: result.append(store[1]))
+    request.start()
+    request.join(0.05)
+    assert request.is_alive()  # waiting for the prefetch's coarsest layer
+    builds.release(1)
+    request.join(TIMEOUT)
+    assert not request.is_alive()
+    assert len(result[0]) >= 1 and result[0][0].shape == (1, 1)
+    # The prefetched build was reused rather than started again
+    assert builds.calls == [1]
+    builds.release(2)
+    waitForLayers(store, 1, 2)
+
+
+def test_failed_prefetch_is_raised_then_retried():
+    attempts = []
+
+    def build(index):
+        # Only the first attempt fails, on its coarsest layer
+        attempts.append(index)
+        if len(attempts) == 1:
+            raise ValueError("build failed")
+        yield np.zeros((1, 1))
+
+    store = PyramidStore(build, count=2, depth=1)
+    store.prefetch([1])
+    deadline = time.monotonic() + TIMEOUT
+    while 1 not in store._errors:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+    with pytest.raises(ValueError, match="build failed"):
+        store[1]
+    assert store[1][0].shape == (1, 1)
+    assert attempts == [1, 1]
@@ -0,0 +1,232 @@
+import cooler
+import numpy as np
+import pandas as pd
+import pytest
+
+from moddotplot.checkpoint import Checkpoint
+from moddotplot.estimate_identity import (
+    convertMatrixToBed,
+    convertMatrixToCool,
+    createPairwiseMatrix,
+    createSelfMatrix,
+)
+from moddotplot.tiling import (
+    createPairwiseTiles,
+    createSelfTiles,
+    findShardSidecars,
+    mergeShards,
+    writeShard,
+    writeTiles,
+)
+
+K = 21
+WINDOW = 200
+SPARSITY = 4
+DELTA = 0.5
+IDENTITY = 80
+EXPECTATION = round(WINDOW / SPARSITY)
+TILE_SIZE = 7
+X_OFFSET = 1000
+Y_OFFSET = 5000
+
+
+def repetitiveKmers(length, seed=0, unit=1000, mutation_rate=0.05):
+    # Mutated copies of a random repeat unit, so that plenty of window pairs score
+    # above the identity threshold. The repeat unit is the same for every seed, only
+    # the mutations differ.
+    repeat = np.random.default_rng(0).integers(-(2**31), 2**31, unit, dtype=np.int64)
+    kmers = np.resize(repeat.astype(np.int32), length)
+    rng = np.random.default_rng(seed)
+    mutated = rng.random(length) < mutation_rate
+    kmers[mutated] = rng.integers(
+        -(2**31), 2**31, mutated.sum(), dtype=np.int64
+    ).astype(np.int32)
+    return kmers
+
+
+def writeDense(bed, path):
+    # Same as exportSelfMatrix/exportPairwiseMatrix
+    with open(path, "w") as bedfile:
+        for row in bed:
+            bedfile.write("\t".join(map(str, row)) + "\n")
+
+
+def readBytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def assertSameCooler(path, expected_path):
+    result, expected = cooler.Cooler(str(path)), cooler.Cooler(str(expected_path))
+    pd.testing.assert_frame_equal(result.bins()[:], expected.bins()[:])
+    pd.testing.assert_frame_equal(result.pixels()[:], expected.pixels()[:])
+
+
+def selfIdentity(max_distance=None):
+    kmers = repetitiveKmers(6000)
+    args = (len(kmers), kmers, WINDOW, SPARSITY, DELTA, K, IDENTITY, False)
+    matrix = createSelfMatrix(*args, EXPECTATION, max_distance)
+    tiles = createSelfTiles(*args, EXPECTATION, max_distance)
+    return matrix, tiles
+
+
+def pairwise():
+    larger, smaller = repetitiveKmers(6000, seed=1), repetitiveKmers(4400, seed=2)
+    args = (
+        len(larger),
+        len(smaller),
+        larger,
+        smaller,
+        WINDOW,
+        SPARSITY,
+        DELTA,
+        K,
+        IDENTITY,
+        False,
+        EXPECTATION,
+    )
+    return createPairwiseMatrix(*args), createPairwiseTiles(*args)
+
+
+def denseOutputs(tmp_path, matrix, self_identity, banded=False):
+    y_offset = X_OFFSET if self_identity else Y_OFFSET
+    bed_args = (matrix, WINDOW, IDENTITY, "x", "y", self_identity, X_OFFSET, y_offset)
+    bed = convertMatrixToBed(*bed_args, banded=banded)
+    assert len(bed) > TILE_SIZE
+    bedpe = tmp_path / "dense.bedpe"
+    writeDense(bed, bedpe)
+    cool = tmp_path / "dense.cool"
+    convertMatrixToCool(*bed_args, None, str(cool), banded=banded)
+    return bedpe, cool
+
+
+@pytest.mark.parametrize("max_distance", [None, 1000])
+def test_self_tiles_match_dense_output(tmp_path, max_distance):
+    matrix, tiles = selfIdentity(max_distance)
+    dense_bedpe, dense_cool = denseOutputs(
+        tmp_path, matrix, True, banded=bool(max_distance)
+    )
+    bedpe, cool = tmp_path / "tiled.bedpe", tmp_path / "tiled.cool"
+    written = writeTiles(
+        tiles,
+        tiles.tiles(TILE_SIZE),
+        WINDOW,
+        IDENTITY,
+        "x",
+        "y",
+        X_OFFSET,
+        X_OFFSET,
+        str(bedpe),
+        str(cool),
+    )
+    assert readBytes(bedpe) == readBytes(dense_bedpe)
+    assert written == readBytes(dense_bedpe).count(b"\n") - 1
+    assertSameCooler(cool, dense_cool)
+
+
+def test_pairwise_tiles_match_dense_output(tmp_path):
+    matrix, tiles = pairwise()
+    assert tiles.rows != tiles.cols
+    dense_bedpe, dense_cool = denseOutputs(tmp_path, matrix, False)
+    bedpe, cool = tmp_path / "tiled.bedpe", tmp_path / "tiled.cool"
+    writeTiles(
+        tiles,
+        tiles.tiles(TILE_SIZE),
+        WINDOW,
+        IDENTITY,
+        "x",
+        "y",
+        X_OFFSET,
+        Y_OFFSET,
+        str(bedpe),
+        str(cool),
+    )
+    assert readBytes(bedpe) == readBytes(dense_bedpe)
+    assertSameCooler(cool, dense_cool)
+
+
+def test_write_tiles_resumes_after_truncation(tmp_path):
+    matrix, tiles = selfIdentity()
+    dense_bedpe, dense_cool = denseOutputs(tmp_path, matrix, True)
+    tile_list = tiles.tiles(TILE_SIZE)
+    band_starts = sorted({tile[0] for tile in tile_list})
+    assert len(band_starts) > 2
+    bedpe, cool = tmp_path / "tiled.bedpe", tmp_path / "tiled.cool"
+    args = (WINDOW, IDENTITY, "x", "y", X_OFFSET, X_OFFSET, str(bedpe))
+
+    # Interrupted run: the first two rows of tiles finished, the third was half
+    # written when it stopped
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint"), {"test": 1})
+    first_bands = [tile for tile in tile_list if tile[0] < band_starts[2]]
+    writeTiles(tiles, first_bands, *args, checkpoint=checkpoint)
+    finished = readBytes(bedpe)
+    with open(bedpe, "ab") as f:
+        f.write(b"x\t12345\t")
+    assert checkpoint.get("bands")["offset"] == len(finished)
+
+    resumed = Checkpoint(str(tmp_path / "checkpoint"), {"test": 1})
+    assert resumed.get("bands")["bands"] == 2
+    written = writeTiles(tiles, tile_list, *args, str(cool), resumed)
+    assert readBytes(bedpe) == readBytes(dense_bedpe)
+    assert written == readBytes(dense_bedpe).count(b"\n") - 1
+    assert resumed.get("bands")["bands"] == len(band_starts)
+    # The cooler file holds the rows read back from the bedpe file too
+    assertSameCooler(cool, dense_cool)
+
+
+def writeShards(tiles, directory, shards, y_offset, params=None):
+    directory.mkdir()
+    for shard in range(shards):
+        writeShard(
+            tiles,
+            TILE_SIZE,
+            shard,
+            shards,
+            WINDOW,
+            IDENTITY,
+            "x",
+            "y",
+            X_OFFSET,
+            y_offset,
+            str(directory / "matrix.bedpe"),
+            str(directory / "matrix.cool"),
+            params or {"identity": IDENTITY},
+        )
+
+
+@pytest.mark.parametrize("self_identity", [True, False])
+def test_merged_shards_match_dense_output(tmp_path, self_identity):
+    if self_identity:
+        (matrix, tiles), y_offset = selfIdentity(), X_OFFSET
+    else:
+        (matrix, tiles), y_offset = pairwise(), Y_OFFSET
+    dense_bedpe, dense_cool = denseOutputs(tmp_path, matrix, self_identity)
+    shards = 3
+    assert len(tiles.tiles(TILE_SIZE)) > shards
+    writeShards(tiles, tmp_path / "shards", shards, y_offset)
+
+    sidecars = findShardSidecars([str(tmp_path / "shards")])
+    assert len(sidecars) == shards
+    merged = mergeShards(sidecars, str(tmp_path / "merged"), cool=True)
+    assert len(merged) == 1
+    bedpe, metadata, written = merged[0]
+    assert bedpe == str(tmp_path / "merged" / "shards" / "matrix.bedpe")
+    assert metadata["shards"] == shards
+    assert readBytes(bedpe) == readBytes(dense_bedpe)
+    assert written == readBytes(dense_bedpe).count(b"\n") - 1
+    assertSameCooler(tmp_path / "merged" / "shards" / "matrix.cool", dense_cool)
+
+
+def test_merge_rejects_missing_or_mismatched_shards(tmp_path):
+    _, tiles = selfIdentity()
+    writeShards(tiles, tmp_path / "shards", 3, X_OFFSET)
+    sidecars = findShardSidecars([str(tmp_path / "shards")])
+    with pytest.raises(ValueError, match="Missing shards \\[1\\]"):
+        mergeShards([sidecars[0], sidecars[2]])
+
+    writeShards(tiles, tmp_path / "other", 3, X_OFFSET, {"identity": IDENTITY + 1})
+    (tmp_path / "other" / "matrix.shard-1-of-3.json").replace(
+        tmp_path / "shards" / "matrix.shard-1-of-3.json"
+    )
+    with pytest.raises(ValueError, match="different parameters"):
+        mergeShards(findShardSidecars([str(tmp_path / "shards")]))
@@ -0,0 +1,110 @@
+import re
+import struct
+
+import numpy as np
+import pytest
+
+from moddotplot.parse_fasta import hashSequence, readFastaIndex
+from moddotplot.twobit import TWOBIT_SIGNATURE, TwoBitFile
+
+BASE_CODES = {"T": 0, "C": 1, "A": 2, "G": 3, "N": 0}
+
+
+def runs(pattern, sequence):
+    # Starts and sizes of the runs of bases matching `pattern`
+    matches = list(re.finditer(pattern, sequence))
+    return [m.start() for m in matches], [m.end() - m.start() for m in matches]
+
+
+def writeTwoBit(path, records, order="<", version=0):
+    # Minimal .2bit writer, following the UCSC file format
+    offset_format = "Q" if version == 1 else "I"
+    index_size = sum(
+        1 + len(name) + struct.calcsize(order + offset_format) for name in records
+    )
+    offset = 16 + index_size
+    index, data = b"", b""
+    for name, sequence in records.items():
+        index += struct.pack(order + "B", len(name)) + name.encode()
+        index += struct.pack(order + offset_format, offset + len(data))
+        n_starts, n_sizes = runs("[Nn]+", sequence)
+        mask_starts, mask_sizes = runs("[a-z]+", sequence)
+        codes = [BASE_CODES[base] for base in sequence.upper()]
+        codes += [0] * (-len(codes) % 4)
+        packed = bytes(
+            (a << 6) | (b << 4) | (c << 2) | d for a, b, c, d in zip(*[iter(codes)] * 4)
+        )
+        data += struct.pack(order + "II", len(sequence), len(n_starts))
+        data += struct.pack(f"{order}{2 * len(n_starts)}I", *n_starts, *n_sizes)
+        data += struct.pack(order + "I", len(mask_starts))
+        data += struct.pack(
+            f"{order}{2 * len(mask_starts)}I", *mask_starts, *mask_sizes
+        )
+        data += struct.pack(order + "I", 0) + packed
+    header = struct.pack(order + "IIII", TWOBIT_SIGNATURE, version, len(records), 0)
+    with open(path, "wb") as f:
+        f.write(header + index + data)
+
+
+def randomSequence(rng, length):
+    # Random bases with N blocks and soft-masked blocks, some of them overlapping
+    sequence = np.array(list("ACGT"))[rng.integers(0, 4, length)]
+    for _ in range(8):
+        start = rng.integers(0, length)
+        sequence[start : start + rng.integers(1, 40)] = "N"
+    sequence = "".join(sequence)
+    for _ in range(8):
+        start = rng.integers(0, length)
+        end = start + rng.integers(1, 60)
+        sequence = sequence[:start] + sequence[start:end].lower() + sequence[end:]
+    return sequence
+
+
+@pytest.fixture
+def records():
+    rng = np.random.default_rng(0)
+    return {
+        "chr1": randomSequence(rng, 1001),
+        "chr2": "NNNNacgtACGTnnnnAC",
+        "chr3": randomSequence(rng, 403),
+    }
+
+
+@pytest.mark.parametrize("order,version", [("<", 0), (">", 0), ("<", 1)])
+def test_fetch_matches_sequence(tmp_path, records, order, version):
+    path = tmp_path / "test.2bit"
+    writeTwoBit(path, records, order, version)
+    rng = np.random.default_rng(1)
+    with TwoBitFile(str(path)) as seq:
+        assert seq.references == list(records)
+        assert seq.lengths == [len(sequence) for sequence in records.values()]
+        for name, sequence in records.items():
+            assert seq.fetch(name) == sequence
+            assert seq.get_reference_length(name) == len(sequence)
+            for start, end in rng.integers(0, len(sequence) + 1, (200, 2)):
+                assert seq.fetch(name, start, end) == sequence[start:end]
+            assert seq.fetch(name, -5, len(sequence) + 5) == sequence
+
+
+def test_hashes_match_fasta(tmp_path, records):
+    twobit = tmp_path / "test.2bit"
+    writeTwoBit(twobit, records)
+    fasta = tmp_path / "test.fa"
+    with open(fasta, "w") as f:
+        for name, sequence in records.items():
+            f.write(f">{name}\n")
+            for i in range(0, len(sequence), 60):
+                f.write(sequence[i : i + 60] + "\n")
+    assert readFastaIndex(str(twobit)) == readFastaIndex(str(fasta))
+    for name in records:
+        np.testing.assert_array_equal(
+            hashSequence(str(twobit), name, 21, True),
+            hashSequence(str(fasta), name, 21, True),
+        )
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "test.2bit"
+    path.write_bytes(b">chr1\nACGT\n" * 4)
+    with pytest.raises(ValueError, match="not a 2bit file"):
+        TwoBitFile(str(path))